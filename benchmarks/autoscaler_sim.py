@@ -0,0 +1,175 @@
+""" Replay a traffic curve through the Autoscaler against stand-in Loki /metrics endpoints
+
+Each simulated Pod is served on its own loopback address (127.0.0.<ordinal + 1>) by a local HTTP server,
+and scraped over HTTP by Autoscaler.scrape, as in a cluster. The clock is simulated, so a day of traffic
+runs in seconds. Prints the replicas decided on each tick and compares the replica-hours with a fleet
+provisioned for the peak. Only the decisions are replayed. The simulated Loki shares its ring on consul and its
+data on s3 (spec.config.ring and spec.config.storage), without them the operator refuses to scale it, see scalable
+in utils/k8sControllers/lokiConfig.py.
+
+    python benchmarks/autoscaler_sim.py [--tick 15] [--startup 60] [--max-replicas 10]
+"""
+
+import os
+import sys
+import math
+import random
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Append (not insert) the repo root: operator.py would shadow the stdlib operator module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.autoscaler import Autoscaler, scaling_policy, INGESTION_METRIC, MEMORY_METRIC  # noqa: E402
+from utils.k8sControllers.lokiConfig import LokiConfig, shared_state  # noqa: E402
+
+MIB = 1024 * 1024
+LOKI = 'loki/loki'
+
+
+def traffic(t):
+    """ Ingested bytes per second at t seconds: a morning ramp, a plateau with a 30s burst, an evening drop """
+    minutes = t / 60
+    if minutes < 5:
+        rate = 1.0
+    elif minutes < 10:
+        rate = 1.0 + (minutes - 5) / 5 * 11
+    elif minutes < 20:
+        rate = 12.0 + (30.0 if 15 <= minutes < 15.5 else 0.0)
+    elif minutes < 25:
+        rate = 12.0 - (minutes - 20) / 5 * 10.5
+    else:
+        rate = 1.5
+    return rate * MIB
+
+
+class Fleet:
+    def __init__(self, startup):
+        """ The simulated Loki Pods: the ingestion counter and heap of each one """
+        self.startup = startup
+        self.lock = threading.Lock()
+        self.pods = dict()  # Ordinal: [counter, heap, ready_at]
+
+    def scale(self, replicas, now):
+        with self.lock:
+            for ordinal in range(replicas):
+                self.pods.setdefault(ordinal, [0.0, 200 * MIB, now + self.startup])
+            for ordinal in [ordinal for ordinal in self.pods if ordinal >= replicas]:
+                self.pods.pop(ordinal)
+
+    def ready(self, now):
+        return sorted(ordinal for ordinal, pod in self.pods.items() if pod[2] <= now)
+
+    def advance(self, rate, dt, now):
+        """ Spread the traffic of dt seconds over the ready Pods """
+        with self.lock:
+            ready = self.ready(now)
+            for ordinal in ready:
+                pod = self.pods[ordinal]
+                pod[0] += rate / len(ready) * dt
+                # A minute of data in the ingester memory, plus a base
+                pod[1] = 200 * MIB + rate / len(ready) * 60 * random.uniform(0.9, 1.1)
+
+    def exposition(self, ordinal):
+        with self.lock:
+            counter, heap, _ = self.pods.get(ordinal, (0.0, 0.0, 0.0))
+        return (
+            f'# TYPE {INGESTION_METRIC} counter\n'
+            f'{INGESTION_METRIC}{{tenant="fake"}} {counter}\n'
+            f'# TYPE {MEMORY_METRIC} gauge\n'
+            f'{MEMORY_METRIC} {heap}\n'
+            'cortex_query_frontend_queue_length{user="fake"} 0\n'
+        )
+
+
+def serve(fleet):
+    """ Serve the /metrics of Pod <ordinal> on 127.0.0.<ordinal + 1> """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            ordinal = int(self.connection.getsockname()[0].rsplit('.', 1)[1]) - 1
+            body = fleet.exposition(ordinal).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def simulate(args):
+    fleet = Fleet(args.startup)
+    server = serve(fleet)
+    autoscaler = Autoscaler(port=server.server_address[1])
+    spec = {
+        'replicas': 1,
+        'resources': {'limits': {'memory': '2Gi'}, 'requests': {}},
+        'config': {
+            'ring': {'store': 'consul', 'consul': {'host': 'consul.loki.svc:8500'}},
+            'storage': {'s3': {'endpoint': 's3.amazonaws.com', 'bucketnames': 'loki-chunks', 'region': 'us-east-1'}}
+        },
+        'autoscaling': {'minReplicas': 1, 'maxReplicas': args.max_replicas, 'targetIngestionRate': '2Mi'}
+    }
+    policy = scaling_policy(spec)
+    config = LokiConfig(lc_name='loki', lc_namespace='loki', lc_limits=spec['resources']['limits'],
+                        lc_requests=spec['resources']['requests'], lc_uid=None, lc_shared_state=shared_state(spec))
+    if not config.scalable():
+        sys.exit('The simulated Loki config is not scalable, the operator would not scale it')
+
+    replicas, peak = spec['replicas'], 0
+    replica_seconds, overloaded = 0.0, 0.0
+    fleet.scale(replicas, 0)
+
+    print(f"{'minute':>7}{'MiB/s':>8}{'ready':>7}{'replicas':>10}")
+    for step in range(int(args.duration * 60 / args.tick)):
+        now = step * args.tick
+        fleet.advance(traffic(now), args.tick, now)
+        ready = fleet.ready(now)
+
+        pods = [{'metadata': {'name': f'loki-{ordinal}'}, 'status': {'podIP': f'127.0.0.{ordinal + 1}'}}
+                for ordinal in ready]
+        scraped = await asyncio.gather(*[autoscaler.scrape(pod) for pod in pods])
+        samples = {pod['metadata']['name']: values for pod, values in zip(pods, scraped) if values is not None}
+
+        if samples and autoscaler.observe(LOKI, samples, now):
+            new = autoscaler.desired(LOKI, policy, replicas, now)
+            if new != replicas:
+                replicas = new
+                fleet.scale(replicas, now)
+
+        peak = max(peak, replicas)
+        replica_seconds += replicas * args.tick
+        if ready and traffic(now) / len(ready) > policy['targetIngestionRate'] * 1.5:
+            overloaded += args.tick
+        if step % max(1, int(60 / args.tick)) == 0:
+            print(f'{now / 60:>7.0f}{traffic(now) / MIB:>8.1f}{len(ready):>7}{replicas:>10}')
+
+    server.shutdown()
+    # The fixed fleet must hold the plateau, the 30s burst aside
+    sized = math.ceil(12 * MIB / policy['targetIngestionRate'])
+    print(f'replica-hours: {replica_seconds / 3600:.2f} autoscaled (peak {peak}) vs '
+          f'{sized * args.duration / 60:.2f} provisioned for the {sized} replicas of the plateau')
+    print(f'seconds above 1.5x the per-replica target: {overloaded:.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tick', type=float, default=15, help='Seconds between two scrapes')
+    parser.add_argument('--startup', type=float, default=60, help='Seconds for a new Pod to become ready')
+    parser.add_argument('--duration', type=float, default=40, help='Minutes simulated')
+    parser.add_argument('--max-replicas', type=int, default=10)
+    args = parser.parse_args()
+    random.seed(1)
+    asyncio.run(simulate(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+""" Benchmark of the repeated-query latency with the cache tier rendered by the operator for a Loki spec
+
+A dashboard refresh sends the same queries again. Without a cache each one decompresses and scans the
+chunks again. With spec.cache, the results go through the two levels of the config generated by
+lokiConfig.render: the in-process fifocache sized from the memory limit, then the memcached of the
+Deployment rendered by lokiCache. The memcached is a local stand-in speaking its text protocol, started with
+the -m and -I of the rendered Deployment, or a real one with --server. Also checks that a chunk of the target
+size of every profile fits in a memcached item.
+
+    python benchmarks/bench_cache.py [--queries 20] [--repeats 10] [--chunks 200] [--memory 2Gi] [--server host:11211]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import hashlib
+import argparse
+import threading
+import socketserver
+import collections
+import yaml
+
+# Append (not insert) the repo root: operator.py would shadow the stdlib operator module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.k8sControllers import lokiConfig  # noqa: E402
+from utils.k8sControllers.lokiCache import LokiCache, cache_host, MIB  # noqa: E402
+from utils.k8sControllers.lokiManifest import freeze  # noqa: E402
+
+LEVELS = ('debug', 'info', 'warn', 'error')
+_DURATION = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def tier(spec, profile=lokiConfig.DEFAULT_PROFILE):
+    """ Return the memcached args of the cache Deployment and the Loki config rendered for a Loki spec """
+    cache = LokiCache(ch_name='loki', ch_namespace='loki', ch_uid=None, ch_cache=spec['cache'], ch_annotation='hash')
+    container = cache.deployment()['spec']['template']['spec']['containers'][0]
+    args = dict(zip(container['args'][::2], container['args'][1::2]))
+
+    text, _ = lokiConfig.render(
+        limits=freeze(spec['resources']['limits']),
+        requests=freeze(spec['resources']['requests']),
+        profile=profile,
+        cache_host=cache_host('loki', 'loki', spec['cache'])
+    )
+    return args, yaml.safe_load(text)
+
+
+def byte_size(value) -> int:
+    """ Parse a Loki byte size as rendered by lokiConfig, e.g. 204MiB """
+    return int(value[:-3]) * MIB
+
+
+def seconds(value) -> int:
+    return int(value[:-1]) * _DURATION[value[-1]]
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    """ The get and set commands of the memcached text protocol, enough for a results cache """
+
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+
+            if parts[0] == b'set':
+                key, size = parts[1], int(parts[4])
+                value = self.rfile.read(size + 2)[:size]
+                self.wfile.write(server.store(key, value))
+            elif parts[0] == b'get':
+                # One write per response: split writes would wait on the delayed ACKs
+                response = b''
+                for key in parts[1:]:
+                    value = server.load(key)
+                    if value is not None:
+                        response += b'VALUE %s 0 %d\r\n%s\r\n' % (key, len(value), value)
+                self.wfile.write(response + b'END\r\n')
+            else:
+                self.wfile.write(b'ERROR\r\n')
+
+
+class StandInCache(socketserver.ThreadingTCPServer):
+    """ A memcached with the memory (-m) and the max item size (-I) of its args, evicting the least recently used """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, args):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.memory = int(args['-m']) * MIB
+        self.item_size = int(args['-I'][:-1]) * MIB
+        self.items = collections.OrderedDict()
+        self.used = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def store(self, key, value) -> bytes:
+        # The item header and the key count against the item size, as in memcached
+        if len(key) + len(value) + 64 > self.item_size:
+            return b'SERVER_ERROR object too large for cache\r\n'
+        with self.lock:
+            if key in self.items:
+                self.used -= len(self.items.pop(key))
+            while self.items and self.used + len(value) > self.memory:
+                self.used -= len(self.items.popitem(last=False)[1])
+                self.evictions += 1
+            self.items[key] = value
+            self.used += len(value)
+        return b'STORED\r\n'
+
+    def load(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return f'{self.server_address[0]}:{self.server_address[1]}'
+
+
+class Client:
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+
+    def get(self, key):
+        self.sock.sendall(b'get %s\r\n' % key)
+        value = None
+        while True:
+            line = self.file.readline()
+            if line == b'END\r\n':
+                return value
+            size = int(line.split()[3])
+            value = self.file.read(size + 2)[:size]
+
+    def set(self, key, value, expiration=3600) -> bool:
+        self.sock.sendall(b'set %s 0 %d %d\r\n%s\r\n' % (key, expiration, len(value), value))
+        return self.file.readline() == b'STORED\r\n'
+
+
+class FifoCache:
+    """ The in-process fifocache of the Loki config, the first level in front of memcached """
+
+    def __init__(self, max_size_bytes):
+        self.max_size_bytes = max_size_bytes
+        self.items = collections.OrderedDict()
+        self.used = 0
+
+    def get(self, key):
+        return self.items.get(key)
+
+    # The entries are only evicted, the validity of the config outlives a run
+    def set(self, key, value, expiration=None):
+        if len(value) > self.max_size_bytes:
+            return
+        while self.items and self.used + len(value) > self.max_size_bytes:
+            self.used -= len(self.items.popitem(last=False)[1])
+        self.items[key] = value
+        self.used += len(value)
+
+
+def chunks(count, lines=2000, seed=42):
+    """ Compressed chunks of synthetic log lines, like the ones read from the Loki storage """
+    rand = random.Random(seed)
+    result = list()
+    for index in range(count):
+        text = '\n'.join(
+            f'ts={index * lines + line} level={rand.choice(LEVELS)} app=app-{rand.randrange(20)} '
+            f'duration={rand.randrange(1000)}ms msg="request {rand.getrandbits(32):08x} done"'
+            for line in range(lines)
+        )
+        result.append(zlib.compress(text.encode(), 6))
+    return result
+
+
+def execute(query, data):
+    """ Run a query the way a querier does without cache: decompress and scan every chunk """
+    app, level = query
+    pattern = re.compile(rf'level={level} app={app} duration=(\d+)ms')
+    count, total = 0, 0
+    for chunk in data:
+        for match in pattern.finditer(zlib.decompress(chunk).decode()):
+            count += 1
+            total += int(match.group(1))
+    return json.dumps({'app': app, 'level': level, 'count': count, 'avg_ms': total / count if count else 0}).encode()
+
+
+def run(queries, repeats, data, levels=(), expiration=3600, salt=''):
+    """ Send every query repeats times, as successive dashboard refreshes, through the cache levels in order.
+    Return each latency """
+    latencies = list()
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            key = hashlib.sha256(f'{salt}{query}'.encode()).hexdigest().encode()
+            missed = list()
+            value = None
+            for level in levels:
+                value = level.get(key)
+                if value is not None:
+                    break
+                missed.append(level)
+            if value is None:
+                value = execute(query, data)
+            for level in missed:
+                level.set(key, value, expiration)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(label, latencies):
+    print(f'{label:<26}{percentile(latencies, 0.5) * 1e3:>10.2f}{percentile(latencies, 0.99) * 1e3:>10.2f}'
+          f'{sum(latencies) / len(latencies) * 1e3:>10.2f}')
+
+
+def check_chunks(spec, cache):
+    """ Store a chunk of the target size of every profile on the memcached, returning the profiles refused """
+    refused = list()
+    for profile in lokiConfig.PROFILES:
+        _, config = tier(spec, profile)
+        size = config['ingester']['chunk_target_size']
+        stored = cache.set(f'chunk-{profile}-{random.getrandbits(32)}'.encode(), os.urandom(size))
+        print(f'{profile:<10} chunk_target_size {size / MIB:.1f}MiB: {"stored" if stored else "REFUSED"}')
+        if not stored:
+            refused.append(profile)
+    return refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=20, help='Distinct queries of the dashboard')
+    parser.add_argument('--repeats', type=int, default=10, help='Refreshes of the dashboard')
+    parser.add_argument('--chunks', type=int, default=200, help='Chunks scanned by each query')
+    parser.add_argument('--memory', default='2Gi', help='Memory limit of the Loki, sizes the fifocache')
+    parser.add_argument('--cache-memory', default='512Mi', help='spec.cache.memory, sizes the memcached -m')
+    parser.add_argument('--server', help='host:port of a real memcached, a local stand-in by default')
+    args = parser.parse_args()
+
+    spec = {
+        'resources': {'limits': {'cpu': '1', 'memory': args.memory}, 'requests': {}},
+        'cache': {'memory': args.cache_memory}
+    }
+    memcached_args, config = tier(spec)
+    results_cache = config['query_range']['results_cache']['cache']
+    fifo = FifoCache(byte_size(results_cache['fifocache']['max_size_bytes']))
+    expiration = seconds(results_cache['memcached']['expiration'])
+
+    data = chunks(args.chunks)
+    queries = [(f'app-{index % 20}', LEVELS[index % len(LEVELS)]) for index in range(args.queries)]
+
+    address = args.server or StandInCache(memcached_args).start()
+    cache = Client(address)
+
+    print(f'memcached {" ".join(f"{flag} {value}" for flag, value in memcached_args.items())} on {address}, '
+          f'fifocache {results_cache["fifocache"]["max_size_bytes"]}')
+    refused = check_chunks(spec, cache)
+
+    print(f'{len(queries)} queries x {args.repeats} refreshes over {args.chunks} chunks')
+    print(f"{'':<26}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+
+    without = run(queries, args.repeats, data)
+    report('no cache', without)
+
+    # A real memcached keeps the results of the previous runs
+    salt = random.getrandbits(64)
+    cold = run(queries, 1, data, (cache,), expiration, salt)
+    report('memcached, first refresh', cold)
+
+    warm = run(queries, args.repeats - 1, data, (cache,), expiration, salt) if args.repeats > 1 else cold
+    report('memcached, next refreshes', warm)
+
+    # Another querier: a cold fifocache in front of the warm memcached, then its own warm fifocache
+    shared = run(queries, 1, data, (fifo, cache), expiration, salt)
+    report('fifocache + memcached', shared)
+    local = run(queries, args.repeats - 1, data, (fifo, cache), expiration, salt) if args.repeats > 1 else shared
+    report('fifocache, next refreshes', local)
+
+    print(f'repeated-query speedup: {percentile(without, 0.5) / percentile(warm, 0.5):.0f}x memcached, '
+          f'{percentile(without, 0.5) / percentile(local, 0.5):.0f}x fifocache (p50)')
+    if refused:
+        return f'The memcached item size refuses the chunks of the {", ".join(refused)} profiles'
+
+
+if __name__ == '__main__':
+    sys.exit(main())
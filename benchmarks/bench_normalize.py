@@ -0,0 +1,76 @@
+""" Benchmark of the normalize + compare cost per StatefulSet
+
+    python benchmarks/bench_normalize.py [statefulsets]
+"""
+
+import os
+import sys
+import copy
+import time
+
+# Append (not insert) the repo root: operator.py would shadow the stdlib operator module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.k8sControllers import lokiManifest  # noqa: E402
+from utils.normalize import FLAVORS, normalizer  # noqa: E402
+
+
+def desired(index):
+    labels = lokiManifest.freeze({'app': f'loki-{index}'})
+    manifest, _ = lokiManifest.render(
+        name=f'loki-{index}',
+        namespace='loki',
+        image='grafana/loki:2.4.2',
+        limits=lokiManifest.freeze({'cpu': '1', 'memory': '1Gi'}),
+        requests=lokiManifest.freeze({'cpu': '500m', 'memory': '512Mi'}),
+        labels=labels,
+        managed_labels=labels,
+        replicas=1,
+        storage='10Gi',
+        storage_class=None,
+        uid=f'uid-{index}',
+        rules=('logs-alert',),
+        annotation='jack.experts/spec-hash',
+        config_annotation='jack.experts/config-hash',
+        config_hash='0123456789abcdef'
+    )
+    return manifest
+
+
+def live(manifest):
+    """ The desired StatefulSet plus the fields set by the API server and Rancher """
+    sts = copy.deepcopy(manifest)
+    sts['metadata'].update({
+        'creationTimestamp': '2022-02-09T00:00:00Z',
+        'resourceVersion': '123456',
+        'uid': 'uid',
+        'generation': 3,
+        'managedFields': [{'manager': 'loki-operator', 'fieldsV1': {'f:spec': {'f:replicas': {}}}}] * 4
+    })
+    sts['spec']['template']['metadata']['annotations']['cattle.io/timestamp'] = '2022-02-09T00:00:00Z'
+    sts['spec']['template']['spec']['containers'][0]['securityContext'] = {}
+    sts['status'] = {'replicas': 1, 'readyReplicas': 1, 'currentRevision': 'loki-0-abc'}
+    return sts
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pairs = [(live(desired(index)), desired(index)) for index in range(size)]
+    rancher = normalizer('rancher')
+
+    start = time.perf_counter()
+    in_sync = sum(rancher(live_sts) == rancher(desired_sts) for live_sts, desired_sts in pairs)
+    elapsed = time.perf_counter() - start
+    print(f'normalize + compare    {elapsed / size * 1e6:>8.2f} us/StatefulSet ({in_sync}/{size} in sync)')
+
+    start = time.perf_counter()
+    for live_sts, _ in pairs:
+        copy.deepcopy(live_sts)
+    elapsed = time.perf_counter() - start
+    print(f'deepcopy (old path)    {elapsed / size * 1e6:>8.2f} us/StatefulSet')
+
+    print(f'flavors: {", ".join(sorted(FLAVORS))}')
+
+
+if __name__ == '__main__':
+    main()
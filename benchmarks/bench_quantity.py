@@ -0,0 +1,53 @@
+""" Benchmark of the quantity engine over large batches of resources dicts
+
+    python benchmarks/bench_quantity.py [batch size]
+"""
+
+import os
+import sys
+import time
+import random
+
+# Append (not insert) the repo root: operator.py would shadow the stdlib operator module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import quantity  # noqa: E402
+
+_CPU = ['100m', '250m', '500m', '1', '1.5', '2', '1500m', '12345678n', '2e3']
+_MEMORY = ['128Mi', '512Mi', '1Gi', '1024Mi', '1.5Gi', '2G', '500M', '1048576Ki', '3e9', '2147483648']
+
+
+def batch(size, seed=0):
+    rand = random.Random(seed)
+    return [
+        {
+            'limits': {'cpu': rand.choice(_CPU), 'memory': rand.choice(_MEMORY)},
+            'requests': {'cpu': rand.choice(_CPU), 'memory': rand.choice(_MEMORY)}
+        }
+        for _ in range(size)
+    ]
+
+
+def measure(label, fn, size):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<28} {elapsed * 1e3:>10.1f} ms {elapsed / size * 1e6:>10.2f} us/dict')
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    current, desired = batch(size, seed=1), batch(size, seed=2)
+
+    print(f'{size} resources dicts')
+    measure('parse_resources', lambda: [quantity.parse_resources(item) for item in current], size)
+    measure('serialize_resources', lambda: [quantity.serialize_resources(item) for item in current], size)
+    measure('resources_equal', lambda: [quantity.resources_equal(a, b) for a, b in zip(current, desired)], size)
+    measure('resources_diff', lambda: [quantity.resources_diff(a, b) for a, b in zip(current, desired)], size)
+    measure('scale memory x1.25', lambda: [
+        quantity.scale(item['limits']['memory'], 1.25, round_to='1Mi') for item in current
+    ], size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+""" Throughput of the sharded operator with 1, 2, 4... replicas against one fake API server
+
+Each replica is its own process running operator.py with LOKI_OPERATOR_SHARDING=true. Once the replicas
+agree on the hash ring, they all run create_fn on the Lokis they own, then Reconciliation.compare_resources.
+Reports the events/s of the whole fleet of replicas and the speedup over a single replica, and checks that
+every Loki was handled by exactly one replica. A replica bounds its API calls in flight
+(LOKI_OPERATOR_API_CONCURRENCY), so the replicas add up with an API latency, not on a single CPU.
+
+    python benchmarks/bench_sharding.py --fleet 1000 --replicas 1,2,4 --latency 20
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BENCHMARKS)
+
+from fake_apiserver import FakeApiServer  # noqa: E402
+from load_test import loki, load_operator  # noqa: E402
+
+# Seconds without renew before a replica leaves the ring, short so the ring settles in a few seconds
+LEASE_DURATION = 3
+
+
+async def replica(replicas, concurrency):
+    """ Run a replica: wait for the ring of all the replicas, then for the go of the parent on stdin """
+    op = load_operator()
+    from kubernetes import client
+    from utils.apiClient import api_client
+    from utils.informer import get_informer
+
+    await op.informers()
+
+    start = time.monotonic()
+    while op.sharding.ring is None or op.sharding.pending is not None or len(op.sharding.ring.members) != replicas:
+        if time.monotonic() - start > 60:
+            raise RuntimeError(f'The ring of {replicas} replicas did not settle')
+        await asyncio.sleep(0.1)
+
+    lokis = client.CustomObjectsApi(api_client()).list_cluster_custom_object(
+        group='jack.experts', version='v1', plural='lokis'
+    )['items']
+    owned = [item for item in lokis if op.owned(item['metadata']['name'], item['metadata']['namespace'])]
+
+    print('ready', flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(item):
+        async with semaphore:
+            await op.create_fn(body=item, spec=item['spec'], name=item['metadata']['name'],
+                               namespace=item['metadata']['namespace'])
+
+    start = time.perf_counter()
+    await asyncio.gather(*[create(item) for item in owned])
+    created = time.perf_counter() - start
+
+    # Let the cache see the new StatefulSets, a missing one would be created again
+    statefulsets = get_informer('statefulsets')
+    while any(statefulsets.get(item['metadata']['namespace'], item['metadata']['name']) is None for item in owned):
+        await asyncio.sleep(0.1)
+    start = time.perf_counter()
+    synced = await op.rec.compare_resources()
+    compared = time.perf_counter() - start
+
+    print(json.dumps({
+        'keys': [f"{item['metadata']['namespace']}/{item['metadata']['name']}" for item in owned],
+        'create_fn': created,
+        'compare_resources': compared,
+        'drifted': sum(1 for in_sync in synced.values() if not in_sync)
+    }), flush=True)
+    op.sharding.stop()
+
+
+def run(size, replicas, args):
+    """ Start the replicas on a fresh server seeded with the fleet, return the report of the run """
+    server = FakeApiServer(latency=args.latency / 1e3, jitter=args.jitter / 1e3)
+    server.start()
+    kubeconfig = os.path.join(tempfile.mkdtemp(), 'kubeconfig')
+    server.write_kubeconfig(kubeconfig)
+    for index in range(size):
+        server.seed('apis/jack.experts/v1', 'lokis', loki(index))
+
+    # Outside of a cluster, so utils.apiClient falls back to the fake kubeconfig
+    env = {key: value for key, value in os.environ.items() if not key.startswith('KUBERNETES_SERVICE')}
+    env.update({
+        'KUBECONFIG': kubeconfig,
+        'LOKI_OPERATOR_METRICS_PORT': '0',
+        'LOKI_OPERATOR_SHARDING': 'true',
+        'LOKI_OPERATOR_SHARD_LEASE_DURATION': str(LEASE_DURATION)
+    })
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--run', str(replicas), '--concurrency', str(args.concurrency)],
+            cwd='/', env=dict(env, LOKI_OPERATOR_SHARD_ID=f'replica-{index}'),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=tempfile.TemporaryFile(), text=True
+        )
+        for index in range(replicas)
+    ]
+
+    for process in processes:
+        if process.stdout.readline().strip() != 'ready':
+            process.wait()
+            process.stderr.seek(0)
+            sys.exit(f'A replica of {replicas} failed to start:\n{process.stderr.read().decode()}')
+
+    api_calls = server.api_calls()
+    for process in processes:
+        process.stdin.write('go\n')
+        process.stdin.flush()
+    reports = [json.loads(process.stdout.readline()) for process in processes]
+    for process in processes:
+        process.wait()
+    server.stop()
+
+    keys = [key for report in reports for key in report['keys']]
+    if len(keys) != size or len(set(keys)) != size:
+        sys.exit(f'{replicas} replicas handled {len(set(keys))} distinct Lokis out of {size}, {len(keys)} in all')
+
+    return {
+        'replicas': replicas,
+        'create_fn': size / max(report['create_fn'] for report in reports),
+        'compare_resources': size / max(report['compare_resources'] for report in reports),
+        'api_calls_per_loki': (server.api_calls() - api_calls) / size,
+        'share': (min(len(report['keys']) for report in reports), max(len(report['keys']) for report in reports)),
+        'drifted': sum(report['drifted'] for report in reports)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fleet', type=int, default=1000, help='Number of Lokis')
+    parser.add_argument('--replicas', default='1,2,4', help='Comma separated numbers of operator replicas')
+    parser.add_argument('--latency', type=float, default=20.0, help='Mean API latency in ms')
+    parser.add_argument('--jitter', type=float, default=5.0, help='Standard deviation of the API latency in ms')
+    parser.add_argument('--concurrency', type=int, default=100, help='Handlers running at the same time per replica')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)  # A single replica, in this process
+    args = parser.parse_args()
+
+    if args.run is not None:
+        asyncio.run(replica(args.run, args.concurrency))
+        return
+
+    results = [run(args.fleet, int(replicas), args) for replicas in args.replicas.split(',')]
+
+    print(f"{'replicas':>8}{'create_fn/s':>13}{'speedup':>9}{'compare/s':>11}{'speedup':>9}"
+          f"{'calls/loki':>12}{'share':>12}{'drifted':>9}")
+    for result in results:
+        share = f"{result['share'][0]}-{result['share'][1]}"
+        print(f"{result['replicas']:>8}{result['create_fn']:>13.1f}"
+              f"{result['create_fn'] / results[0]['create_fn']:>9.2f}{result['compare_resources']:>11.1f}"
+              f"{result['compare_resources'] / results[0]['compare_resources']:>9.2f}"
+              f"{result['api_calls_per_loki']:>12.2f}{share:>12}{result['drifted']:>9}")
+
+
+if __name__ == '__main__':
+    main()
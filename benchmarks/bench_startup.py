@@ -0,0 +1,115 @@
+""" Benchmark of the cold start and of the per-event client overhead
+
+Compare the old path (load the configuration and build new API objects on every LokiSf) with the
+process-wide ApiClient built once. Out of a cluster and without a kubeconfig, the configuration is
+loaded from the fake API server of benchmarks/fake_apiserver.py.
+
+    python benchmarks/bench_startup.py [events]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+# Append (not insert) the repo root: operator.py would shadow the stdlib operator module
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.append(ROOT)
+sys.path.append(BENCHMARKS)
+
+from fake_apiserver import FakeApiServer  # noqa: E402
+
+
+def fake_cluster():
+    """ Point KUBECONFIG to a fake API server when there is no cluster configuration. Before the kubernetes
+    import, which reads the kubeconfig location """
+    kubeconfig = os.environ.get('KUBECONFIG', os.path.expanduser('~/.kube/config'))
+    if 'KUBERNETES_SERVICE_HOST' in os.environ or os.path.exists(kubeconfig):
+        return None
+
+    server = FakeApiServer()
+    server.start()
+    os.environ['KUBECONFIG'] = os.path.join(tempfile.mkdtemp(), 'kubeconfig')
+    server.write_kubeconfig(os.environ['KUBECONFIG'])
+    return server
+
+
+fake_server = fake_cluster()
+
+from kubernetes import client, config  # noqa: E402
+from kubernetes.config.config_exception import ConfigException  # noqa: E402
+from utils.apiClient import api_client  # noqa: E402
+from utils.k8sControllers.lokiSf import LokiSf  # noqa: E402
+
+
+def import_time(module):
+    """ Seconds to import a module on a fresh interpreter """
+    code = (
+        'import sys, time; sys.path.append(sys.argv[1]); start = time.perf_counter(); '
+        f'import {module}; print(time.perf_counter() - start)'
+    )
+    output = subprocess.run([sys.executable, '-c', code, ROOT], cwd='/', capture_output=True, text=True, check=True)
+    return float(output.stdout)
+
+
+def load_config():
+    try:
+        config.load_incluster_config()
+    except ConfigException:
+        config.load_kube_config()
+
+
+def old_event():
+    """ What every LokiSf cost before: a configuration load plus new API objects """
+    load_config()
+    client.AppsV1Api()
+    client.CoreV1Api()
+    client.CustomObjectsApi()
+
+
+def new_loki(index=0):
+    return LokiSf(
+        lk_name=f'loki-{index}',
+        lk_namespace='loki',
+        lk_image='grafana/loki:2.4.2',
+        lk_limits={'cpu': '1', 'memory': '1Gi'},
+        lk_requests={'cpu': '500m', 'memory': '512Mi'},
+        lk_labels={'app': f'loki-{index}'},
+        lk_replicas=1,
+        lk_storage='10Gi',
+        lk_uid=f'uid-{index}'
+    )
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print(f'import utils.resources {import_time("utils.resources") * 1e3:>8.2f} ms')
+
+    start = time.perf_counter()
+    api_client()
+    print(f'shared ApiClient       {(time.perf_counter() - start) * 1e3:>8.2f} ms (once)')
+
+    start = time.perf_counter()
+    for index in range(events):
+        old_event()
+        new_loki(index).manifest()
+    elapsed = time.perf_counter() - start
+    print(f'old per event          {elapsed / events * 1e6:>8.2f} us/event')
+
+    start = time.perf_counter()
+    for index in range(events):
+        loki = new_loki(index)
+        loki.manifest()
+        loki.api.api  # Force the lazy API object
+    elapsed = time.perf_counter() - start
+    print(f'shared per event       {elapsed / events * 1e6:>8.2f} us/event')
+
+    if fake_server is not None:
+        fake_server.stop()
+
+
+if __name__ == '__main__':
+    main()
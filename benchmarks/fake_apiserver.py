@@ -0,0 +1,412 @@
+""" In-process fake Kubernetes API server for the benchmarks
+
+Serves any resource under /api/<version> and /apis/<group>/<version> from memory: get, list (equality
+label selectors), watch (chunked, from a resourceVersion), create (with dryRun), merge, strategic merge
+and apply patches (an apply drops the fields its manager stops applying), update and delete. A change of
+an immutable StatefulSet field is refused with a 422, as the API server does. Every request can wait a
+modeled latency, and the calls are counted by verb and resource.
+
+    server = FakeApiServer(latency=0.005, jitter=0.002)
+    server.start()
+    server.write_kubeconfig('/tmp/kubeconfig')
+"""
+
+import bisect
+import collections
+import copy
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Merge keys of the lists merged by a strategic merge patch, as the API server does for the apps/v1 and v1 types
+_MERGE_KEYS = {
+    'containers': 'name',
+    'initContainers': 'name',
+    'volumes': 'name',
+    'volumeMounts': 'mountPath',
+    'ports': 'containerPort',
+    'env': 'name',
+    'ownerReferences': 'uid'
+}
+
+# Watch events kept per collection, older resourceVersions answer 410 Gone
+_EVENTS_KEPT = 50000
+
+
+def _merge(target, patch, strategic):
+    if not isinstance(patch, dict) or not isinstance(target, dict):
+        return copy.deepcopy(patch)
+
+    result = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif strategic and isinstance(value, list) and key in _MERGE_KEYS and isinstance(result.get(key), list):
+            merge_key = _MERGE_KEYS[key]
+            items = list(result[key])
+            positions = {item.get(merge_key): index for index, item in enumerate(items)}
+            for item in value:
+                index = positions.get(item.get(merge_key))
+                if index is None:
+                    items.append(copy.deepcopy(item))
+                else:
+                    items[index] = _merge(items[index], item, strategic)
+            result[key] = items
+        else:
+            result[key] = _merge(result.get(key), value, strategic)
+    return result
+
+
+def _prune(target, previous, applied):
+    """ Remove from target the fields of the previous apply missing from the new one, as a server-side apply
+    drops the fields its manager stops applying. The ownership taken by updates is not modeled """
+    if not isinstance(target, dict) or not isinstance(previous, dict):
+        return target
+
+    applied = applied if isinstance(applied, dict) else {}
+    result = dict(target)
+    for key, value in previous.items():
+        if key not in applied:
+            result.pop(key, None)
+        elif isinstance(value, dict):
+            result[key] = _prune(result.get(key), value, applied[key])
+        elif isinstance(value, list) and key in _MERGE_KEYS and isinstance(result.get(key), list):
+            merge_key = _MERGE_KEYS[key]
+            old_items = {item.get(merge_key): item for item in value if isinstance(item, dict)}
+            new_items = {item.get(merge_key): item for item in applied[key] or [] if isinstance(item, dict)}
+            result[key] = [
+                _prune(item, old_items[item.get(merge_key)], new_items[item.get(merge_key)])
+                if item.get(merge_key) in old_items else item
+                for item in result[key]
+                if item.get(merge_key) not in old_items or item.get(merge_key) in new_items
+            ]
+    return result
+
+
+def _immutable(plural, current, obj):
+    """ Return the StatefulSet field an update must not change, as the API server refuses it, None when allowed """
+    if plural != 'statefulsets':
+        return None
+
+    def claims(spec):
+        return [(claim['metadata']['name'], ((claim.get('spec') or {}).get('resources') or {}).get('requests'))
+                for claim in spec.get('volumeClaimTemplates') or []]
+
+    old, new = current.get('spec') or {}, obj.get('spec') or {}
+    if old.get('podManagementPolicy', 'OrderedReady') != new.get('podManagementPolicy', 'OrderedReady'):
+        return 'podManagementPolicy'
+    if claims(old) != claims(new):
+        return 'volumeClaimTemplates'
+    if old.get('selector') != new.get('selector'):
+        return 'selector'
+    return None
+
+
+def _matches(obj, namespace, selector):
+    if namespace is not None and obj['metadata'].get('namespace') != namespace:
+        return False
+    labels = obj['metadata'].get('labels') or {}
+    return all(labels.get(key) == value for key, value in selector.items())
+
+
+class FakeApiServer:
+    def __init__(self, latency=0.0, jitter=0.0, host='127.0.0.1', port=0):
+        """ Fake Kubernetes API server running on a background thread
+        :param latency: Mean seconds added to every request, watches apart
+        :param jitter: Standard deviation of the added seconds
+        :param host: The listen address
+        :param port: The listen port, a free one by default
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.host = host
+        self.port = port
+
+        self.objects = collections.defaultdict(dict)  # (prefix, plural) -> {(namespace, name): object}
+        self.events = collections.defaultdict(list)  # (prefix, plural) -> [(resourceVersion, type, object)]
+        self.versions = collections.defaultdict(list)  # (prefix, plural) -> resourceVersion of each event
+        self.resource_version = 0
+        self.calls = collections.Counter()  # (verb, plural) -> number of requests
+        self.applied = dict()  # (prefix, plural, namespace, name, field manager) -> last applied body
+
+        self.__condition = threading.Condition()
+        self.__server = None
+        self.__stopped = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def start(self) -> str:
+        self.__server = ThreadingHTTPServer((self.host, self.port), self.__handler())
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+        threading.Thread(target=self.__server.serve_forever, name='fake-apiserver', daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.__stopped.set()
+        with self.__condition:
+            self.__condition.notify_all()
+        if self.__server is not None:
+            self.__server.shutdown()
+
+    def write_kubeconfig(self, path):
+        """ Write a kubeconfig pointing to the server, loaded by utils.apiClient out of a cluster """
+        kubeconfig = {
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'fake', 'cluster': {'server': self.url}}],
+            'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+            'current-context': 'fake'
+        }
+        with open(path, 'w') as file:
+            json.dump(kubeconfig, file)  # JSON is valid YAML
+
+    def api_calls(self) -> int:
+        """ Number of requests, the long-lived watches apart """
+        return sum(count for (verb, _), count in self.calls.items() if verb != 'watch')
+
+    def seed(self, prefix, plural, obj):
+        """ Store an object without counting a call, e.g. seed('apis/jack.experts/v1', 'lokis', loki) """
+        with self.__condition:
+            return self.__store((prefix, plural), self.__new(obj, None), 'ADDED')
+
+    # Storage
+
+    @staticmethod
+    def __now() -> str:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def __store(self, collection, obj, event_type):
+        self.resource_version += 1
+        # The stored objects are never mutated, the past events keep their version
+        obj = dict(obj, metadata=dict(obj['metadata'], resourceVersion=str(self.resource_version)))
+        key = (obj['metadata'].get('namespace'), obj['metadata']['name'])
+
+        if event_type == 'DELETED':
+            self.objects[collection].pop(key, None)
+        else:
+            self.objects[collection][key] = obj
+
+        events, versions = self.events[collection], self.versions[collection]
+        events.append((self.resource_version, event_type, obj))
+        versions.append(self.resource_version)
+        if len(events) > _EVENTS_KEPT:
+            del events[:len(events) - _EVENTS_KEPT]
+            del versions[:len(versions) - _EVENTS_KEPT]
+        self.__condition.notify_all()
+        return obj
+
+    def __new(self, obj, namespace):
+        obj = copy.deepcopy(obj)
+        meta = obj.setdefault('metadata', {})
+        if namespace is not None:
+            meta['namespace'] = namespace
+        meta.setdefault('uid', str(uuid.uuid4()))
+        meta.setdefault('creationTimestamp', self.__now())
+        meta['generation'] = 1
+        return obj
+
+    def __changed(self, old, new):
+        generation = old['metadata'].get('generation', 1)
+        if old.get('spec') != new.get('spec'):
+            generation += 1
+        new['metadata'] = dict(new['metadata'], generation=generation)
+        return new
+
+    # HTTP
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._FakeApiServer__serve(self, 'GET')
+
+            def do_POST(self):
+                server._FakeApiServer__serve(self, 'POST')
+
+            def do_PATCH(self):
+                server._FakeApiServer__serve(self, 'PATCH')
+
+            def do_PUT(self):
+                server._FakeApiServer__serve(self, 'PUT')
+
+            def do_DELETE(self):
+                server._FakeApiServer__serve(self, 'DELETE')
+
+        return Handler
+
+    @staticmethod
+    def __reply(request, code, body):
+        data = json.dumps(body).encode()
+        request.send_response(code)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def __status(self, request, code, reason, message):
+        self.__reply(request, code, {
+            'kind': 'Status', 'apiVersion': 'v1', 'metadata': {},
+            'status': 'Failure', 'reason': reason, 'message': message, 'code': code
+        })
+
+    @staticmethod
+    def __route(path):
+        """ Return the collection, namespace and name of an API path """
+        segments = [segment for segment in path.split('/') if segment]
+        size = 2 if segments[0] == 'api' else 3
+        prefix, rest = '/'.join(segments[:size]), segments[size:]
+
+        namespace = None
+        if rest[:1] == ['namespaces'] and len(rest) >= 3:
+            namespace, rest = rest[1], rest[2:]
+
+        name = rest[1] if len(rest) > 1 else None
+        return (prefix, rest[0]), namespace, name
+
+    def __serve(self, request, method):
+        url = urlsplit(request.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        collection, namespace, name = self.__route(url.path)
+
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length)) if length else None
+
+        if method == 'GET' and name is None and query.get('watch', '').lower() == 'true':
+            with self.__condition:
+                self.calls[('watch', collection[1])] += 1
+            return self.__watch(request, collection, namespace, query)
+
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+        content_type = request.headers.get('Content-Type', '')
+        verb = {
+            'GET': 'get' if name else 'list',
+            'POST': 'create',
+            'PATCH': 'apply' if 'apply-patch' in content_type else 'patch',
+            'PUT': 'update',
+            'DELETE': 'delete'
+        }[method]
+
+        with self.__condition:
+            self.calls[(verb, collection[1])] += 1
+            objects = self.objects[collection]
+            current = objects.get((namespace, name)) if name else None
+
+            if verb == 'list':
+                selector = dict(
+                    term.split('=', 1) for term in query.get('labelSelector', '').split(',') if '=' in term
+                )
+                items = [obj for obj in objects.values() if _matches(obj, namespace, selector)]
+                return self.__reply(request, 200, {
+                    'kind': 'List', 'apiVersion': 'v1',
+                    'metadata': {'resourceVersion': str(self.resource_version)},
+                    'items': items
+                })
+
+            if verb == 'get':
+                if current is None:
+                    return self.__status(request, 404, 'NotFound', f'{collection[1]} "{name}" not found')
+                return self.__reply(request, 200, current)
+
+            dry_run = 'dryRun' in query
+
+            if verb == 'create':
+                obj = self.__new(body, namespace)
+                if collection[1] == 'statefulsets':
+                    obj['spec'].setdefault('podManagementPolicy', 'OrderedReady')
+                if (namespace, obj['metadata']['name']) in objects:
+                    message = f"{collection[1]} {obj['metadata']['name']} already exists"
+                    return self.__status(request, 409, 'AlreadyExists', message)
+                if not dry_run:
+                    obj = self.__store(collection, obj, 'ADDED')
+                return self.__reply(request, 201, obj)
+
+            if verb == 'delete':
+                if current is None:
+                    return self.__status(request, 404, 'NotFound', f'{collection[1]} "{name}" not found')
+                for key in [key for key in self.applied if key[:4] == (*collection, namespace, name)]:
+                    self.applied.pop(key)
+                self.__store(collection, current, 'DELETED')
+                return self.__reply(request, 200, current)
+
+            if current is None and verb != 'apply':
+                return self.__status(request, 404, 'NotFound', f'{collection[1]} "{name}" not found')
+
+            applied = (*collection, namespace, name, query.get('fieldManager'))
+            if current is None:
+                obj = self.__new(body, namespace)
+                if collection[1] == 'statefulsets':
+                    obj['spec'].setdefault('podManagementPolicy', 'OrderedReady')
+            elif verb == 'update':
+                obj = self.__changed(current, self.__new(body, namespace))
+                obj['metadata'].update({key: current['metadata'][key] for key in ('uid', 'creationTimestamp')})
+            elif verb == 'apply':
+                pruned = _prune(current, self.applied.get(applied), body)
+                obj = self.__changed(current, _merge(pruned, body, True))
+            else:
+                obj = self.__changed(current, _merge(current, body, 'strategic' in content_type))
+
+            field = _immutable(collection[1], current, obj) if current is not None else None
+            if field is not None:
+                message = f'{collection[1]} "{name}" is invalid: spec.{field}: Forbidden: field is immutable'
+                return self.__status(request, 422, 'Invalid', message)
+
+            if not dry_run:
+                if verb == 'apply':
+                    self.applied[applied] = copy.deepcopy(body)
+                obj = self.__store(collection, obj, 'ADDED' if current is None else 'MODIFIED')
+            return self.__reply(request, 200, obj)
+
+    def __watch(self, request, collection, namespace, query):
+        selector = dict(term.split('=', 1) for term in query.get('labelSelector', '').split(',') if '=' in term)
+        since = int(query.get('resourceVersion') or 0)
+        deadline = time.monotonic() + float(query.get('timeoutSeconds') or 60)
+
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Transfer-Encoding', 'chunked')
+        request.end_headers()
+
+        def send(data):
+            request.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            request.wfile.flush()
+
+        try:
+            while time.monotonic() < deadline and not self.__stopped.is_set():
+                with self.__condition:
+                    events = self.events[collection]
+                    if events and since and since < events[0][0] - 1:
+                        expired = {'code': 410, 'reason': 'Expired', 'message': 'too old resource version'}
+                        send(json.dumps({'type': 'ERROR', 'object': expired}).encode() + b'\n')
+                        break
+
+                    start = bisect.bisect_right(self.versions[collection], since)
+                    batch = [event for event in events[start:] if _matches(event[2], namespace, selector)]
+                    if events[start:]:
+                        since = events[-1][0]
+                    if not batch:
+                        self.__condition.wait(min(1.0, max(0.0, deadline - time.monotonic())))
+                        continue
+
+                for _, event_type, obj in batch:
+                    send(json.dumps({'type': event_type, 'object': obj}).encode() + b'\n')
+            send(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
@@ -0,0 +1,258 @@
+""" Load test of the operator handlers against the in-process fake API server
+
+Drives the real handlers of operator.py (create_fn, create_la, resources_change) plus
+Reconciliation.compare_resources with synthetic fleets of Loki and LogAlert CRs. Reports events/s,
+p50/p99 handler latency, API calls per event and peak RSS. Each fleet runs in its own process, the
+fake API server included in its RSS.
+
+    python benchmarks/load_test.py --fleet 100,1000,10000 --latency 5 --jitter 2
+    python benchmarks/load_test.py --save-baseline   # Store the results as the new baseline
+    python benchmarks/load_test.py                   # Compare with the baseline, exit 1 on a regression
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import importlib.util
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+BASELINE = os.path.join(BENCHMARKS, 'load_test_baseline.json')
+
+# Relative slack before a slower or bigger result is a regression
+TOLERANCE = 0.2
+
+# API calls per event barely depend on the timing (only the debounced ConfigMap patches do), so they get less slack
+CALLS_TOLERANCE = 0.05
+
+RESOURCES = {'limits': {'cpu': '1', 'memory': '1Gi'}, 'requests': {'cpu': '500m', 'memory': '512Mi'}}
+NEW_RESOURCES = {'limits': {'cpu': '2', 'memory': '2Gi'}, 'requests': {'cpu': '1', 'memory': '1Gi'}}
+
+
+def loki(index):
+    name = f'loki-{index}'
+    return {
+        'apiVersion': 'jack.experts/v1',
+        'kind': 'Loki',
+        'metadata': {'name': name, 'namespace': f'team-{index % 50}', 'labels': {'app': name}},
+        'spec': {'image': 'grafana/loki:2.4.2', 'replicas': 1, 'storage': '10Gi', 'resources': RESOURCES}
+    }
+
+
+def log_alert(index):
+    return {
+        'apiVersion': 'jack.experts/v1',
+        'kind': 'LogAlert',
+        'metadata': {'name': f'alert-{index}', 'namespace': f'team-{index % 50}'},
+        'spec': {'groups': [{'name': f'alert-{index}', 'rules': [{
+            'alert': 'HighErrorRate',
+            'expr': f'sum(rate({{app="app-{index}"}} |= "error" [5m])) > 10',
+            'for': '5m',
+            'labels': {'severity': 'warning'}
+        }]}]}
+    }
+
+
+def load_operator():
+    """ Import operator.py under another name, operator being the stdlib module """
+    sys.path.append(ROOT)
+    spec = importlib.util.spec_from_file_location('loki_operator', os.path.join(ROOT, 'operator.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+async def drive(server, name, calls, concurrency):
+    """ Run the handler calls with bounded concurrency, returning the scenario report """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = list()
+
+    async def one(call):
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    api_calls = server.api_calls()
+    start = time.perf_counter()
+    await asyncio.gather(*[one(call) for call in calls])
+    elapsed = time.perf_counter() - start
+
+    return report(server, name, len(calls), elapsed, api_calls, latencies)
+
+
+async def sweep(server, name, fn, events):
+    api_calls = server.api_calls()
+    start = time.perf_counter()
+    await fn()
+    return report(server, name, events, time.perf_counter() - start, api_calls, [])
+
+
+def report(server, name, events, elapsed, api_calls, latencies):
+    return {
+        'scenario': name,
+        'events': events,
+        'events_per_s': events / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1e3 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1e3 if latencies else None,
+        'api_calls_per_event': (server.api_calls() - api_calls) / events,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+async def run_fleet(size, latency, jitter, concurrency, informers):
+    from fake_apiserver import FakeApiServer
+
+    server = FakeApiServer(latency=latency, jitter=jitter)
+    server.start()
+
+    kubeconfig = os.path.join(tempfile.mkdtemp(), 'kubeconfig')
+    server.write_kubeconfig(kubeconfig)
+    os.environ['KUBECONFIG'] = kubeconfig
+    os.environ['LOKI_OPERATOR_METRICS_PORT'] = '0'
+
+    # The Lokis exist before their create event, with the uid set by the API server
+    lokis = [server.seed('apis/jack.experts/v1', 'lokis', loki(index)) for index in range(size)]
+
+    op = load_operator()
+    if informers:
+        from utils.informer import get_informer
+        await op.informers()
+        kinds = ('lokis', 'statefulsets', 'pods', 'deployments', 'configmaps')
+        while any(get_informer(kind) is None for kind in kinds):
+            await asyncio.sleep(0.05)
+
+    results = list()
+
+    # The Lokis first, with the rules ConfigMaps, as in a cluster where the LogAlerts come after them
+    results.append(await drive(server, 'create_fn', [
+        lambda item=item: op.create_fn(
+            body=item, spec=item['spec'], name=item['metadata']['name'], namespace=item['metadata']['namespace']
+        )
+        for item in lokis
+    ], concurrency))
+
+    alerts = [log_alert(index) for index in range(size)]
+    results.append(await drive(server, 'create_la', [
+        lambda alert=alert: op.create_la(
+            body=alert, name=alert['metadata']['name'], namespace=alert['metadata']['namespace']
+        )
+        for alert in alerts
+    ], concurrency))
+
+    # Let the caches see the new StatefulSets, as between two timer ticks.
+    # A freshly created Loki must be found in sync, a drift would patch it on every pass
+    for scenario in ('compare_resources/cold', 'compare_resources/warm'):
+        await asyncio.sleep(1)
+        synced = dict()
+
+        async def compare():
+            synced.update(await op.rec.compare_resources())
+
+        results.append(await sweep(server, scenario, compare, size))
+        drifted = sorted(key for key, in_sync in synced.items() if not in_sync)
+        if drifted:
+            raise RuntimeError(f"{scenario}: {len(drifted)} freshly created Lokis drifted, e.g. {drifted[0]}")
+
+    results.append(await drive(server, 'resources_change', [
+        lambda item=item: op.resources_change(new=NEW_RESOURCES, body=item)
+        for item in lokis
+    ], concurrency))
+
+    server.stop()
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    found = list()
+    for result in results:
+        key = f"{result['scenario']}/{result['events']}"
+        base = baseline.get(key)
+        if base is None:
+            continue
+
+        checks = [
+            ('events_per_s', result['events_per_s'] < base['events_per_s'] * (1 - tolerance)),
+            ('p99_ms', result['p99_ms'] is not None and base['p99_ms'] is not None and
+             result['p99_ms'] > base['p99_ms'] * (1 + tolerance)),
+            ('api_calls_per_event', result['api_calls_per_event'] > base['api_calls_per_event'] * (1 + CALLS_TOLERANCE)),
+            ('peak_rss_mb', result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance))
+        ]
+        found += [f'{key} {field}: {base[field]} -> {result[field]}' for field, regressed in checks if regressed]
+    return found
+
+
+def print_results(results):
+    print(f"{'scenario':<26}{'events':>8}{'events/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'calls/event':>13}{'RSS MB':>9}")
+    for result in results:
+        p50 = f"{result['p50_ms']:.1f}" if result['p50_ms'] is not None else '-'
+        p99 = f"{result['p99_ms']:.1f}" if result['p99_ms'] is not None else '-'
+        print(f"{result['scenario']:<26}{result['events']:>8}{result['events_per_s']:>12.1f}{p50:>10}{p99:>10}"
+              f"{result['api_calls_per_event']:>13.2f}{result['peak_rss_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fleet', default='100,1000', help='Comma separated fleet sizes, e.g. 100,1000,10000')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean API latency in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the API latency in ms')
+    parser.add_argument('--concurrency', type=int, default=100, help='Handlers running at the same time')
+    parser.add_argument('--no-informers', action='store_true', help='Read through the API instead of the caches')
+    parser.add_argument('--baseline', default=BASELINE, help='The baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)  # A single fleet, in this process
+    args = parser.parse_args()
+
+    if args.run is not None:
+        sys.path.append(BENCHMARKS)
+        results = asyncio.run(run_fleet(
+            args.run, args.latency / 1e3, args.jitter / 1e3, args.concurrency, not args.no_informers
+        ))
+        print(json.dumps(results))
+        return
+
+    # Outside of a cluster, so utils.apiClient falls back to the fake kubeconfig
+    env = {key: value for key, value in os.environ.items() if not key.startswith('KUBERNETES_SERVICE')}
+    results = list()
+    for size in [int(size) for size in args.fleet.split(',')]:
+        command = [sys.executable, os.path.abspath(__file__), '--run', str(size),
+                   '--latency', str(args.latency), '--jitter', str(args.jitter),
+                   '--concurrency', str(args.concurrency)]
+        if args.no_informers:
+            command.append('--no-informers')
+        output = subprocess.run(command, cwd='/', env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            sys.exit(f'Fleet of {size} failed:\n{output.stderr}')
+        results += json.loads(output.stdout.strip().splitlines()[-1])
+
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({f"{result['scenario']}/{result['events']}": result for result in results}, file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,29 +3,119 @@
 # Date:   09/02/2022                    #
 # # # # # # # # # # # # # # # # # # # # #
 
+import os
+import signal
 import logging
 import kopf
 import asyncio
 import typing
 
 # Kubernetes Client imports
-from kubernetes import client
 from kubernetes.client.exceptions import ApiException
 
 # Internal Imports
 from utils.k8sControllers.configmap import ConfigMap
-from utils.k8sControllers.lokiSf import LokiSf
-from utils.resources import update, vpa
+from utils.k8sControllers.lokiSf import LokiSf, pod_management_policy
+from utils.k8sControllers.lokiConfig import config_profile, shared_state
+from utils.resources import update, scale, vpa, live_stateful_set
 from utils.reconciliation import Reconciliation
-
-# TODO: Utilizar @kopf.on.timer() para reconciliação dos recursos
-
-# TODO: Ferificar como utilizar VPA para CPU
+from utils.informer import Informer, start_informers
+from utils.workQueue import WorkQueue
+from utils.oomWatcher import OomWatcher
+from utils.recommender import Recommender
+from utils.autoscaler import Autoscaler
+from utils.sharding import Sharding
+from utils import metrics
+from utils.profiler import profiler
+from utils.checkpoint import Checkpoint
+from utils.retry import retryable
+from utils.rollout import RolloutController, rollout_step
+from utils.recovery import RecoveryWatcher
 
 cm_name_rule = 'logs-alert'
 cm_ns = 'loki-operator'
 
-log_alert = ConfigMap(namespace=cm_ns, name=cm_name_rule)
+log_alert = ConfigMap(
+    namespace=cm_ns,
+    name=cm_name_rule,
+    shards=int(os.environ.get('LOKI_OPERATOR_RULES_SHARDS', '1'))
+)
+
+oom_watcher = OomWatcher(resize_fn=vpa)
+
+# Move the staged rollouts forward as the updated Loki Pods become ready
+rollout = RolloutController(cr_plural='lokis')
+
+# Time each Loki Pod takes to replay its WAL and become ready again
+recovery = RecoveryWatcher()
+
+reconciliation_interval = float(os.environ.get('LOKI_OPERATOR_RECONCILE_INTERVAL', '30'))
+
+# Resume the caches and the verified StatefulSets from the last run, instead of a List and a diff of every Loki
+checkpoint = None
+if os.environ.get('LOKI_OPERATOR_CHECKPOINT'):
+    checkpoint = Checkpoint(
+        path=os.environ['LOKI_OPERATOR_CHECKPOINT'],
+        interval=float(os.environ.get('LOKI_OPERATOR_CHECKPOINT_INTERVAL', '30'))
+    )
+
+rec = Reconciliation(
+    cr_group='jack.experts',
+    cr_plural='lokis',
+    cr_version='v1',
+    rules=log_alert.shard_names(),
+    flavor=os.environ.get('LOKI_OPERATOR_CLUSTER_FLAVOR', 'rancher'),
+    checkpoint=checkpoint,
+    ensure_rules=log_alert.create_cm
+)
+
+# Split the Lokis across the operator replicas, each replica announcing itself with a Lease
+sharding = None
+if os.environ.get('LOKI_OPERATOR_SHARDING', 'false').lower() == 'true':
+    sharding = Sharding(
+        namespace=cm_ns,
+        identity=os.environ.get('LOKI_OPERATOR_SHARD_ID', os.environ.get('HOSTNAME', 'loki-operator')),
+        lease_duration=float(os.environ.get('LOKI_OPERATOR_SHARD_LEASE_DURATION', '15'))
+    )
+
+
+def owned(name, namespace, **_):
+    """ Handler filter: True when this replica handles the object """
+    return sharding is None or sharding.owns(namespace, name)
+
+
+def handled(name, namespace, **_):
+    """ Handler filter: True when this replica handles the object now, or once the handoff is over """
+    return owned(name, namespace) or sharding.awaits(namespace, name)
+
+
+# Raised on the events of a Loki not handed over to this replica yet, not counted as a handler error
+class NotClaimed(kopf.TemporaryError):
+    expected = True
+
+
+# kopf drops the events its when filter refuses: the ones of an object coming to this replica are retried instead
+def claim(name, namespace):
+    if not owned(name, namespace):
+        raise NotClaimed(f"{namespace}/{name} is not handed over to this replica yet",
+                         delay=sharding.handoff_left() + 1)
+
+
+recommender_interval = float(os.environ.get('LOKI_OPERATOR_RECOMMENDER_INTERVAL', '0'))
+recommender = Recommender(owns=owned)
+
+# Scale the Lokis with a spec.autoscaling on the metrics of their Pods
+autoscaler_interval = float(os.environ.get('LOKI_OPERATOR_AUTOSCALER_INTERVAL', '15'))
+autoscaler = Autoscaler(owns=owned)
+
+metrics_port = int(os.environ.get('LOKI_OPERATOR_METRICS_PORT', '9090'))
+
+reconcile_queue = WorkQueue(
+    process_fn=metrics.timed('reconcile')(rec.reconcile),
+    workers=int(os.environ.get('LOKI_OPERATOR_RECONCILE_WORKERS', '4')),
+    rate=float(os.environ.get('LOKI_OPERATOR_RECONCILE_QPS', '20')),
+    burst=int(os.environ.get('LOKI_OPERATOR_RECONCILE_BURST', '40'))
+)
 
 
 async def tunnel(fn: kopf.WebhookFn) -> typing.AsyncIterator[kopf.WebhookClientConfig]:
@@ -55,6 +145,116 @@ def configure(settings: kopf.OperatorSettings, **_):
     settings.admission.server = tunnel
     settings.admission.managed = 'teste.jack.webhook'
 
+    # The replicas split the objects between them, none of them must pause the others
+    if sharding is not None:
+        settings.peering.standalone = True
+        # kopf stores the last handled state even when the when filters skip every handler: shared between the
+        # replicas, the one skipping an object would hide its changes from the one owning it
+        prefix = f'{sharding.identity}.shards.jack.experts'
+        settings.persistence.diffbase_storage = kopf.AnnotationsDiffBaseStorage(prefix=prefix)
+        settings.persistence.progress_storage = kopf.AnnotationsProgressStorage(prefix=prefix)
+
+
+# Start the List+Watch caches used by utils/ to read the cluster state
+@kopf.on.startup()
+async def informers(**_):
+    loop = asyncio.get_running_loop()
+    started = start_informers(
+        cm_namespace=cm_ns,
+        shard=sharding.caches if sharding is not None else None,
+        checkpoint=checkpoint
+    )
+    oom_watcher.attach(started['pods'], loop)
+    rollout.attach(started['statefulsets'], started['pods'], loop)
+    recovery.attach(started['pods'])
+    log_alert.attach(started['configmaps'])
+
+    if sharding is not None:
+        # Move the Lokis between the replicas: the lost ones leave the queue as soon as a new ring is seen,
+        # the gained ones are cached then, and reconciled once the handoff is over
+        def requeue():
+            for loki in started['lokis'].list():
+                key = Informer.key(loki)
+                if owned(loki['metadata']['name'], loki['metadata']['namespace']):
+                    reconcile_queue.add(key)
+                else:
+                    reconcile_queue.drop(key)
+
+        def rebalance(phase):
+            if phase == 'pending':
+                for kind in ('lokis', 'statefulsets', 'pods', 'deployments'):
+                    started[kind].refresh()
+            loop.call_soon_threadsafe(requeue)
+
+        sharding.add_listener(rebalance)
+        await loop.run_in_executor(None, sharding.start)
+
+    if checkpoint is not None:
+        checkpoint.start()
+
+
+@kopf.on.cleanup()
+async def stop_checkpoint(**_):
+    if checkpoint is not None:
+        await asyncio.get_running_loop().run_in_executor(None, checkpoint.stop)
+
+
+@kopf.on.cleanup()
+async def stop_sharding(**_):
+    if sharding is not None:
+        await asyncio.get_running_loop().run_in_executor(None, sharding.stop)
+
+
+@kopf.on.startup()
+async def reconcile_workers(**_):
+    reconcile_queue.start()
+
+
+# Serve the Prometheus metrics on /metrics
+@kopf.on.startup()
+async def metrics_server(**_):
+    if metrics_port > 0:
+        metrics.QUEUE_DEPTH.set_function(reconcile_queue.depth)
+        metrics.serve(metrics_port)
+
+
+@kopf.on.cleanup()
+async def stop_reconcile_workers(**_):
+    await reconcile_queue.stop()
+
+
+# Profile a window on SIGUSR2 (kill -USR2 <pid>), or from the start
+@kopf.on.startup()
+async def profiling(**_):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, profiler.toggle)
+    if os.environ.get('LOKI_OPERATOR_PROFILE', 'false').lower() == 'true':
+        profiler.start()
+
+
+# Recommend the cpu and memory of each Loki from its usage history
+@kopf.on.startup()
+async def start_recommender(memo: kopf.Memo, **_):
+    if recommender_interval > 0:
+        memo.recommender_task = asyncio.ensure_future(recommender.run(recommender_interval))
+
+
+@kopf.on.cleanup()
+async def stop_recommender(memo: kopf.Memo, **_):
+    if getattr(memo, 'recommender_task', None) is not None:
+        memo.recommender_task.cancel()
+
+
+@kopf.on.startup()
+async def start_autoscaler(memo: kopf.Memo, **_):
+    if autoscaler_interval > 0:
+        memo.autoscaler_task = asyncio.ensure_future(autoscaler.run(autoscaler_interval))
+
+
+@kopf.on.cleanup()
+async def stop_autoscaler(memo: kopf.Memo, **_):
+    if getattr(memo, 'autoscaler_task', None) is not None:
+        memo.autoscaler_task.cancel()
+
 #
 # @kopf.on.validate('statefulset', labels={'operated': 'True'}, operation='UPDATE')
 # def validate(body, headers, warnings, **_):
@@ -68,58 +268,133 @@ def configure(settings: kopf.OperatorSettings, **_):
 
 
 # Create Loki Resource
-@kopf.on.create('Loki')
+@kopf.on.create('Loki', when=handled)
+@metrics.timed('create_fn')
 async def create_fn(body, spec, name, namespace, **kwargs):
-    api = client.AppsV1Api()
+    claim(name, namespace)
+    try:
+        loki = LokiSf(
+            lk_name=name,
+            lk_namespace=namespace,
+            lk_image=spec['image'],
+            lk_limits=spec['resources']['limits'],
+            lk_requests=spec['resources']['requests'],
+            lk_labels=body['metadata']['labels'],
+            lk_storage=spec['storage'],
+            lk_uid=body['metadata']['uid'],
+            lk_replicas=spec['replicas'],
+            lk_rules=log_alert.shard_names(),
+            lk_pod_management_policy=pod_management_policy(spec),
+            lk_storage_class=spec.get('storageClassName'),
+            lk_config_profile=config_profile(spec),
+            lk_cache=spec.get('cache'),
+            lk_shared_state=shared_state(spec)
+        )
+    except ValueError as e:
+        # An invalid spec, retrying does not help
+        raise kopf.PermanentError(str(e))
 
+    try:
+        await log_alert.create_cm()
+        await loki.create()
+
+        # logging.info(f"\n\n\t{sf_loki}\n\n")
+        logging.info("\n\nLoki was created\n\n")
+    except ApiException as e:
+        logging.error(e)
+        # Still failing after the retries of each call: kopf retries the whole handler later
+        if retryable(e):
+            raise kopf.TemporaryError(f"{e.status} {e.reason}", delay=30)
+
+
+# Update Loki resources
+@kopf.on.field('loki', field='spec.resources', when=handled)
+@metrics.timed('resources_change')
+async def resources_change(new, body, **kwargs):
+    claim(body['metadata']['name'], body['metadata']['namespace'])
+    spec = body['spec']
+    # Without spec.podManagementPolicy, the immutable policy of the live StatefulSet is kept
+    live = await live_stateful_set(body['metadata']['name'], body['metadata']['namespace'])
     loki = LokiSf(
-        lk_name=name,
-        lk_namespace=namespace,
+        lk_name=body['metadata']['name'],
+        lk_namespace=body['metadata']['namespace'],
         lk_image=spec['image'],
-        lk_limits=spec['resources']['limits'],
-        lk_requests=spec['resources']['requests'],
+        lk_limits=new['limits'],
+        lk_requests=new['requests'],
         lk_labels=body['metadata']['labels'],
         lk_storage=spec['storage'],
         lk_uid=body['metadata']['uid'],
-        lk_replicas=spec['replicas']
+        lk_replicas=spec['replicas'],
+        lk_rules=log_alert.shard_names(),
+        lk_pod_management_policy=pod_management_policy(spec, live),
+        lk_storage_class=spec.get('storageClassName'),
+        lk_config_profile=config_profile(spec),
+        lk_cache=spec.get('cache'),
+        lk_shared_state=shared_state(spec)
     )
 
-    sf_loki = loki.stateful_set()
+    # Retune the Loki config to the new resources, the new config hash rolls the Pods out with them
+    await loki.config.apply()
+    await update(loki, step=rollout_step(spec))
 
-    try:
-        log_alert.create_cm()
-        api.create_namespaced_stateful_set(
-            body=sf_loki,
-            namespace=namespace
-        )
 
-        # logging.info(f"\n\n\t{sf_loki}\n\n")
-        logging.info("\n\nLoki was created\n\n")
+# Update Loki replicas, set by hand or by the autoscaler
+@kopf.on.field('loki', field='spec.replicas', when=handled)
+@metrics.timed('replicas_change')
+async def replicas_change(old, new, body, **kwargs):
+    claim(body['metadata']['name'], body['metadata']['namespace'])
+    # On create, the StatefulSet is created with its replicas by create_fn
+    if old is None or new is None:
+        return
+    await scale(name=body['metadata']['name'], namespace=body['metadata']['namespace'], replicas=new)
+
+
+@kopf.on.create('logalert', when=handled)
+@metrics.timed('create_la')
+async def create_la(body, name, namespace, **kwargs):
+    claim(name, namespace)
+    try:
+        await log_alert.new_key_cm(name, body['spec'])
     except ApiException as e:
-        logging.error(e)
+        # The rules were not stored, e.g. a rules ConfigMap not created yet: kopf retries the handler later
+        raise kopf.TemporaryError(f"{e.status} {e.reason}", delay=30)
 
 
-# Update Loki resources
-@kopf.on.field('loki', field='spec.resources')
-async def resources_change(new, body, **kwargs):
-    update(name=body['metadata']['name'], namespace=body['metadata']['namespace'], new_resource=new)
+@kopf.on.update('logalert', when=handled)
+@metrics.timed('update_la')
+async def update_la(body, name, namespace, **kwargs):
+    claim(name, namespace)
+    try:
+        await log_alert.new_key_cm(name, body['spec'])
+    except ApiException as e:
+        # The rules were not stored, e.g. a rules ConfigMap not created yet: kopf retries the handler later
+        raise kopf.TemporaryError(f"{e.status} {e.reason}", delay=30)
 
 
-@kopf.on.create('logalert')
-async def create_la(body, name, namespace, **kwargs):
+@kopf.on.delete('logalert', optional=True, when=handled)
+@metrics.timed('delete_la')
+async def delete_la(name, namespace, **kwargs):
+    claim(name, namespace)
+    try:
+        await log_alert.delete_key_cm(name)
+    except ApiException as e:
+        # The rules were not stored, e.g. a rules ConfigMap not created yet: kopf retries the handler later
+        raise kopf.TemporaryError(f"{e.status} {e.reason}", delay=30)
+
 
-    __cm = log_alert.new_key_cm(name, body['spec'])
+# Reconcile each Loki through the work queue, duplicated keys are collapsed
+@kopf.timer('Loki', interval=reconciliation_interval)
+async def reconciliation(name, namespace, **kwargs):
+    # Not a when filter: kopf only checks it on the object events, not on a rebalance
+    if not owned(name, namespace):
+        return
 
+    key = f'{namespace}/{name}'
+    reconcile_queue.add(key)
+    logging.debug(f"Reconcile queue depth: {reconcile_queue.depth()}, "
+                  f"last latency of {key}: {reconcile_queue.latency.get(key)}")
 
-# @kopf.timer('Loki', interval=10.0)
-# def reconciliation(spec, name, namespace, **kwargs):
-#     rec = Reconciliation(
-#         cr_group='jack.experts',
-#         cr_plural='lokis',
-#         cr_version='v1'
-#     )
 
-    # rec.compare_resources()
-# @kopf.timer('Loki', interval=30.0)
-# async def resources(spec, name, namespace, **kwargs):
-#     vpa(name, namespace)
+@kopf.on.delete('Loki', optional=True)
+async def forget_loki(name, namespace, **kwargs):
+    reconcile_queue.drop(f'{namespace}/{name}')
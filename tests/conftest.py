@@ -0,0 +1,50 @@
+""" Shared fixtures: the fake API server of benchmarks/ stands for the cluster """
+
+import os
+import sys
+import uuid
+import tempfile
+import pytest
+
+# Append (not insert) the repo root: operator.py would shadow the stdlib operator module
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+from fake_apiserver import FakeApiServer  # noqa: E402
+
+# Started before any kubernetes import, which reads the kubeconfig location, and shared by the process-wide ApiClient
+_server = FakeApiServer()
+_server.start()
+os.environ['KUBECONFIG'] = os.path.join(tempfile.mkdtemp(), 'kubeconfig')
+_server.write_kubeconfig(os.environ['KUBECONFIG'])
+os.environ.pop('KUBERNETES_SERVICE_HOST', None)
+
+
+@pytest.fixture
+def server():
+    return _server
+
+
+@pytest.fixture
+def namespace():
+    """ A namespace of its own, the server being shared by the tests """
+    return f'test-{uuid.uuid4().hex[:8]}'
+
+
+@pytest.fixture
+def informers():
+    """ Start the Informers, stopped and unregistered after the test """
+    import time
+    from utils import informer
+
+    started = informer.start_informers(cm_namespace='loki-operator')
+    deadline = time.monotonic() + 10
+    while any(informer.get_informer(kind) is None for kind in started) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    yield started
+
+    for item in started.values():
+        item.stop()
+    informer._informers.clear()
@@ -0,0 +1,61 @@
+""" The Loki config generated from the spec, and whether its replicas can be scaled """
+
+import yaml
+import pytest
+from utils.k8sControllers.lokiConfig import LokiConfig, render, scalable, shared_state
+from utils.k8sControllers.lokiManifest import freeze
+
+LIMITS = freeze({'cpu': '1', 'memory': '1Gi'})
+REQUESTS = freeze({'cpu': '500m', 'memory': '512Mi'})
+
+RING = {'store': 'consul', 'consul': {'host': 'consul.loki.svc:8500'}}
+STORAGE = {'s3': {'endpoint': 's3.amazonaws.com', 'bucketnames': 'loki-chunks', 'region': 'us-east-1'}}
+
+
+def config(spec):
+    return yaml.safe_load(render(LIMITS, REQUESTS, shared=shared_state(spec))[0])
+
+
+def test_default_config_is_not_scalable():
+    assert shared_state({}) is None
+    assert not scalable(render(LIMITS, REQUESTS)[0])
+
+
+def test_shared_ring_and_storage_are_scalable():
+    spec = {'config': {'ring': RING, 'storage': STORAGE, 'replicationFactor': 3}}
+    rendered = config(spec)
+
+    assert rendered['common']['ring']['kvstore'] == RING
+    assert rendered['common']['storage'] == STORAGE
+    assert rendered['common']['replication_factor'] == 3
+    assert rendered['schema_config']['configs'][0]['object_store'] == 's3'
+    assert scalable(render(LIMITS, REQUESTS, shared=shared_state(spec))[0])
+
+    loki = LokiConfig(lc_name='loki', lc_namespace='loki', lc_limits=dict(LIMITS), lc_requests=dict(REQUESTS),
+                      lc_uid=None, lc_shared_state=shared_state(spec))
+    assert loki.scalable()
+    assert loki.config_hash() != render(LIMITS, REQUESTS)[1]
+
+
+def test_memberlist_ring():
+    spec = {'config': {'ring': {'store': 'memberlist'}, 'memberlist': {'join_members': ['loki-memberlist:7946']},
+                       'storage': {'gcs': {'bucket_name': 'loki-chunks'}}}}
+    rendered = config(spec)
+
+    assert rendered['memberlist'] == {'join_members': ['loki-memberlist:7946']}
+    assert scalable(render(LIMITS, REQUESTS, shared=shared_state(spec))[0])
+
+
+@pytest.mark.parametrize('shared', [{'ring': RING}, {'storage': STORAGE}])
+def test_half_shared_is_not_scalable(shared):
+    assert not scalable(render(LIMITS, REQUESTS, shared=shared_state({'config': shared}))[0])
+
+
+@pytest.mark.parametrize('shared', [
+    {'ring': {'consul': {'host': 'consul:8500'}}},
+    {'storage': {'s3': {}, 'gcs': {}}},
+    {'storage': 's3'}
+])
+def test_invalid_shared_state(shared):
+    with pytest.raises(ValueError):
+        shared_state({'config': shared})
@@ -0,0 +1,64 @@
+""" The LogAlert rules ConfigMap shards """
+
+import asyncio
+from utils.k8sControllers.configmap import ConfigMap
+
+
+def test_cancelled_waiter_does_not_block_the_batch(server, namespace):
+    rules = ConfigMap(namespace=namespace, name='logs-alert', debounce=0.05)
+
+    async def run():
+        cancelled = asyncio.ensure_future(rules.new_key_cm('first', {'groups': []}))
+        second = asyncio.ensure_future(rules.new_key_cm('second', {'groups': []}))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait_for(second, timeout=5)
+
+    asyncio.run(run())
+    data = server.objects[('api/v1', 'configmaps')][(namespace, 'logs-alert')]['data']
+    assert set(data) == {'first.yaml', 'second.yaml'}
+
+
+def home(rules, key):
+    """ The shard a new key goes to when every shard has room """
+    return rules._ConfigMap__place(key, 0, {shard: 0 for shard in rules.shard_names()})
+
+
+def test_place_walks_to_the_next_shard_with_room(namespace):
+    rules = ConfigMap(namespace=namespace, name='logs-alert', shards=3, shard_limit=100)
+    place = rules._ConfigMap__place
+    names = rules.shard_names()
+    start = names.index(home(rules, 'a.yaml'))
+    following = [names[(start + offset) % len(names)] for offset in range(len(names))]
+
+    sizes = {shard: 0 for shard in names}
+    assert place('a.yaml', 10, sizes) == following[0]
+    # Stable: the same key always starts from the same shard
+    assert place('a.yaml', 10, sizes) == home(rules, 'a.yaml')
+
+    sizes[following[0]] = 95
+    assert place('a.yaml', 10, sizes) == following[1]
+    assert place('a.yaml', 5, sizes) == following[0]
+    assert place('a.yaml', 5, sizes, exclude=following[0]) == following[1]
+
+    sizes[following[1]] = 100
+    assert place('a.yaml', 10, sizes) == following[2]
+    sizes[following[2]] = 91
+    assert place('a.yaml', 10, sizes) is None
+
+
+def test_key_moves_when_its_shard_is_full(server, namespace):
+    rules = ConfigMap(namespace=namespace, name='logs-alert', shards=2, shard_limit=250, debounce=0.01)
+    first = home(rules, 'rule.yaml')
+    # A second key stored on the same shard, leaving no room for the first one to grow
+    filler = next(f'filler-{index}' for index in range(1000) if home(rules, f'filler-{index}.yaml') == first)
+
+    asyncio.run(rules.new_key_cm('rule', {'expr': 'x'}))
+    asyncio.run(rules.new_key_cm(filler, {'expr': 'y' * 150}))
+    asyncio.run(rules.new_key_cm('rule', {'expr': 'x' * 100}))
+
+    configmaps = server.objects[('api/v1', 'configmaps')]
+    second = next(shard for shard in rules.shard_names() if shard != first)
+    assert set(configmaps[(namespace, first)]['data']) == {f'{filler}.yaml'}
+    assert configmaps[(namespace, second)]['data'] == {'rule.yaml': 'expr: ' + 'x' * 100 + '\n'}
+    assert rules.index['rule.yaml'] == second
@@ -0,0 +1,61 @@
+""" The plain-dict renderer of the StatefulSet against the kubernetes.client model path """
+
+import pytest
+from kubernetes import client
+from utils.k8sControllers.lokiSf import LokiSf
+from utils.k8sControllers.lokiConfig import LokiConfig
+from utils.k8sControllers.lokiManifest import config_name
+
+VARIANTS = {
+    'default': {},
+    'cache': {'lk_cache': {'replicas': 2, 'memory': '1Gi'}},
+    'storage class': {'lk_storage_class': 'fast-ssd'},
+    'policy': {'lk_pod_management_policy': 'OrderedReady'},
+    'rules shards': {'lk_rules': ('logs-alert', 'logs-alert-1', 'logs-alert-2')}
+}
+
+# A StatefulSet of the operator versions before the data PVC: an emptyDir data volume, no claim template
+EMPTY_DIR = {'spec': {'template': {'spec': {'volumes': [{'name': 'data', 'emptyDir': {}}]}}}}
+
+
+def new_loki(**fields):
+    return LokiSf(**{
+        'lk_name': 'loki',
+        'lk_namespace': 'logs',
+        'lk_image': 'grafana/loki:2.4.2',
+        'lk_limits': {'cpu': '1', 'memory': '1Gi'},
+        'lk_requests': {'cpu': '500m', 'memory': '512Mi'},
+        'lk_labels': {'app': 'loki'},
+        'lk_replicas': 3,
+        'lk_storage': '10Gi',
+        'lk_uid': '00000000-0000-0000-0000-000000000001',
+        **fields
+    })
+
+
+def model(loki):
+    return client.ApiClient().sanitize_for_serialization(loki.stateful_set())
+
+
+@pytest.mark.parametrize('fields', VARIANTS.values(), ids=list(VARIANTS))
+def test_render_matches_the_model_objects(fields):
+    loki = new_loki(**fields)
+    assert loki.manifest() == model(loki)
+
+
+def test_render_matches_the_model_objects_on_an_empty_dir():
+    loki = new_loki()
+    live_claims = LokiSf._LokiSf__live_claims
+
+    assert live_claims(loki.manifest(), EMPTY_DIR) == live_claims(model(loki), EMPTY_DIR)
+    volumes = live_claims(loki.manifest(), EMPTY_DIR)['spec']['template']['spec']['volumes']
+    assert {'name': 'data', 'emptyDir': {}} in volumes
+
+
+def test_config_volume_mounts_the_config_map():
+    loki = new_loki()
+    config = LokiConfig(lc_name='loki', lc_namespace='logs', lc_limits={}, lc_requests={}, lc_uid=None)
+    volumes = loki.manifest()['spec']['template']['spec']['volumes']
+
+    assert config.name == config_name('loki')
+    assert {'name': 'config', 'configMap': {'name': config.name, 'defaultMode': 420}} in volumes
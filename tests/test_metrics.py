@@ -0,0 +1,28 @@
+""" The metrics of the kopf handlers """
+
+import asyncio
+import pytest
+from prometheus_client import REGISTRY
+from utils import metrics
+
+
+class Deferred(Exception):
+    expected = True
+
+
+def errors(handler):
+    return REGISTRY.get_sample_value('loki_operator_handler_errors_total', {'handler': handler}) or 0
+
+
+@pytest.mark.parametrize('exception, counted', [(RuntimeError('failed'), 1), (Deferred('not owned'), 0)])
+def test_handler_errors(exception, counted):
+    handler = f'test_{type(exception).__name__}'
+
+    @metrics.timed(handler)
+    async def fn():
+        raise exception
+
+    with pytest.raises(type(exception)):
+        asyncio.run(fn())
+    assert errors(handler) == counted
+    assert REGISTRY.get_sample_value('loki_operator_handler_duration_seconds_count', {'handler': handler}) == 1
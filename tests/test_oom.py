@@ -0,0 +1,71 @@
+""" The memory bumps after the OOMKilled Loki containers """
+
+import asyncio
+from utils.oomWatcher import OomWatcher
+from utils.resources import vpa
+
+
+def oom_killed(namespace, ordinal, memory, finished):
+    return {
+        'metadata': {
+            'name': f'loki-{ordinal}',
+            'namespace': namespace,
+            'ownerReferences': [{'kind': 'StatefulSet', 'name': 'loki'}]
+        },
+        'spec': {'containers': [{'name': 'loki', 'resources': {'limits': {'memory': memory}}}]},
+        'status': {'containerStatuses': [{
+            'name': 'loki',
+            'state': {'running': {}},
+            'lastState': {'terminated': {'reason': 'OOMKilled', 'finishedAt': finished}}
+        }]}
+    }
+
+
+class Informer:
+    def add_handler(self, handler):
+        pass
+
+
+def memory_limit(server, namespace):
+    loki = server.objects[('apis/jack.experts/v1', 'lokis')][(namespace, 'loki')]
+    return loki['spec']['resources']['limits']['memory']
+
+
+def test_ooms_of_the_old_limit_bump_once(server, namespace):
+    server.seed('apis/jack.experts/v1', 'lokis', {
+        'apiVersion': 'jack.experts/v1',
+        'kind': 'Loki',
+        'metadata': {'name': 'loki', 'namespace': namespace},
+        'spec': {'resources': {'limits': {'memory': '1Gi'}, 'requests': {'memory': '512Mi'}}}
+    })
+
+    asyncio.run(vpa('loki', namespace, memory='1Gi'))
+    assert memory_limit(server, namespace) == '1280Mi'
+
+    # Another replica, not restarted with the new limit yet, is OOMKilled seconds later
+    asyncio.run(vpa('loki', namespace, memory='1Gi'))
+    assert memory_limit(server, namespace) == '1280Mi'
+
+    # OOMKilled again with the bumped limit
+    asyncio.run(vpa('loki', namespace, memory='1280Mi'))
+    assert memory_limit(server, namespace) == '1600Mi'
+
+
+def test_watcher_reports_the_highest_limit_of_a_burst(namespace):
+    calls = list()
+
+    async def resize(name, namespace, memory):
+        calls.append((name, namespace, memory))
+
+    async def run():
+        watcher = OomWatcher(resize_fn=resize, debounce=0.05)
+        watcher.started = 0
+        watcher.attach(Informer(), asyncio.get_running_loop())
+        watcher.on_pod('MODIFIED', oom_killed(namespace, 0, '1Gi', '2026-01-01T00:00:00Z'))
+        watcher.on_pod('MODIFIED', oom_killed(namespace, 1, '1280Mi', '2026-01-01T00:00:01Z'))
+        # The same OOM seen again on the next event of the Pod
+        watcher.on_pod('MODIFIED', oom_killed(namespace, 1, '1280Mi', '2026-01-01T00:00:01Z'))
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert calls == [('loki', namespace, '1280Mi')]
@@ -0,0 +1,74 @@
+""" Parsing, serializing and scaling the Kubernetes quantities """
+
+from fractions import Fraction
+import pytest
+from utils import quantity
+
+
+@pytest.mark.parametrize('text, value', [
+    ('512Mi', 512 * 1024 ** 2),
+    ('1Gi', 1024 ** 3),
+    ('+2Ki', 2048),
+    ('1.5G', 1500 * 1000 ** 2),
+    ('100k', 100000),
+    ('500m', Fraction(1, 2)),
+    ('12345n', Fraction(12345, 10 ** 9)),
+    ('1e3', 1000),
+    ('0.1', Fraction(1, 10)),
+    ('-512Mi', -512 * 1024 ** 2),
+    ('-1.5G', -1500 * 1000 ** 2),
+    ('-500m', Fraction(-1, 2)),
+    ('-0', 0)
+])
+def test_parse(text, value):
+    assert quantity.parse(text) == value
+
+
+@pytest.mark.parametrize('text, canonical', [
+    ('512Mi', '512Mi'),
+    ('0.5Mi', '512Ki'),
+    ('1.5G', '1500M'),
+    ('1e3', '1k'),
+    ('0.1', '100m'),
+    ('12345n', '12345n'),
+    ('-512Mi', '-512Mi'),
+    ('-1.5G', '-1500M'),
+    ('-500m', '-500m'),
+    ('-0', '0')
+])
+def test_serialize_round_trip(text, canonical):
+    assert quantity.serialize(text) == canonical
+    assert quantity.parse(canonical) == quantity.parse(text)
+    assert quantity.serialize(quantity.parse(canonical)) == canonical
+
+
+def test_serialize_notation():
+    assert quantity.serialize(1024, binary=False) == '1024'
+    assert quantity.serialize('1000', binary=True) == '1k'
+    # Below 1n, rounded up to the next nano unit
+    assert quantity.serialize(Fraction(1, 3 * 10 ** 9)) == '1n'
+
+
+@pytest.mark.parametrize('value, factor, round_to, scaled', [
+    ('1Gi', 1.25, '1Mi', '1280Mi'),
+    ('1000Mi', 1.25, '1Mi', '1250Mi'),
+    ('1001Mi', 1.25, '1Mi', '1252Mi'),
+    ('1G', 1.1, None, '1100M'),
+    ('-100Mi', 1.5, '1Mi', '-150Mi'),
+    # Rounded up, towards zero for a negative quantity
+    ('-1001Mi', 1.25, '1Mi', '-1251Mi')
+])
+def test_scale(value, factor, round_to, scaled):
+    assert quantity.scale(value, factor, round_to=round_to) == scaled
+
+
+def test_resources_equal_ignores_the_notation():
+    assert quantity.resources_equal({'limits': {'memory': '1Gi', 'cpu': '1'}},
+                                    {'limits': {'memory': '1024Mi', 'cpu': '1000m'}})
+    assert not quantity.resources_equal({'limits': {'memory': '1Gi'}}, {'limits': {'memory': '1G'}})
+
+
+def test_invalid_quantity():
+    for text in ('12XB', 'Mi', ''):
+        with pytest.raises(quantity.QuantityError):
+            quantity.parse(text)
@@ -0,0 +1,59 @@
+""" The partition staging the Pod template changes step by step """
+
+import copy
+import pytest
+from utils.rollout import stage, partition, rollout_step
+
+
+def stateful_set(replicas, held=None):
+    strategy = {'type': 'RollingUpdate'}
+    if held is not None:
+        strategy['rollingUpdate'] = {'partition': held}
+    return {
+        'metadata': {'name': 'loki', 'namespace': 'logs'},
+        'spec': {'replicas': replicas, 'updateStrategy': strategy}
+    }
+
+
+def test_new_stateful_set_is_not_staged():
+    body = stateful_set(5)
+    assert stage(body, None, step=1) is body
+
+
+@pytest.mark.parametrize('step, held', [(1, 4), (2, 3), (4, 1)])
+def test_template_change_holds_all_but_the_first_step(step, held):
+    staged = stage(stateful_set(5), stateful_set(5), step=step)
+    assert partition(staged) == held
+    assert staged['spec']['updateStrategy']['type'] == 'RollingUpdate'
+
+
+def test_step_over_the_replicas_updates_every_pod():
+    body = stateful_set(3)
+    assert stage(body, stateful_set(3), step=3) is body
+    assert stage(body, stateful_set(3), step=10) is body
+
+
+def test_template_change_during_a_rollout_starts_over():
+    assert partition(stage(stateful_set(5), stateful_set(5, held=2), step=1)) == 4
+    # Releasing a held rollout needs the partition set back to 0
+    staged = stage(stateful_set(3), stateful_set(3, held=2), step=5)
+    assert staged['spec']['updateStrategy']['rollingUpdate'] == {'partition': 0}
+
+
+def test_other_changes_keep_the_rollout_in_progress():
+    assert partition(stage(stateful_set(5), stateful_set(5, held=3), step=1, template_changed=False)) == 3
+    body = stateful_set(5)
+    assert stage(body, stateful_set(5), step=1, template_changed=False) is body
+
+
+def test_body_is_not_mutated():
+    body = stateful_set(5)
+    expected = copy.deepcopy(body)
+    stage(body, stateful_set(5), step=1)
+    assert body == expected
+
+
+@pytest.mark.parametrize('spec, step', [({}, 1), ({'rollout': {}}, 1), ({'rollout': {'step': 3}}, 3),
+                                        ({'rollout': {'step': 0}}, 1)])
+def test_rollout_step(spec, step):
+    assert rollout_step(spec) == step
@@ -0,0 +1,43 @@
+""" The hash ring spreading the Lokis over the operator replicas """
+
+from utils.sharding import HashRing
+
+KEYS = [f'namespace-{index % 50}/loki-{index}' for index in range(5000)]
+
+
+def owners(ring):
+    return {key: ring.owner(key) for key in KEYS}
+
+
+def test_empty_ring():
+    assert HashRing([]).owner('loki/loki') is None
+
+
+def test_members_order_does_not_matter():
+    assert owners(HashRing(['a', 'b', 'c'])) == owners(HashRing(['c', 'a', 'b']))
+
+
+def test_adding_a_member_only_moves_keys_to_it():
+    before, after = owners(HashRing(['a', 'b', 'c'])), owners(HashRing(['a', 'b', 'c', 'd']))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == 'd' for key in moved)
+    # About a quarter of the keys, each replica giving a share of its own
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+    assert {before[key] for key in moved} == {'a', 'b', 'c'}
+
+
+def test_removing_a_member_only_moves_its_keys():
+    before, after = owners(HashRing(['a', 'b', 'c', 'd'])), owners(HashRing(['a', 'c', 'd']))
+
+    assert all(after[key] == before[key] for key in KEYS if before[key] != 'b')
+    assert 'b' not in after.values()
+    # Its keys are spread over the replicas left
+    assert {after[key] for key in KEYS if before[key] == 'b'} == {'a', 'c', 'd'}
+
+
+def test_keys_spread_evenly():
+    counts = dict()
+    for owner in owners(HashRing(['a', 'b', 'c', 'd'])).values():
+        counts[owner] = counts.get(owner, 0) + 1
+    assert min(counts.values()) > len(KEYS) / 4 * 0.6
@@ -0,0 +1,92 @@
+""" The StatefulSets created by the operator versions before the managed-by label """
+
+import copy
+import time
+import asyncio
+import pytest
+from utils.informer import get_informer
+from utils.reconciliation import Reconciliation
+from utils.resources import update, live_stateful_set
+from utils.k8sControllers.lokiSf import LokiSf, pod_management_policy
+
+RESOURCES = {'limits': {'cpu': '1', 'memory': '1Gi'}, 'requests': {'cpu': '500m', 'memory': '512Mi'}}
+
+
+def new_loki(cr, spec, policy):
+    return LokiSf(
+        lk_name=cr['metadata']['name'],
+        lk_namespace=cr['metadata']['namespace'],
+        lk_image=spec['image'],
+        lk_limits=spec['resources']['limits'],
+        lk_requests=spec['resources']['requests'],
+        lk_labels=cr['metadata']['labels'],
+        lk_storage=spec['storage'],
+        lk_uid=cr['metadata']['uid'],
+        lk_replicas=spec['replicas'],
+        lk_pod_management_policy=policy
+    )
+
+
+@pytest.fixture
+def baseline(server, namespace):
+    """ A Loki and the StatefulSet of the baseline operator: no managed-by label, emptyDir data, OrderedReady """
+    cr = server.seed('apis/jack.experts/v1', 'lokis', {
+        'apiVersion': 'jack.experts/v1',
+        'kind': 'Loki',
+        'metadata': {'name': 'loki', 'namespace': namespace, 'labels': {'app': 'loki'}},
+        'spec': {'image': 'grafana/loki:2.4.2', 'replicas': 3, 'storage': '10Gi', 'resources': RESOURCES}
+    })
+
+    sts = copy.deepcopy(new_loki(cr, cr['spec'], 'Parallel').manifest())
+    sts['metadata']['labels'] = {'app': 'loki'}
+    sts['metadata'].pop('annotations', None)
+    sts['spec']['template']['metadata']['labels'] = {'app': 'loki'}
+    sts['spec'].pop('volumeClaimTemplates')
+    sts['spec']['podManagementPolicy'] = 'OrderedReady'
+    sts['spec']['template']['spec']['volumes'].append({'name': 'data', 'emptyDir': {}})
+    server.seed('apis/apps/v1', 'statefulsets', sts)
+    return cr
+
+
+def live(server, cr):
+    return server.objects[('apis/apps/v1', 'statefulsets')][(cr['metadata']['namespace'], cr['metadata']['name'])]
+
+
+def test_baseline_statefulset_keeps_its_policy(server, baseline, informers):
+    namespace = baseline['metadata']['namespace']
+    assert get_informer('statefulsets').get(namespace, 'loki') is None
+
+    rec = Reconciliation('jack.experts', 'v1', 'lokis')
+    # Migrated from the emptyDir to the data PVC, not applied over as a missing StatefulSet
+    assert asyncio.run(rec.reconcile(f'{namespace}/loki')) is False
+    sts = live(server, baseline)
+    assert sts['spec']['podManagementPolicy'] == 'OrderedReady'
+    assert [claim['metadata']['name'] for claim in sts['spec']['volumeClaimTemplates']] == ['data']
+
+    # Labelled by the operator, so cached from now on
+    deadline = time.monotonic() + 5
+    while get_informer('statefulsets').get(namespace, 'loki') is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert asyncio.run(rec.reconcile(f'{namespace}/loki')) is True
+
+
+def test_baseline_statefulset_resources_change(server, baseline, informers):
+    namespace = baseline['metadata']['namespace']
+    spec = dict(baseline['spec'], resources={'limits': {'cpu': '2', 'memory': '2Gi'}, 'requests': RESOURCES['requests']})
+
+    async def resources_change():
+        current = await live_stateful_set('loki', namespace)
+        assert current is not None
+        await update(new_loki(baseline, spec, pod_management_policy(spec, current)), step=1)
+
+    asyncio.run(resources_change())
+    sts = live(server, baseline)
+    assert sts['spec']['podManagementPolicy'] == 'OrderedReady'
+    assert sts['spec']['template']['spec']['containers'][0]['resources']['limits'] == {'cpu': '2', 'memory': '2Gi'}
+
+
+def test_policy_defaults():
+    assert pod_management_policy({}) == 'Parallel'
+    assert pod_management_policy({}, {'spec': {}}) == 'OrderedReady'
+    assert pod_management_policy({'podManagementPolicy': 'Parallel'}, {'spec': {'podManagementPolicy': 'OrderedReady'}}) \
+        == 'Parallel'
@@ -0,0 +1,35 @@
+import os
+import threading
+from kubernetes import client, config
+from kubernetes.config.config_exception import ConfigException
+
+# Max number of Kubernetes API calls running at the same time
+API_CONCURRENCY = int(os.environ.get('LOKI_OPERATOR_API_CONCURRENCY', '16'))
+
+# Long-lived watch connections kept by the Informers, on top of the API calls
+WATCH_CONNECTIONS = 8
+
+_api_client = None
+_lock = threading.Lock()
+
+
+def api_client() -> client.ApiClient:
+    """ Return the process-wide ApiClient, loading the configuration on the first call.
+    The in-cluster configuration is tried first, then the local kubeconfig
+    """
+    global _api_client
+
+    if _api_client is None:
+        with _lock:
+            if _api_client is None:
+                configuration = client.Configuration()
+                try:
+                    config.load_incluster_config(client_configuration=configuration)
+                except ConfigException:
+                    config.load_kube_config(client_configuration=configuration)
+
+                # Keep one keep-alive connection per concurrent call, so no connection is discarded
+                configuration.connection_pool_maxsize = API_CONCURRENCY + WATCH_CONNECTIONS
+                _api_client = client.ApiClient(configuration)
+
+    return _api_client
@@ -0,0 +1,76 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .apiClient import API_CONCURRENCY, api_client as shared_api_client
+from .metrics import api_call
+from .informer import list_pages
+from . import retry
+
+_executor = None
+
+
+def executor() -> ThreadPoolExecutor:
+    """ Return the process-wide executor used to run the blocking Kubernetes calls """
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=API_CONCURRENCY,
+            thread_name_prefix='k8s-api'
+        )
+    return _executor
+
+
+async def run(fn, *args, **kwargs):
+    """ Run a blocking function on the API executor without blocking the event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), functools.partial(fn, *args, **kwargs))
+
+
+class AsyncApi:
+    def __init__(self, api_cls, api_client=None):
+        """ Async wrapper with the same surface of a kubernetes.client API class
+        :param api_cls: The API class: AppsV1Api, CoreV1Api, CustomObjectsApi...
+        :param api_client: The ApiClient to use, the process-wide one by default.
+                           The API object is only built on its first use
+        """
+
+        self.api_cls = api_cls
+        self.__api_client = api_client
+        self.__api = None
+
+    @property
+    def api_client(self):
+        if self.__api_client is None:
+            self.__api_client = shared_api_client()
+        return self.__api_client
+
+    @property
+    def api(self):
+        if self.__api is None:
+            self.__api = self.api_cls(self.api_client)
+        return self.__api
+
+    async def list_all(self, method, **kwargs):
+        """ Call a list method page by page (limit/continue), returning the items and the List resourceVersion
+        :param method: The list method name, e.g. list_cluster_custom_object
+        """
+        fn = functools.partial(api_call, method, getattr(self.api, method))
+        return await retry.call(lambda: run(list_pages, fn, **kwargs))
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+
+        method = getattr(self.api, item)
+
+        if not callable(method):
+            return method
+
+        # Every API method becomes a coroutine running on the bounded executor, counted by verb and resource,
+        # retried on the retryable errors
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await retry.call(lambda: run(api_call, item, method, *args, **kwargs))
+
+        return call
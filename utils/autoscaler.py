@@ -0,0 +1,290 @@
+import math
+import time
+import asyncio
+import logging
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client
+from . import quantity
+from .asyncApi import AsyncApi
+from .informer import get_informer
+from .metrics import SCALE_ACTIONS
+from .k8sControllers.lokiManifest import CONTAINER_PORT
+from .k8sControllers.lokiConfig import LokiConfig, config_profile, shared_state
+from .k8sControllers.lokiCache import cache_host
+
+# Signals read on the /metrics of each Loki Pod, the counter is turned into a rate
+INGESTION_METRIC = 'loki_distributor_bytes_received_total'
+MEMORY_METRIC = 'go_memstats_heap_inuse_bytes'
+QUEUE_METRICS = ('cortex_query_frontend_queue_length', 'cortex_query_scheduler_queue_length')
+
+_WANTED = frozenset((INGESTION_METRIC, MEMORY_METRIC) + QUEUE_METRICS)
+
+# Defaults of spec.autoscaling, the memory target being a share of the memory limit
+DEFAULTS = {
+    'minReplicas': 1,
+    'maxReplicas': 10,
+    'targetIngestionRate': '2Mi',  # Bytes per second and replica
+    'targetQueueLength': 10,  # Queued queries per replica
+    'scaleUpStabilizationSeconds': 60,
+    'scaleDownStabilizationSeconds': 300
+}
+_MEMORY_TARGET = 0.7
+
+
+def parse_metrics(text, wanted=_WANTED) -> dict:
+    """ Sum the samples of the wanted metrics of a Prometheus text exposition, whatever their labels """
+    values = dict()
+    for line in text.splitlines():
+        if not line or line[0] == '#':
+            continue
+        name = line.split('{', 1)[0].split(' ', 1)[0]
+        if name not in wanted:
+            continue
+        try:
+            # The value follows the labels, a timestamp may follow the value
+            value = float(line.rsplit('}', 1)[-1].split()[0] if '{' in line else line.split()[1])
+        except (IndexError, ValueError):
+            continue
+        values[name] = values.get(name, 0.0) + value
+    return values
+
+
+def scaling_policy(spec):
+    """ Return the autoscaling policy of a Loki CR, None without spec.autoscaling """
+    autoscaling = spec.get('autoscaling')
+    if autoscaling is None:
+        return None
+
+    policy = {**DEFAULTS, **autoscaling}
+    policy['targetIngestionRate'] = float(quantity.parse(policy['targetIngestionRate']))
+    if policy.get('targetMemory') is not None:
+        policy['targetMemory'] = float(quantity.parse(policy['targetMemory']))
+    else:
+        limit = ((spec.get('resources') or {}).get('limits') or {}).get('memory')
+        policy['targetMemory'] = float(quantity.parse(limit)) * _MEMORY_TARGET if limit else None
+    return policy
+
+
+class Autoscaler:
+    def __init__(self, port=CONTAINER_PORT, half_life=60.0, tolerance=0.1, timeout=2.0, workers=8, owns=None):
+        """ Scale the Lokis on their ingestion rate, ingester memory in use and query queue length, read on
+        the /metrics of their Pods
+        :param port: The port of the Loki /metrics
+        :param half_life: Seconds for the weight of a past signal value to halve, smoothing the spikes
+        :param tolerance: Min relative change of the replicas to act, as the HorizontalPodAutoscaler
+        :param timeout: Seconds to scrape a Pod
+        :param workers: Pods scraped at the same time
+        :param owns: Function called as owns(name=, namespace=), only the Lokis it accepts are scaled
+        """
+
+        self.port = port
+        self.half_life = half_life
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.owns = owns
+
+        self.api = AsyncApi(client.CustomObjectsApi)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scrape')
+
+        self.signals = dict()  # Smoothed (ingestion rate, memory, queue length) and time, per Loki
+        self.counters = dict()  # Last ingestion counter and time, per Pod
+        self.recommendations = dict()  # (time, replicas) within the stabilization windows, per Loki
+        self.refused = set()  # Lokis with a spec.autoscaling whose config cannot be scaled, already reported
+
+    def __get(self, url):
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return response.read().decode()
+
+    async def scrape(self, pod):
+        """ Return the wanted metrics of a Pod, None when it does not answer """
+        url = f"http://{pod['status']['podIP']}:{self.port}/metrics"
+        try:
+            text = await asyncio.get_running_loop().run_in_executor(self.executor, self.__get, url)
+        except (urllib.error.URLError, OSError) as e:
+            logging.debug(f"Scrape of {url} failed: {e}")
+            return None
+        return parse_metrics(text)
+
+    def observe(self, loki, samples, now=None) -> bool:
+        """ Smooth the signals of a Loki from the metrics of its Pods
+        :param loki: The Loki key as namespace/name
+        :param samples: The metrics of each Pod, by Pod name
+        :return: False until an ingestion rate is known, two scrapes being needed
+        """
+        now = time.time() if now is None else now
+        rate, rated, memory, queue = 0.0, False, 0.0, 0.0
+
+        for pod, values in samples.items():
+            memory += values.get(MEMORY_METRIC, 0.0)
+            queue += sum(values.get(name, 0.0) for name in QUEUE_METRICS)
+
+            counter = values.get(INGESTION_METRIC)
+            last = self.counters.get((loki, pod))
+            self.counters[(loki, pod)] = (counter, now)
+            # A lower counter is a restart, the Pod counts again from the next scrape
+            if counter is not None and last is not None and last[0] is not None and counter >= last[0] \
+                    and now > last[1]:
+                rate += (counter - last[0]) / (now - last[1])
+                rated = True
+
+        previous = self.signals.get(loki)
+        if previous is None:
+            if not rated:
+                # Keep the counters, the rate is known on the next scrape
+                return False
+            self.signals[loki] = ((rate, memory, queue), now)
+            return True
+
+        smoothed, then = previous
+        alpha = 1 - 0.5 ** ((now - then) / self.half_life)
+        raw = (rate if rated else smoothed[0], memory, queue)
+        self.signals[loki] = (tuple(old + alpha * (new - old) for old, new in zip(smoothed, raw)), now)
+        return True
+
+    def desired(self, loki, policy, current, now=None) -> int:
+        """ Return the replicas of a Loki from its smoothed signals, within the policy bounds and after the
+        stabilization windows: a scale-up follows the lowest recommendation of its window, a scale-down the
+        highest one of its window
+        :param loki: The Loki key as namespace/name
+        :param policy: The policy returned by scaling_policy
+        :param current: The current spec.replicas
+        """
+        now = time.time() if now is None else now
+        (rate, memory, queue), _ = self.signals[loki]
+
+        wanted = [math.ceil(rate / policy['targetIngestionRate'])]
+        if policy['targetMemory']:
+            wanted.append(math.ceil(memory / policy['targetMemory']))
+        if policy['targetQueueLength']:
+            wanted.append(math.ceil(queue / policy['targetQueueLength']))
+
+        lowest, highest = policy['minReplicas'], policy['maxReplicas']
+        recommendation = min(highest, max(lowest, max(wanted)))
+        # Ignore the small changes, unless the current replicas are out of the bounds
+        if current and lowest <= current <= highest and abs(recommendation / current - 1) <= self.tolerance:
+            recommendation = current
+
+        window = max(policy['scaleUpStabilizationSeconds'], policy['scaleDownStabilizationSeconds'])
+        history = self.recommendations.setdefault(loki, deque())
+        history.append((now, recommendation))
+        while history[0][0] < now - window:
+            history.popleft()
+
+        def within(seconds):
+            return [replicas for then, replicas in history if then >= now - seconds]
+
+        if recommendation > current:
+            replicas = max(current, min(within(policy['scaleUpStabilizationSeconds'])))
+        elif recommendation < current:
+            replicas = min(current, max(within(policy['scaleDownStabilizationSeconds'])))
+        else:
+            replicas = current
+        return min(highest, max(lowest, replicas))
+
+    def forget(self, seen):
+        """ Drop the state of the Lokis and Pods not in seen, e.g. deleted or moved to another replica """
+        for loki in [loki for loki in self.signals if loki not in seen]:
+            self.signals.pop(loki)
+            self.recommendations.pop(loki, None)
+        for key in [key for key in self.counters if key[0] not in seen]:
+            self.counters.pop(key)
+
+    def __scalable(self, key, loki) -> bool:
+        """ True when the replicas of the Loki share their ring and storage. Without spec.config.ring and
+        spec.config.storage, the generated config keeps both in each Pod (inmemory ring, filesystem storage): more
+        replicas would split the streams and the data """
+        name, namespace, spec = loki['metadata']['name'], loki['metadata']['namespace'], loki['spec']
+        try:
+            config = LokiConfig(
+                lc_name=name,
+                lc_namespace=namespace,
+                lc_limits=spec['resources']['limits'],
+                lc_requests=spec['resources']['requests'],
+                lc_uid=loki['metadata'].get('uid'),
+                lc_profile=config_profile(spec),
+                lc_cache_host=cache_host(name, namespace, spec.get('cache')),
+                lc_shared_state=shared_state(spec)
+            )
+            ok = config.scalable()
+        except (KeyError, ValueError):
+            ok = False
+
+        if ok:
+            self.refused.discard(key)
+        elif key not in self.refused:
+            self.refused.add(key)
+            logging.warning(f"\n\n\tNot scaling {key}: its config keeps the ring and the data in each Pod, "
+                            "spec.autoscaling needs a shared ring and an object store\n\n")
+        return ok
+
+    async def run_once(self):
+        """ Scrape the Pods of the autoscaled Lokis and apply the new replicas on their spec """
+        lokis, pods = get_informer('lokis'), get_informer('pods')
+        if lokis is None or pods is None:
+            return
+
+        by_loki = dict()
+        for pod in pods.list():
+            status = pod.get('status') or {}
+            if status.get('phase') != 'Running' or not status.get('podIP'):
+                continue
+            for owner in pod['metadata'].get('ownerReferences') or []:
+                if owner['kind'] == 'StatefulSet':
+                    by_loki.setdefault(f"{pod['metadata']['namespace']}/{owner['name']}", list()).append(pod)
+
+        scaled, autoscaled = list(), set()
+        for loki in lokis.list():
+            name, namespace = loki['metadata']['name'], loki['metadata']['namespace']
+            policy = scaling_policy(loki['spec'])
+            if policy is None or (self.owns is not None and not self.owns(name=name, namespace=namespace)):
+                continue
+            autoscaled.add(f'{namespace}/{name}')
+            if not self.__scalable(f'{namespace}/{name}', loki):
+                continue
+            scaled.append((f'{namespace}/{name}', loki, policy, by_loki.get(f'{namespace}/{name}', [])))
+
+        # Every Pod of every Loki at once, bounded by the scrape workers
+        scraped = await asyncio.gather(*[self.scrape(pod) for _, _, _, loki_pods in scaled for pod in loki_pods])
+        now = time.time()
+        index = 0
+        for key, loki, policy, loki_pods in scaled:
+            samples = {
+                pod['metadata']['name']: values
+                for pod, values in zip(loki_pods, scraped[index:index + len(loki_pods)]) if values is not None
+            }
+            index += len(loki_pods)
+            if not samples or not self.observe(key, samples, now):
+                continue
+
+            current = loki['spec']['replicas']
+            replicas = self.desired(key, policy, current, now)
+            if replicas == current:
+                continue
+
+            # The Loki spec is the desired state: replicas_change applies it on the StatefulSet
+            await self.api.patch_namespaced_custom_object(
+                group='jack.experts',
+                version='v1',
+                namespace=loki['metadata']['namespace'],
+                plural='lokis',
+                name=loki['metadata']['name'],
+                body={'spec': {'replicas': replicas}}
+            )
+            SCALE_ACTIONS.labels(direction='up' if replicas > current else 'down').inc()
+            logging.info(f"\n\n\tScaled {key} from {current} to {replicas} replicas\n\n")
+
+        self.forget({key for key, _, _, _ in scaled})
+        self.refused &= autoscaled
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"\n\n\tAutoscaler failed: {e}\n\n")
+            await asyncio.sleep(interval)
@@ -0,0 +1,84 @@
+import os
+import gzip
+import json
+import logging
+import threading
+
+
+class Checkpoint:
+    def __init__(self, path, interval=30.0):
+        """ Local store of the state worth keeping across restarts, written atomically as gzipped JSON
+        :param path: The checkpoint file, on a volume kept across the operator rollouts
+        :param interval: Seconds between two writes, a write only happens when something changed
+        """
+
+        self.path = path
+        self.interval = interval
+
+        self.sections = dict()  # Plain dicts mutated in place by their owners
+        self.providers = dict()  # Objects with a revision and a snapshot(), e.g. the Informers
+        self.loaded = self.__load()
+
+        self.__saved_sections = dict()
+        self.__saved_revisions = dict()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __load(self) -> dict:
+        try:
+            with gzip.open(self.path, 'rt') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as e:
+            logging.error(f"\n\n\tCheckpoint {self.path} ignored: {e}\n\n")
+            return dict()
+
+    def section(self, name) -> dict:
+        """ Return a dict checkpointed as is, holding the values of the last run """
+        if name not in self.sections:
+            self.sections[name] = dict(self.loaded.get(name) or {})
+        return self.sections[name]
+
+    def restore(self, name):
+        """ Return the snapshot of a provider from the last run, None if there is none """
+        return self.loaded.get(name)
+
+    def provide(self, name, provider):
+        """ Checkpoint provider.snapshot() each time provider.revision changes """
+        self.providers[name] = provider
+
+    def save(self, force=False):
+        # dict() copies atomically, the owners keep mutating the sections from their threads
+        sections = {name: dict(section) for name, section in self.sections.items()}
+        revisions = {name: provider.revision for name, provider in self.providers.items()}
+        if not force and sections == self.__saved_sections and revisions == self.__saved_revisions:
+            return False
+
+        data = dict(sections)
+        data.update({name: provider.snapshot() for name, provider in self.providers.items()})
+
+        temporary = f'{self.path}.tmp'
+        with gzip.open(temporary, 'wt', compresslevel=1) as file:
+            json.dump(data, file, separators=(',', ':'))
+        os.replace(temporary, self.path)
+
+        self.__saved_sections, self.__saved_revisions = sections, revisions
+        return True
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='checkpoint', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        """ Stop the periodic writes and write the last state """
+        self.__stop.set()
+        self.save()
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                logging.error(f"\n\n\tCheckpoint {self.path} not written: {e}\n\n")
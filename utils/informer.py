@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import logging
+import threading
+from kubernetes import client, watch
+from kubernetes.client.exceptions import ApiException
+from .apiClient import api_client
+
+# Label used to select the objects created by the operator
+MANAGED_BY_LABEL = 'app.kubernetes.io/managed-by'
+MANAGED_BY_VALUE = 'loki-operator'
+MANAGED_BY_SELECTOR = f'{MANAGED_BY_LABEL}={MANAGED_BY_VALUE}'
+
+# Objects per page of a List
+LIST_PAGE_SIZE = int(os.environ.get('LOKI_OPERATOR_LIST_PAGE_SIZE', '500'))
+
+_informers = dict()
+
+
+def list_pages(list_fn, limit=LIST_PAGE_SIZE, **kwargs):
+    """ List page by page with limit/continue, returning the items and the resourceVersion of the List
+    :param list_fn: The list function of the kubernetes client
+    :param limit: Objects per page
+    :param kwargs: Extra arguments to the list function
+    """
+    items, token, resource_version = list(), None, None
+
+    while True:
+        try:
+            response = list_fn(_preload_content=False, limit=limit, _continue=token, **kwargs)
+        except ApiException as e:
+            # The continue token expired while paging: fall back to a single List
+            if e.status != 410 or token is None:
+                raise
+            data = json.loads(list_fn(_preload_content=False, **kwargs).data)
+            return data['items'], data['metadata']['resourceVersion']
+
+        data = json.loads(response.data)
+        items += data['items']
+        # Every page is read from the snapshot of the first one
+        if resource_version is None:
+            resource_version = data['metadata']['resourceVersion']
+
+        token = data['metadata'].get('continue')
+        if not token:
+            return items, resource_version
+
+
+class Informer:
+    def __init__(self, kind, list_fn, resync_period=300.0, predicate=None, checkpoint=None, **list_kwargs):
+        """ In-process List+Watch cache of a Kubernetes resource
+        :param kind: The name used to register the Informer (e.g. lokis, pods)
+        :param list_fn: The list function of the kubernetes client (e.g. CoreV1Api.list_pod_for_all_namespaces)
+        :param resync_period: Seconds between two full relists
+        :param predicate: Function called as predicate(obj), only the objects it accepts are cached
+        :param checkpoint: The Checkpoint keeping the cache and its resourceVersion across restarts
+        :param list_kwargs: Extra arguments to the list function (label_selector, field_selector, namespace...)
+        """
+
+        self.kind = kind
+        self.list_fn = list_fn
+        self.list_kwargs = list_kwargs
+        self.resync_period = resync_period
+        self.predicate = predicate
+        self.checkpoint = checkpoint
+        self.resource_version = None
+        self.revision = 0  # Number of changes on the store
+
+        self.store = dict()
+        self.handlers = list()
+        self.synced = threading.Event()
+
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__last_list = 0.0
+
+    @staticmethod
+    def key(obj) -> str:
+        """ Return the namespace/name key of an object """
+        meta = obj['metadata']
+        return f"{meta.get('namespace', '')}/{meta['name']}"
+
+    def add_handler(self, handler):
+        """ Register a function called as handler(event_type, obj) for each change on the cache """
+        self.handlers.append(handler)
+
+    def get(self, namespace, name):
+        """ Return the cached object. The object is shared, callers must not mutate it """
+        with self.__lock:
+            return self.store.get(f'{namespace}/{name}')
+
+    def list(self) -> list:
+        """ Return all the cached objects """
+        with self.__lock:
+            return list(self.store.values())
+
+    def snapshot(self) -> dict:
+        """ Return the cached objects and the resourceVersion to watch from, to checkpoint them """
+        with self.__lock:
+            return {'resourceVersion': self.resource_version, 'items': list(self.store.values())}
+
+    # Fill the store from the checkpoint, the watch resuming from its resourceVersion instead of a List
+    def __restore(self):
+        snapshot = self.checkpoint.restore(f'informer/{self.kind}')
+        if not snapshot or not snapshot.get('resourceVersion'):
+            return
+
+        with self.__lock:
+            self.store = {self.key(item): item for item in snapshot['items'] if self.__wanted(item)}
+            self.revision += 1
+
+        self.resource_version = snapshot['resourceVersion']
+        self.__last_list = time.monotonic()
+        self.synced.set()
+        logging.info(f"\n\n\tInformer {self.kind} resumed {len(self.store)} objects from the checkpoint\n\n")
+
+        for item in self.list():
+            self.__notify('ADDED', item)
+
+    def start(self):
+        if self.checkpoint is not None:
+            self.__restore()
+            self.checkpoint.provide(f'informer/{self.kind}', self)
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name=f'informer-{self.kind}', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __notify(self, event_type, obj):
+        for handler in self.handlers:
+            try:
+                handler(event_type, obj)
+            except Exception as e:
+                logging.error(f"\n\n\tInformer {self.kind} handler failed: {e}\n\n")
+
+    def __wanted(self, obj) -> bool:
+        return self.predicate is None or self.predicate(obj)
+
+    # Replace the whole store with a fresh List and notify the differences
+    def __list(self):
+        items, resource_version = list_pages(self.list_fn, **self.list_kwargs)
+
+        new_store = {self.key(item): item for item in items if self.__wanted(item)}
+
+        with self.__lock:
+            old_store = self.store
+            self.store = new_store
+            self.revision += 1
+
+        self.resource_version = resource_version
+        self.__last_list = time.monotonic()
+        self.synced.set()
+
+        for key, item in new_store.items():
+            self.__notify('ADDED' if key not in old_store else 'MODIFIED', item)
+        for key, item in old_store.items():
+            if key not in new_store:
+                self.__notify('DELETED', item)
+
+    # Watch from the last known resourceVersion until the next resync
+    def __watch(self):
+        timeout = max(1, int(self.resync_period - (time.monotonic() - self.__last_list)))
+        stream = watch.Watch().stream(
+            self.list_fn,
+            resource_version=self.resource_version,
+            timeout_seconds=timeout,
+            allow_watch_bookmarks=True,
+            **self.list_kwargs
+        )
+
+        for event in stream:
+            if self.__stop.is_set():
+                return
+
+            event_type = event['type']
+            obj = event['raw_object']
+
+            if event_type == 'ERROR':
+                # 410 Gone: the resourceVersion is too old, a relist is needed
+                if obj.get('code') == 410:
+                    self.resource_version = None
+                    return
+                raise ApiException(status=obj.get('code'), reason=obj.get('message'))
+
+            self.resource_version = obj['metadata']['resourceVersion']
+            if event_type == 'BOOKMARK':
+                continue
+
+            with self.__lock:
+                if event_type == 'DELETED':
+                    self.store.pop(self.key(obj), None)
+                elif not self.__wanted(obj):
+                    # An object leaving the predicate is seen as deleted, one never cached is ignored
+                    if self.store.pop(self.key(obj), None) is None:
+                        continue
+                    event_type = 'DELETED'
+                else:
+                    self.store[self.key(obj)] = obj
+                self.revision += 1
+
+            self.__notify(event_type, obj)
+
+    def refresh(self):
+        """ List again from the calling thread, once the predicate accepts other objects.
+        The objects no longer accepted are dropped, the cached copies newer than the List are kept
+        """
+        items, _ = list_pages(self.list_fn, **self.list_kwargs)
+        listed = {self.key(item): item for item in items if self.__wanted(item)}
+        added, dropped = list(), list()
+
+        with self.__lock:
+            for key, item in listed.items():
+                cached = self.store.get(key)
+                if cached is None:
+                    self.store[key] = item
+                    added.append(item)
+                elif int(cached['metadata']['resourceVersion']) < int(item['metadata']['resourceVersion']):
+                    self.store[key] = item
+
+            for key, item in list(self.store.items()):
+                if not self.__wanted(item):
+                    self.store.pop(key)
+                    dropped.append(item)
+            self.revision += 1
+
+        for item in added:
+            self.__notify('ADDED', item)
+        for item in dropped:
+            self.__notify('DELETED', item)
+
+    def __run(self):
+        backoff = 1
+        while not self.__stop.is_set():
+            try:
+                resync = time.monotonic() - self.__last_list >= self.resync_period
+                if self.resource_version is None or resync:
+                    self.__list()
+                self.__watch()
+                backoff = 1
+            except ApiException as e:
+                if e.status == 410:
+                    self.resource_version = None
+                    continue
+                logging.error(f"\n\n\tInformer {self.kind} failed: {e}\n\n")
+                self.__stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            except Exception as e:
+                logging.error(f"\n\n\tInformer {self.kind} failed: {e}\n\n")
+                self.__stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+
+def register(informer: Informer) -> Informer:
+    _informers[informer.kind] = informer
+    return informer
+
+
+def get_informer(kind):
+    """ Return the Informer registered for the kind only when it is already synced """
+    informer = _informers.get(kind)
+    if informer is not None and informer.synced.is_set():
+        return informer
+    return None
+
+
+async def read(kind, namespace, name, fallback, miss=False):
+    """ Read an object from the cache, calling the API only when the cache is not available
+    :param kind: The registered Informer kind
+    :param namespace: The object namespace
+    :param name: The object name
+    :param fallback: Coroutine function returning the object as a dict
+    :param miss: Also call the API when the object is not cached. The Informers only select the objects with the
+                 managed-by label, not the ones created by the operator versions before it
+    """
+    informer = get_informer(kind)
+    if informer is not None:
+        cached = informer.get(namespace, name)
+        if cached is not None or not miss:
+            return cached
+    return await fallback()
+
+
+def _owner_name(obj):
+    """ Return the name of the Loki owning a StatefulSet, one of its Pods or its cache Deployment """
+    for owner in obj['metadata'].get('ownerReferences') or []:
+        if owner['kind'] in ('Loki', 'StatefulSet'):
+            return owner['name']
+    return obj['metadata']['name']
+
+
+def start_informers(cm_namespace, resync_period=300.0, shard=None, checkpoint=None):
+    """ Start the Informers used by the operator
+    :param cm_namespace: The namespace of the rules ConfigMap shards
+    :param resync_period: Seconds between two full relists
+    :param shard: Function called as shard(namespace, name), only the Lokis it accepts and their
+                  StatefulSets and Pods are cached. Every Loki is cached by default
+    :param checkpoint: The Checkpoint the Informers resume from after a restart
+    """
+    custom_api = client.CustomObjectsApi(api_client())
+    apps_api = client.AppsV1Api(api_client())
+    core_api = client.CoreV1Api(api_client())
+
+    def loki_predicate(obj):
+        return shard(obj['metadata']['namespace'], obj['metadata']['name'])
+
+    def owned_predicate(obj):
+        return shard(obj['metadata']['namespace'], _owner_name(obj))
+
+    loki_filter = loki_predicate if shard is not None else None
+    owned_filter = owned_predicate if shard is not None else None
+
+    informers = [
+        Informer('lokis', custom_api.list_cluster_custom_object, resync_period, loki_filter, checkpoint,
+                 group='jack.experts', version='v1', plural='lokis'),
+        Informer('statefulsets', apps_api.list_stateful_set_for_all_namespaces, resync_period, owned_filter,
+                 checkpoint, label_selector=MANAGED_BY_SELECTOR),
+        Informer('pods', core_api.list_pod_for_all_namespaces, resync_period, owned_filter, checkpoint,
+                 label_selector=MANAGED_BY_SELECTOR),
+        Informer('deployments', apps_api.list_deployment_for_all_namespaces, resync_period, owned_filter,
+                 checkpoint, label_selector=MANAGED_BY_SELECTOR),
+        Informer('configmaps', core_api.list_namespaced_config_map, resync_period, None, checkpoint,
+                 namespace=cm_namespace)
+    ]
+
+    for informer in informers:
+        register(informer).start()
+
+    return {informer.kind: informer for informer in informers}
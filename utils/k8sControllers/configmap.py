@@ -1,74 +1,295 @@
+import json
+import zlib
+import asyncio
 import logging
 import yaml
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.exceptions import ApiException
+from ..asyncApi import AsyncApi
+from ..informer import get_informer
+from ..metrics import CONFIGMAP_PATCH_BYTES
+from ..patch import patch_size
+from ..retry import retryable
+
+# Max bytes of rules per shard, under the 1 MiB limit of a Kubernetes object to leave room to metadata
+RULES_SHARD_LIMIT = 900 * 1024
 
 
 class ConfigMap:
-    def __init__(self, namespace, name):
+    def __init__(self, namespace, name, shards=1, shard_limit=RULES_SHARD_LIMIT, debounce=0.2, api_client=None):
+        """ Manage the ConfigMaps holding the LogAlert rules
+        :param namespace: The ConfigMaps namespace
+        :param name: The name of the first shard, the next ones are named <name>-<index>
+        :param shards: Number of ConfigMaps the rules are spread over
+        :param shard_limit: Max bytes of rules stored on each shard
+        :param debounce: Seconds to gather key changes before sending them as one patch per shard
+        :param api_client: The kubernetes ApiClient, the process-wide one by default
+        """
+
         self.name = name
         self.namespace = namespace
-        self.api = client.CoreV1Api()
-        config.load_incluster_config()
-        # config.load_kube_config('/lixo/kubernetes/jac/kubeconfig-production.yaml')
+        self.shards = shards
+        self.shard_limit = shard_limit
+        self.debounce = debounce
+        self.api = AsyncApi(client.CoreV1Api, api_client)
 
-    # Method to verify if ConfigMap exists
-    def __verify(self) -> bool:
-        try:
-            self.api.read_namespaced_config_map(name=self.name, namespace=self.namespace)
-            return True
-        except ApiException as e:
-            logging.error(f'{e}')
-            return False
+        self.index = dict()  # Shard holding each key
+
+        self.__stored = dict()  # Version and data returned by the last patch, per shard
+        self.__pending = dict()  # Rendered value per key, None to delete the key
+        self.__waiters = list()
+        self.__flush_task = None
+        self.__flush_lock = None
+
+        self.__ensured = False  # Every shard is known to exist
+        self.__ensuring = None  # Ensure call shared by the concurrent callers
+
+    # Method to return the name of every shard, the first one keeps the original ConfigMap name
+    def shard_names(self) -> tuple:
+        return tuple([self.name] + [f'{self.name}-{index}' for index in range(1, self.shards)])
+
+    def attach(self, informer):
+        """ Listen to the ConfigMap events of the Informer, to create the shards again once deleted """
+        informer.add_handler(self.on_configmap)
+
+    # Called by the Informer thread
+    def on_configmap(self, event_type, configmap):
+        name = configmap['metadata']['name']
+        if event_type == 'DELETED' and name in self.shard_names():
+            self.__stored.pop(name, None)
+            self.__ensured = False
+
+    # Method to add a new key on ConfigMap, or to update an existing one
+    async def new_key_cm(self, key_name, data):
+        return await self.__stage(f'{key_name}.yaml', yaml.dump(data))
+
+    # Method to remove a key from ConfigMap
+    async def delete_key_cm(self, key_name):
+        return await self.__stage(f'{key_name}.yaml', None)
+
+    # Queue a key change and wait for the patches sending it
+    async def __stage(self, key, value):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+
+        self.__pending[key] = value
+        self.__waiters.append(waiter)
 
-    # Method to add a new key on ConfigMap
-    def new_key_cm(self, key_name, data):
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.ensure_future(self.__flush_later())
 
-        new_data = client.V1ConfigMap(
-            data={f'{key_name}.yaml': yaml.dump(data)}
+        return await waiter
+
+    # Return the data stored on each shard, reading from the API only the shards never seen
+    async def __shards_data(self) -> dict:
+        informer = get_informer('configmaps')
+        data = dict()
+
+        for shard in self.shard_names():
+            cached = informer.get(self.namespace, shard) if informer is not None else None
+            known = self.__stored.get(shard)
+
+            # The cache may not have seen our last patch yet, keep the newest copy
+            if cached is not None and (known is None or
+                                       int(cached['metadata']['resourceVersion']) >= int(known[0])):
+                data[shard] = cached.get('data') or {}
+            elif known is not None:
+                data[shard] = known[1]
+            elif informer is not None:
+                data[shard] = {}
+            else:
+                try:
+                    response = await self.api.read_namespaced_config_map(
+                        name=shard,
+                        namespace=self.namespace,
+                        _preload_content=False
+                    )
+                    self.__keep(json.loads(response.data))
+                    data[shard] = self.__stored[shard][1]
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+                    data[shard] = {}
+
+        return data
+
+    def __keep(self, configmap):
+        self.__stored[configmap['metadata']['name']] = (
+            configmap['metadata']['resourceVersion'],
+            configmap.get('data') or {}
         )
+
+    @staticmethod
+    def __size(key, value) -> int:
+        return len(key.encode()) + len(value.encode())
+
+    # Pick the shard of a new key: the stable hash of the key, or the next shard with room
+    def __place(self, key, size, sizes, exclude=None):
+        names = self.shard_names()
+        start = zlib.crc32(key.encode()) % len(names)
+
+        for offset in range(len(names)):
+            shard = names[(start + offset) % len(names)]
+            if shard != exclude and sizes[shard] + size <= self.shard_limit:
+                return shard
+        return None
+
+    async def __flush_later(self):
+        await asyncio.sleep(self.debounce)
+
+        pending, waiters = self.__pending, self.__waiters
+        self.__pending, self.__waiters = dict(), list()
+        self.__flush_task = None
+
+        if self.__flush_lock is None:
+            self.__flush_lock = asyncio.Lock()
+
+        # Serialize the patches, so an older one never lands after a newer one
+        async with self.__flush_lock:
+            try:
+                result = await self.__flush(pending)
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                return
+
+        # The waiter of a cancelled handler is already done
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+
+    # Send the pending changes as a single merge patch per touched shard
+    async def __flush(self, pending):
+        # The shards added by a bigger LOKI_OPERATOR_RULES_SHARDS, or deleted, are only created on a Loki create.
+        # A no-op once every shard is known to exist
+        await self.create_cm()
+        data = await self.__shards_data()
+
+        self.index = {key: shard for shard, shard_data in data.items() for key in shard_data}
+        sizes = {
+            shard: sum(self.__size(key, value) for key, value in shard_data.items())
+            for shard, shard_data in data.items()
+        }
+        patches = {shard: dict() for shard in data}
+
+        for key, value in pending.items():
+            current = self.index.get(key)
+            old_size = self.__size(key, data[current][key]) if current is not None else 0
+
+            if value is None:
+                if current is not None:
+                    patches[current][key] = None  # A None value removes the key
+                    sizes[current] -= old_size
+                    self.index.pop(key)
+                continue
+
+            # Skip the keys whose rendered YAML is already stored
+            if current is not None and data[current][key] == value:
+                continue
+
+            size = self.__size(key, value)
+            if current is not None and sizes[current] - old_size + size <= self.shard_limit:
+                patches[current][key] = value
+                sizes[current] += size - old_size
+                continue
+
+            # New key, or its shard is full: move it to a shard with room
+            target = self.__place(key, size, sizes, exclude=current)
+            if target is None:
+                logging.error(f"\n\n\tNo rules shard has room to the key {key}\n\n")
+                continue
+
+            if current is not None:
+                patches[current][key] = None
+                sizes[current] -= old_size
+            patches[target][key] = value
+            sizes[target] += size
+            self.index[key] = target
+
+        patches = {shard: patch for shard, patch in patches.items() if patch}
+        if not patches:
+            return None
+
+        return await asyncio.gather(*[self.__patch(shard, patch) for shard, patch in patches.items()])
+
+    async def __patch(self, shard, patch):
+        body = {'data': patch}
+        CONFIGMAP_PATCH_BYTES.observe(patch_size(body))
         try:
-            __new_key = self.api.patch_namespaced_config_map(
-                name=self.name,
+            response = await self.api.patch_namespaced_config_map(
+                name=shard,
                 namespace=self.namespace,
-                body=new_data
+                body=body,
+                _preload_content=False
             )
-            logging.info(f"\n\n\tThe key {key_name} was successfully added!\n\n")
-            return __new_key
+            patched = json.loads(response.data)
+            self.__keep(patched)
+
+            logging.info(f"\n\n\tThe keys {', '.join(sorted(patch))} were successfully patched on {shard}!\n\n")
+            return patched
         except ApiException as e:
-            logging.error(e)
+            # Still failing after the retries, or not retryable (e.g. a 404 or a 422): fail the waiters, so their
+            # handlers are retried instead of reporting the key as stored
+            logging.error(f"\n\n\tThe keys {', '.join(sorted(patch))} were not patched on {shard}: "
+                          f"{e.status} {e.reason}\n\n")
+            raise
 
-    # Method to create a ConfigMap if not exists
-    def create_cm(self):
-        check = self.__verify()
+    # Method to create the ConfigMap shards if not exists, a single call is made for the concurrent callers
+    async def create_cm(self):
+        if self.__ensured:
+            return []
 
-        # If ConfigMap not Exists, then create
-        if check is False:
-            # Define Metadata to ConfigMap
-            meta = client.V1ObjectMeta(
-                name=self.name,
-                namespace=self.namespace
-            )
+        if self.__ensuring is None:
+            self.__ensuring = asyncio.ensure_future(self.__ensure())
 
-            # Construct the ConfigMap
-            configmap = client.V1ConfigMap(
-                metadata=meta,
-                data={}
-            )
-            # Apply
-            try:
-                created = self.api.create_namespaced_config_map(
-                    namespace=self.namespace,
-                    body=configmap
-                )
-                logging.info("\n\n\tThe ConfigMap was Successfully created!\n\n")
-                return created
-            except ApiException as e:
-                logging.error(e)
+        ensuring = self.__ensuring
+        try:
+            # Shielded, so a cancelled caller does not cancel the call shared with the others
+            return await asyncio.shield(ensuring)
+        finally:
+            if self.__ensuring is ensuring and ensuring.done():
+                self.__ensuring = None
 
-        else:
-            logging.info("\n\n\tThe ConfigMap exists!\n\n")
+    async def __ensure(self):
+        informer = get_informer('configmaps')
+        missing = [
+            shard for shard in self.shard_names()
+            if informer is None or informer.get(self.namespace, shard) is None
+        ]
 
+        results = await asyncio.gather(*[self.__create(shard) for shard in missing])
 
+        # Keep trying on the next call while a shard could not be created
+        self.__ensured = all(result is not False for result in results)
+        return [configmap for configmap in results if configmap not in (None, False)]
 
+    # Create a shard, an existing one (409 Conflict) being fine. Return None if it already exists, False on error
+    async def __create(self, shard):
+        # Define Metadata to ConfigMap
+        meta = client.V1ObjectMeta(
+            name=shard,
+            namespace=self.namespace
+        )
 
+        # Construct the ConfigMap
+        configmap = client.V1ConfigMap(
+            metadata=meta,
+            data={}
+        )
+        # Apply
+        try:
+            created = await self.api.create_namespaced_config_map(
+                namespace=self.namespace,
+                body=configmap
+            )
+            logging.info(f"\n\n\tThe ConfigMap {shard} was Successfully created!\n\n")
+            return created
+        except ApiException as e:
+            if e.status == 409:
+                logging.info(f"\n\n\tThe ConfigMap {shard} exists!\n\n")
+                return None
+            logging.error(e)
+            if retryable(e):
+                raise
+            return False
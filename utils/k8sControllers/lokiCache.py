@@ -0,0 +1,166 @@
+import math
+import functools
+from kubernetes import client
+from .. import quantity
+from ..asyncApi import AsyncApi
+from ..informer import MANAGED_BY_LABEL, MANAGED_BY_VALUE
+from ..patch import server_side_apply, deployment_path, service_path
+from .lokiManifest import RENDER_CACHE_SIZE, spec_hash
+from .lokiConfig import PROFILES
+
+CACHE_PORT = 11211
+CACHE_IMAGE = 'memcached:1.6.17-alpine'
+CACHE_MEMORY = '512Mi'
+CACHE_CPU = '500m'
+
+# Share of the memory limit given to the items, the rest covers the connections and the hash table
+_ITEM_MEMORY = 0.85
+
+MIB = 1024 * 1024
+
+# Max item size, twice the biggest chunk target size of the profiles (2MiB for ingest): the chunks are cut once
+# over their target, and a chunk stored with its key and item header must still fit
+ITEM_SIZE = 2 * max(profile['chunk_target_size'] for profile in PROFILES.values())
+
+
+def cache_host(name, namespace, cache):
+    """ Return the DNS name of the memcached Service of a Loki, None when its spec.cache is None """
+    return f'{name}-cache.{namespace}.svc.cluster.local' if cache is not None else None
+
+
+def _args(memory, cpu) -> list:
+    """ Return the memcached arguments sized from the container resources """
+    return [
+        '-m', str(max(16, int(quantity.parse(memory) * _ITEM_MEMORY // MIB))),
+        '-t', str(max(1, math.ceil(quantity.parse(cpu)))),
+        '-I', f'{ITEM_SIZE // MIB}m',
+        '-c', '1024'
+    ]
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render(name, namespace, uid, image, memory, cpu, replicas, annotation):
+    """ Render the cache Deployment and its headless Service as JSON-ready dicts, memoized by the CR fields
+    :param name: The Loki name, the cache objects are named <name>-cache
+    :param memory: The memory of each cache replica
+    :param cpu: The cpu of each cache replica
+    :param annotation: The annotation receiving the hash of the rendered Deployment spec
+    :return: The Deployment, the Service and the Deployment spec hash
+    """
+
+    cache_name = f'{name}-cache'
+    # Not the Loki labels: the Loki StatefulSet selector must not match the cache Pods
+    labels = {'app.kubernetes.io/name': 'memcached', 'app.kubernetes.io/instance': cache_name}
+    owner = [{
+        'apiVersion': 'jack.experts/v1',
+        'blockOwnerDeletion': True,
+        'controller': True,
+        'kind': 'Loki',
+        'name': name,
+        'uid': uid
+    }]
+
+    container = {
+        'name': 'memcached',
+        'image': image,
+        'imagePullPolicy': 'IfNotPresent',
+        'args': _args(memory, cpu),
+        'ports': [{'containerPort': CACHE_PORT, 'name': 'memcache', 'protocol': 'TCP'}],
+        'resources': {'limits': {'cpu': cpu, 'memory': memory}, 'requests': {'cpu': cpu, 'memory': memory}},
+        'readinessProbe': {'tcpSocket': {'port': CACHE_PORT}, 'periodSeconds': 10, 'timeoutSeconds': 1}
+    }
+
+    spec = {
+        'replicas': replicas,
+        'selector': {'matchLabels': labels},
+        'template': {'metadata': {'labels': labels}, 'spec': {'containers': [container]}}
+    }
+    digest = spec_hash(labels, spec)
+
+    # Only the Deployment carries the managed-by label, the Pods informer keeps to the Loki Pods
+    deployment = {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {
+            'name': cache_name,
+            'namespace': namespace,
+            'labels': {**labels, MANAGED_BY_LABEL: MANAGED_BY_VALUE},
+            'annotations': {annotation: digest},
+            'ownerReferences': owner
+        },
+        'spec': spec
+    }
+
+    # Headless: Loki resolves every replica with a SRV lookup and spreads the keys with a consistent hash
+    service = {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': {'name': cache_name, 'namespace': namespace, 'labels': labels, 'ownerReferences': owner},
+        'spec': {
+            'clusterIP': 'None',
+            'selector': labels,
+            'ports': [{'name': 'memcache', 'port': CACHE_PORT, 'targetPort': CACHE_PORT, 'protocol': 'TCP'}]
+        }
+    }
+
+    return deployment, service, digest
+
+
+class LokiCache:
+    def __init__(self, ch_name, ch_namespace, ch_uid, ch_cache, ch_annotation, ch_api_client=None):
+        """ Create the memcached cache tier of a Loki: a Deployment and its headless Service
+        :param ch_name: The Loki Name defined on metadata.name Field of CRD
+        :param ch_namespace: The Loki Namespace defined on metadata.namespace
+        :param ch_uid: The UID defined on metadata.uid of CRD
+        :param ch_cache: The spec.cache of CRD: replicas, memory, cpu and image, all optional
+        :param ch_annotation: The annotation receiving the hash of the Deployment spec
+        :param ch_api_client: The kubernetes ApiClient, the process-wide one by default
+        """
+
+        self.loki_name = ch_name
+        self.name = f'{ch_name}-cache'
+        self.namespace = ch_namespace
+        self.uid = ch_uid
+        self.replicas = ch_cache.get('replicas', 1)
+        self.memory = ch_cache.get('memory', CACHE_MEMORY)
+        self.cpu = ch_cache.get('cpu', CACHE_CPU)
+        self.image = ch_cache.get('image', CACHE_IMAGE)
+        self.annotation = ch_annotation
+        self.api = AsyncApi(client.AppsV1Api, ch_api_client)
+
+    def __render(self):
+        return render(
+            name=self.loki_name,
+            namespace=self.namespace,
+            uid=self.uid,
+            image=self.image,
+            memory=self.memory,
+            cpu=self.cpu,
+            replicas=self.replicas,
+            annotation=self.annotation
+        )
+
+    # Define the Deployment as a dict, shared by the renderer cache so it must not be mutated
+    def deployment(self) -> dict:
+        return self.__render()[0]
+
+    # Define the headless Service as a dict, shared by the renderer cache so it must not be mutated
+    def service(self) -> dict:
+        return self.__render()[1]
+
+    # Define the hash of the desired Deployment, the same stamped on the spec hash annotation
+    def spec_hash(self) -> str:
+        return self.__render()[2]
+
+    # Create the Service and the Deployment, or bring them to the desired state, with a server-side apply
+    async def apply(self):
+        await server_side_apply(
+            api_client=self.api.api_client,
+            path=service_path(name=self.name, namespace=self.namespace),
+            body=self.service()
+        )
+        return await server_side_apply(
+            api_client=self.api.api_client,
+            path=deployment_path(name=self.name, namespace=self.namespace),
+            body=self.deployment()
+        )
@@ -0,0 +1,249 @@
+import math
+import json
+import hashlib
+import functools
+import yaml
+from kubernetes import client
+from .. import quantity
+from ..asyncApi import AsyncApi
+from ..patch import server_side_apply, config_map_path
+from .lokiManifest import CONTAINER_PORT, config_name, freeze
+
+# Key read by the default command of the grafana/loki image, -config.file=/etc/loki/local-config.yaml
+CONFIG_KEY = 'local-config.yaml'
+
+MIB = 1024 * 1024
+
+# Share of the memory limit given to each cache and to the WAL replay, and query concurrency per CPU.
+# ingest favors the WAL and bigger chunks, query the caches and the concurrency
+PROFILES = {
+    'balanced': {'results_cache': 0.10, 'chunk_cache': 0.15, 'wal_replay': 0.25, 'concurrency_per_cpu': 2,
+                 'chunk_target_size': 1572864},
+    'ingest': {'results_cache': 0.05, 'chunk_cache': 0.05, 'wal_replay': 0.40, 'concurrency_per_cpu': 1,
+               'chunk_target_size': 2097152},
+    'query': {'results_cache': 0.20, 'chunk_cache': 0.25, 'wal_replay': 0.15, 'concurrency_per_cpu': 4,
+              'chunk_target_size': 1048576}
+}
+
+DEFAULT_PROFILE = 'balanced'
+
+# Fields of spec.config holding the state shared by the replicas, written in the Loki config syntax
+SHARED_STATE = {'ring': 'ring', 'storage': 'storage', 'memberlist': 'memberlist',
+                'replicationFactor': 'replication_factor'}
+
+
+def config_profile(spec) -> str:
+    """ Return the tuning profile of a Loki CR, from spec.config.profile """
+    return (spec.get('config') or {}).get('profile', DEFAULT_PROFILE)
+
+
+def shared_state(spec):
+    """ Return the shared ring, object storage and replication of a Loki CR, from spec.config, as a canonical JSON
+    usable as memoization key. None when the Loki keeps its state in each Pod
+    :raise ValueError: When spec.config.ring has no store, or spec.config.storage is not a single backend
+    """
+    config = spec.get('config') or {}
+    shared = {key: config[field] for field, key in SHARED_STATE.items() if config.get(field) is not None}
+    if not shared:
+        return None
+
+    if 'ring' in shared and not (isinstance(shared['ring'], dict) and shared['ring'].get('store')):
+        raise ValueError("spec.config.ring must define the kvstore store, e.g. consul, etcd or memberlist")
+    if 'storage' in shared and not (isinstance(shared['storage'], dict) and len(shared['storage']) == 1):
+        raise ValueError("spec.config.storage must define a single object store, e.g. s3 or gcs")
+    return json.dumps(shared, sort_keys=True, separators=(',', ':'))
+
+
+def _cache(fifocache_size, cache_host) -> dict:
+    """ Return a cache config: an in-process fifocache, in front of the memcached tier when there is one """
+    cache = {'enable_fifocache': True, 'fifocache': {'max_size_bytes': fifocache_size, 'validity': '1h'}}
+    if cache_host is not None:
+        cache['memcached'] = {'batch_size': 256, 'parallelism': 10, 'expiration': '24h'}
+        cache['memcached_client'] = {
+            'host': cache_host,
+            'service': 'memcache',  # SRV lookup of every replica behind the headless Service
+            'consistent_hash': True,
+            'timeout': '500ms',
+            'max_idle_conns': 16
+        }
+    return cache
+
+
+def _mib(size) -> str:
+    """ Return a size in bytes as a Loki byte size, at least 1MiB """
+    return f'{max(1, int(size // MIB))}MiB'
+
+
+def tuning(limits, requests, profile=DEFAULT_PROFILE) -> dict:
+    """ Return the cache sizes and the concurrency derived from the resources, the limits first
+    :param limits: The frozen spec.resources.limits
+    :param requests: The frozen spec.resources.requests
+    :param profile: One of PROFILES
+    """
+    limits, requests = dict(limits), dict(requests)
+    factors = PROFILES[profile]
+    memory = quantity.parse(limits.get('memory') or requests.get('memory') or '1Gi')
+    cpu = quantity.parse(limits.get('cpu') or requests.get('cpu') or '1')
+    concurrency = max(1, math.ceil(cpu * factors['concurrency_per_cpu']))
+
+    return {
+        'results_cache': _mib(memory * factors['results_cache']),
+        'chunk_cache': _mib(memory * factors['chunk_cache']),
+        'wal_replay': _mib(memory * factors['wal_replay']),
+        'chunk_target_size': factors['chunk_target_size'],
+        'concurrency': concurrency,
+        'parallelism': concurrency * 2
+    }
+
+
+@functools.lru_cache(maxsize=1024)
+def render(limits, requests, profile=DEFAULT_PROFILE, cache_host=None, shared=None):
+    """ Render the Loki config as YAML, memoized: the Lokis with the same resources and no cache share it
+    :param limits: The frozen spec.resources.limits
+    :param requests: The frozen spec.resources.requests
+    :param profile: The tuning profile, one of PROFILES
+    :param cache_host: The memcached Service of the Loki, None without a cache tier
+    :param shared: The shared state returned by shared_state, None to keep the ring and the data in each Pod
+    :return: The config text and its hash
+    """
+
+    tuned = tuning(limits, requests, profile)
+    config = {
+        'auth_enabled': False,
+        'server': {'http_listen_port': CONTAINER_PORT, 'grpc_listen_port': 9095},
+        'common': {
+            'path_prefix': '/data',
+            'replication_factor': 1,
+            'ring': {'kvstore': {'store': 'inmemory'}},
+            'storage': {'filesystem': {'chunks_directory': '/data/chunks', 'rules_directory': '/data/rules'}}
+        },
+        'schema_config': {'configs': [{
+            'from': '2020-10-24',
+            'store': 'boltdb-shipper',
+            'object_store': 'filesystem',
+            'schema': 'v11',
+            'index': {'prefix': 'index_', 'period': '24h'}
+        }]},
+        'ingester': {
+            'chunk_target_size': tuned['chunk_target_size'],
+            'chunk_idle_period': '30m',
+            'max_chunk_age': '1h',
+            'wal': {'enabled': True, 'dir': '/data/wal', 'replay_memory_ceiling': tuned['wal_replay']}
+        },
+        'querier': {'max_concurrent': tuned['concurrency']},
+        'query_range': {
+            'parallelise_shardable_queries': True,
+            'cache_results': True,
+            'results_cache': {'cache': _cache(tuned['results_cache'], cache_host)}
+        },
+        'chunk_store_config': {'chunk_cache_config': _cache(tuned['chunk_cache'], cache_host)},
+        'limits_config': {'max_query_parallelism': tuned['parallelism'], 'split_queries_by_interval': '30m'},
+        'ruler': {
+            'storage': {'type': 'local', 'local': {'directory': '/etc/loki/rules'}},
+            'rule_path': '/data/rules-temp'
+        }
+    }
+
+    # A shared kvstore and object store replace the inmemory ring and the filesystem storage of each Pod
+    shared = json.loads(shared) if shared is not None else {}
+    if 'ring' in shared:
+        config['common']['ring']['kvstore'] = shared['ring']
+    if 'memberlist' in shared:
+        config['memberlist'] = shared['memberlist']
+    if 'replication_factor' in shared:
+        config['common']['replication_factor'] = shared['replication_factor']
+    if 'storage' in shared:
+        config['common']['storage'] = shared['storage']
+        config['schema_config']['configs'][0]['object_store'] = next(iter(shared['storage']))
+
+    text = yaml.safe_dump(config, sort_keys=True)
+    return text, hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=64)
+def scalable(text) -> bool:
+    """ True when the replicas running a Loki config share their state: the ring on a shared kvstore, the chunks
+    and the index on an object store. Otherwise each Pod has its own ring and data, more Pods split the streams
+    :param text: The config YAML, as rendered
+    """
+    config = yaml.safe_load(text)
+    common = config.get('common') or {}
+    store = ((common.get('ring') or {}).get('kvstore') or {}).get('store')
+    object_stores = {schema.get('object_store') for schema in (config.get('schema_config') or {}).get('configs') or []}
+    return store not in (None, 'inmemory') and 'filesystem' not in (common.get('storage') or {}) and \
+        not object_stores & {None, 'filesystem'}
+
+
+class LokiConfig:
+    def __init__(self, lc_name, lc_namespace, lc_limits, lc_requests, lc_uid, lc_profile=DEFAULT_PROFILE,
+                 lc_cache_host=None, lc_shared_state=None, lc_api_client=None):
+        """ Create the Loki config ConfigMap, tuned from the Loki resources
+        :param lc_name: The Loki Name defined on metadata.name Field of CRD
+        :param lc_namespace: The Loki Namespace defined on metadata.namespace
+        :param lc_limits: The Limits defined on spec.resources.limits of CRD
+        :param lc_requests: The Requests defined on spec.resources.requests of CRD
+        :param lc_uid: The UID defined on metadata.uid of CRD
+        :param lc_profile: The tuning profile defined on spec.config.profile of CRD
+        :param lc_cache_host: The memcached Service of the Loki cache tier, None without spec.cache
+        :param lc_shared_state: The shared ring and storage returned by shared_state, None to keep them in each Pod
+        :param lc_api_client: The kubernetes ApiClient, the process-wide one by default
+        """
+
+        if lc_profile not in PROFILES:
+            raise ValueError(f"Unknown Loki config profile {lc_profile}, expected one of {', '.join(PROFILES)}")
+
+        self.loki_name = lc_name
+        self.name = config_name(lc_name)
+        self.namespace = lc_namespace
+        self.limits = lc_limits
+        self.requests = lc_requests
+        self.uid = lc_uid
+        self.profile = lc_profile
+        self.cache_host = lc_cache_host
+        self.shared_state = lc_shared_state
+        self.api = AsyncApi(client.CoreV1Api, lc_api_client)
+
+    def __render(self):
+        return render(
+            limits=freeze(self.limits),
+            requests=freeze(self.requests),
+            profile=self.profile,
+            cache_host=self.cache_host,
+            shared=self.shared_state
+        )
+
+    # Define the hash of the config, stamped on the Pod Template so a config change restarts the Pods
+    def config_hash(self) -> str:
+        return self.__render()[1]
+
+    # Define if the Loki can run more than one replica, see scalable
+    def scalable(self) -> bool:
+        return scalable(self.__render()[0])
+
+    # Define the ConfigMap as a dict
+    def manifest(self) -> dict:
+        return {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {
+                'name': self.name,
+                'namespace': self.namespace,
+                'ownerReferences': [{
+                    'apiVersion': 'jack.experts/v1',
+                    'blockOwnerDeletion': True,
+                    'controller': True,
+                    'kind': 'Loki',
+                    'name': self.loki_name,
+                    'uid': self.uid
+                }]
+            },
+            'data': {CONFIG_KEY: self.__render()[0]}
+        }
+
+    # Create or update the ConfigMap with a server-side apply
+    async def apply(self):
+        return await server_side_apply(
+            api_client=self.api.api_client,
+            path=config_map_path(name=self.name, namespace=self.namespace),
+            body=self.manifest()
+        )
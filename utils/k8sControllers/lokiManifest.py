@@ -0,0 +1,151 @@
+import json
+import hashlib
+import functools
+
+# The renderer below emits the same JSON returned by sanitize_for_serialization(LokiSf.stateful_set()),
+# without building the kubernetes.client model objects. tests/test_manifest.py keeps the two in line.
+#
+# The invariant parts are module-level skeletons shared by every rendered manifest, so neither the
+# skeletons nor the rendered manifests may be mutated: copy them before any change.
+
+CONTAINER_PORT = 3100
+
+_PORTS = [
+    {'containerPort': CONTAINER_PORT, 'name': 'http-metrics', 'protocol': 'TCP'}
+]
+
+_VOLUME_MOUNTS = [
+    {'mountPath': '/etc/loki', 'name': 'config'},
+    {'mountPath': '/etc/loki/rules', 'name': 'rules'},
+    {'mountPath': '/data', 'name': 'data'}
+]
+
+# Same values of LokiSf.__Probes.readiness(): the rollouts advance once the updated Pods pass it
+_READY_PROBE = {
+    'initialDelaySeconds': 45,
+    'timeoutSeconds': 1,
+    'periodSeconds': 10,
+    'successThreshold': 1,
+    'failureThreshold': 3,
+    'httpGet': {'path': '/ready', 'port': CONTAINER_PORT, 'scheme': 'HTTP'}
+}
+
+# Rolling updates held by a partition, moved forward by utils/rollout.py and left out of the rendered spec
+_UPDATE_STRATEGY = {'type': 'RollingUpdate'}
+
+RENDER_CACHE_SIZE = 8192
+
+
+def freeze(mapping) -> tuple:
+    """ Return a hashable representation of a flat dict, used as memoization key """
+    return tuple(sorted(mapping.items())) if mapping else ()
+
+
+def spec_hash(labels, spec) -> str:
+    """ Return a stable hash of the labels and the StatefulSet spec """
+    encoded = json.dumps({'labels': labels, 'spec': spec}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def config_name(name) -> str:
+    """ Return the name of the ConfigMap holding the Loki config generated for a Loki """
+    return f'{name}-config'
+
+
+@functools.lru_cache(maxsize=None)
+def _rules_volume(rules) -> dict:
+    """ Return the rules volume, the ConfigMap itself or a projection of every shard """
+    if len(rules) == 1:
+        return {'name': 'rules', 'configMap': {'name': rules[0], 'defaultMode': 420}}
+
+    return {'name': 'rules', 'projected': {
+        'defaultMode': 420,
+        'sources': [{'configMap': {'name': shard, 'optional': True}} for shard in rules]
+    }}
+
+
+def _volumes(name, rules) -> list:
+    """ Return the Pod volumes: the config generated for the Loki and the rules. The data volume comes from
+    the claim template """
+    return [{'name': 'config', 'configMap': {'name': config_name(name), 'defaultMode': 420}}, _rules_volume(rules)]
+
+
+def _data_claim(storage, storage_class) -> dict:
+    """ Return the claim template of the data volume, the default StorageClass when storage_class is None """
+    spec = {'accessModes': ['ReadWriteOnce'], 'resources': {'requests': {'storage': storage}}}
+    if storage_class is not None:
+        spec['storageClassName'] = storage_class
+    return {'metadata': {'name': 'data'}, 'spec': spec}
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render(name, namespace, image, limits, requests, labels, managed_labels, replicas, storage, storage_class, uid,
+           rules, annotation, config_annotation, config_hash, pod_management_policy='Parallel'):
+    """ Render the Loki StatefulSet as a JSON-ready dict, memoized by the CR fields
+    :param limits: The frozen spec.resources.limits
+    :param requests: The frozen spec.resources.requests
+    :param labels: The frozen metadata.labels, used on the selector
+    :param managed_labels: The frozen labels of the StatefulSet and the Pod Template
+    :param storage: The size of the data volume of each replica
+    :param storage_class: The StorageClass of the data volumes, None for the default one
+    :param rules: The tuple of the rules ConfigMap shards
+    :param annotation: The annotation receiving the hash of the rendered spec
+    :param config_annotation: The Pod Template annotation receiving the hash of the Loki config
+    :param config_hash: The hash of the Loki config, a new one rolls the Pods out
+    :param pod_management_policy: Parallel starts and stops every Pod at once, OrderedReady one after the other
+    :return: The StatefulSet dict and its spec hash
+    """
+
+    container = {
+        'name': name,
+        'image': image,
+        'imagePullPolicy': 'IfNotPresent',
+        'resources': {'limits': dict(limits), 'requests': dict(requests)},
+        'ports': _PORTS,
+        'readinessProbe': _READY_PROBE,
+        'volumeMounts': _VOLUME_MOUNTS
+    }
+
+    pod_labels = dict(managed_labels)
+
+    spec = {
+        'serviceName': 'teste',
+        'replicas': replicas,
+        'podManagementPolicy': pod_management_policy,
+        'updateStrategy': _UPDATE_STRATEGY,
+        'template': {
+            'metadata': {
+                'name': name,
+                'namespace': namespace,
+                'labels': pod_labels,
+                'annotations': {config_annotation: config_hash}
+            },
+            'spec': {'containers': [container], 'volumes': _volumes(name, rules)}
+        },
+        'selector': {'matchLabels': dict(labels)},
+        'volumeClaimTemplates': [_data_claim(storage, storage_class)]
+    }
+
+    digest = spec_hash(pod_labels, spec)
+
+    stateful_set = {
+        'apiVersion': 'apps/v1',
+        'kind': 'StatefulSet',
+        'metadata': {
+            'name': name,
+            'namespace': namespace,
+            'labels': pod_labels,
+            'annotations': {annotation: digest},
+            'ownerReferences': [{
+                'apiVersion': 'jack.experts/v1',
+                'blockOwnerDeletion': True,
+                'controller': True,
+                'kind': 'Loki',
+                'name': name,
+                'uid': uid
+            }]
+        },
+        'spec': spec
+    }
+
+    return stateful_set, digest
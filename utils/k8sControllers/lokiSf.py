@@ -1,4 +1,30 @@
-from kubernetes import client, config
+from kubernetes import client
+from ..asyncApi import AsyncApi
+from . import lokiManifest
+from .lokiConfig import DEFAULT_PROFILE, LokiConfig
+from .lokiCache import LokiCache, cache_host
+from ..informer import MANAGED_BY_LABEL, MANAGED_BY_VALUE
+from ..patch import server_side_apply, stateful_set_path
+from ..rollout import ROLLOUT_STEP, stage
+
+# Annotation holding the hash of the desired StatefulSet rendered by LokiSf
+SPEC_HASH_ANNOTATION = 'jack.experts/spec-hash'
+
+# Pod Template annotation holding the hash of the Loki config, so a config change rolls the Pods out
+CONFIG_HASH_ANNOTATION = 'jack.experts/config-hash'
+
+
+def pod_management_policy(spec, live=None) -> str:
+    """ Return the pod management policy of a Loki CR, from spec.podManagementPolicy. Without it, an existing
+    StatefulSet keeps its own policy, a change recreating it. A new one starts its Pods in Parallel
+    :param spec: The spec of the Loki CR
+    :param live: The live StatefulSet, None before it is created
+    """
+    if spec.get('podManagementPolicy'):
+        return spec['podManagementPolicy']
+    if live is not None:
+        return live['spec'].get('podManagementPolicy', 'OrderedReady')
+    return 'Parallel'
 
 
 class LokiSf:
@@ -11,7 +37,14 @@ class LokiSf:
                  lk_labels,
                  lk_replicas,
                  lk_storage,
-                 lk_uid):
+                 lk_uid,
+                 lk_rules=('logs-alert',),
+                 lk_pod_management_policy='Parallel',
+                 lk_storage_class=None,
+                 lk_config_profile=DEFAULT_PROFILE,
+                 lk_cache=None,
+                 lk_shared_state=None,
+                 lk_api_client=None):
 
         """ Create the Loki StatefulSet
         :param lk_name: The Loki Name defined on metadata.name Field of CRD
@@ -23,22 +56,56 @@ class LokiSf:
         :param lk_replicas: The Replicas defined on spec.replicas of CRD
         :param lk_storage: The Storage request defined on spec.storage of CRD
         :param lk_uid: The UID defined on metadata.uid of CRD
+        :param lk_rules: The names of the LogAlert rules ConfigMap shards
+        :param lk_pod_management_policy: The policy defined on spec.podManagementPolicy of CRD, Parallel by default
+        :param lk_storage_class: The StorageClass defined on spec.storageClassName of CRD, the default one if None
+        :param lk_config_profile: The Loki config tuning profile defined on spec.config.profile of CRD
+        :param lk_cache: The memcached cache tier defined on spec.cache of CRD, None without one
+        :param lk_shared_state: The shared ring and storage defined on spec.config of CRD, see shared_state
+        :param lk_api_client: The kubernetes ApiClient, the process-wide one by default
         """
 
         self.name = lk_name
         self.namespace = lk_namespace
         self.image = lk_image
-        self.api = client.AppsV1Api()
+        self.api = AsyncApi(client.AppsV1Api, lk_api_client)
         self.limits = lk_limits
         self.replicas = lk_replicas
         self.requests = lk_requests
         self.labels = lk_labels
+        # The managed-by label lets the Informers watch only the objects created by the operator
+        self.managed_labels = {**lk_labels, MANAGED_BY_LABEL: MANAGED_BY_VALUE}
         self.storage = lk_storage
+        self.storage_class = lk_storage_class
         self.uid = lk_uid
-        self.container_port = 3100
+        self.rules = tuple(lk_rules)
+        self.pod_management_policy = lk_pod_management_policy
+        self.container_port = lokiManifest.CONTAINER_PORT
 
         self.probes = self.__Probes(container_port=self.container_port)
-        config.load_incluster_config()
+
+        self.cache = None
+        if lk_cache is not None:
+            self.cache = LokiCache(
+                ch_name=lk_name,
+                ch_namespace=lk_namespace,
+                ch_uid=lk_uid,
+                ch_cache=lk_cache,
+                ch_annotation=SPEC_HASH_ANNOTATION,
+                ch_api_client=lk_api_client
+            )
+
+        self.config = LokiConfig(
+            lc_name=lk_name,
+            lc_namespace=lk_namespace,
+            lc_limits=lk_limits,
+            lc_requests=lk_requests,
+            lc_uid=lk_uid,
+            lc_profile=lk_config_profile,
+            lc_cache_host=cache_host(lk_name, lk_namespace, lk_cache),
+            lc_shared_state=lk_shared_state,
+            lc_api_client=lk_api_client
+        )
 
     # Define and return the resources object
     def __resources(self):
@@ -67,7 +134,7 @@ class LokiSf:
             image=self.image,
             image_pull_policy="IfNotPresent",
             # liveness_probe=self.probes.liveness(),
-            # readiness_probe=self.probes.readiness(),
+            readiness_probe=self.probes.readiness(),
             resources=self.__resources(),  # Get the Resources Object returned by the function
             ports=self.__ports(),  # Get the Ports object returned by the function
             volume_mounts=[
@@ -90,6 +157,30 @@ class LokiSf:
         _ct.append(ct)
         return _ct
 
+    # Define the rules Volume: the ConfigMap itself, or a projection of every ConfigMap shard
+    def __rules_volume(self):
+        if len(self.rules) == 1:
+            return client.V1Volume(
+                name='rules',
+                config_map=client.V1ConfigMapVolumeSource(
+                    name=self.rules[0],
+                    default_mode=420
+                )
+            )
+
+        return client.V1Volume(
+            name='rules',
+            projected=client.V1ProjectedVolumeSource(
+                default_mode=420,
+                sources=[
+                    client.V1VolumeProjection(
+                        config_map=client.V1ConfigMapProjection(name=shard, optional=True)
+                    )
+                    for shard in self.rules
+                ]
+            )
+        )
+
     # Define the Pod object
     def __pod(self):
         pod = client.V1PodSpec(
@@ -98,22 +189,11 @@ class LokiSf:
                 client.V1Volume(
                     name='config',
                     config_map=client.V1ConfigMapVolumeSource(
-                        name='loki-config',
+                        name=self.config.name,
                         default_mode=420
                     )
                 ),
-                client.V1Volume(
-                    name='rules',
-                    config_map=client.V1ConfigMapVolumeSource(
-                        name='logs-alert',
-                        default_mode=420
-                    )
-                ),
-                # TODO: TEMPORARY
-                client.V1Volume(
-                    name='data',
-                    empty_dir=client.V1EmptyDirVolumeSource()
-                )
+                self.__rules_volume()
             ]
         )
         return pod
@@ -125,7 +205,8 @@ class LokiSf:
             metadata=client.V1ObjectMeta(  # Define the object metadata
                 name=self.name,
                 namespace=self.namespace,
-                labels=self.labels
+                labels=self.managed_labels,
+                annotations={CONFIG_HASH_ANNOTATION: self.config.config_hash()}
             )
         )
         return pod_tpl
@@ -137,7 +218,8 @@ class LokiSf:
                 resources=client.V1ResourceRequirements(
                     requests={'storage': self.storage}
                 ),
-                access_modes=['ReadWriteOnce']
+                access_modes=['ReadWriteOnce'],
+                storage_class_name=self.storage_class
             )
         )
         _pvc = list()
@@ -149,11 +231,15 @@ class LokiSf:
         st_spec = client.V1StatefulSetSpec(
             service_name='teste',
             replicas=self.replicas,
+            pod_management_policy=self.pod_management_policy,
+            # The partition is moved by utils/rollout.py, not rendered
+            update_strategy=client.V1StatefulSetUpdateStrategy(type='RollingUpdate'),
             template=self.__pod_template(),  # Get the Pod Template Object returned by the function
             selector=client.V1LabelSelector(
                 match_labels=self.labels
-            )
-            # volume_claim_templates=self.__data_pvc()
+            ),
+            # Immutable: a bigger spec.storage expands the PVCs, see Reconciliation
+            volume_claim_templates=self.__data_pvc()
         )
         return st_spec
 
@@ -172,20 +258,100 @@ class LokiSf:
 
         return _owner
 
+    # Render the StatefulSet as a JSON-ready dict, returning it with its spec hash
+    def __render(self):
+        return lokiManifest.render(
+            name=self.name,
+            namespace=self.namespace,
+            image=self.image,
+            limits=lokiManifest.freeze(self.limits),
+            requests=lokiManifest.freeze(self.requests),
+            labels=lokiManifest.freeze(self.labels),
+            managed_labels=lokiManifest.freeze(self.managed_labels),
+            replicas=self.replicas,
+            storage=self.storage,
+            storage_class=self.storage_class,
+            uid=self.uid,
+            rules=self.rules,
+            annotation=SPEC_HASH_ANNOTATION,
+            config_annotation=CONFIG_HASH_ANNOTATION,
+            config_hash=self.config.config_hash(),
+            pod_management_policy=self.pod_management_policy
+        )
+
+    # Define the StatefulSet as a dict, shared by the renderer cache so it must not be mutated
+    def manifest(self) -> dict:
+        return self.__render()[0]
+
+    # Define the hash of the desired StatefulSet, the same stamped on the spec hash annotation
+    def spec_hash(self) -> str:
+        return self.__render()[1]
+
     # Define the StatefulSet Object
     def stateful_set(self):
         st = client.V1StatefulSet(
+            api_version='apps/v1',
+            kind='StatefulSet',
             spec=self.__stateful_set_spec(),  # Get the StatefulSet Spec Object returned by the function
             metadata=client.V1ObjectMeta(  # Define the Metadata Object
                 name=self.name,
                 namespace=self.namespace,
-                labels=self.labels,
+                labels=self.managed_labels,
+                annotations={SPEC_HASH_ANNOTATION: self.spec_hash()},
                 owner_references=self.__obj_owner()
             )
         )
 
         return st
 
+    # Create the StatefulSet on the cluster, or bring an existing one to the desired state, with a server-side apply.
+    # The cache and the config go first, the Pods use them
+    async def create(self):
+        if self.cache is not None:
+            await self.cache.apply()
+        await self.config.apply()
+        created = await server_side_apply(
+            api_client=self.api.api_client,
+            path=stateful_set_path(name=self.name, namespace=self.namespace),
+            body=self.manifest()
+        )
+        return created
+
+    # The claim templates are immutable: keep the size and the class of the live ones, the PVCs being resized apart
+    @staticmethod
+    def __live_claims(body, live):
+        live_claim = next(
+            (claim for claim in live['spec'].get('volumeClaimTemplates') or [] if claim['metadata']['name'] == 'data'),
+            None
+        )
+        if live_claim is None:
+            # Created with the emptyDir data volume of the previous versions: kept until the reconciliation moves
+            # the StatefulSet to the data PVC
+            volumes = live['spec']['template']['spec'].get('volumes') or []
+            data = next((volume for volume in volumes if volume['name'] == 'data'), {'name': 'data', 'emptyDir': {}})
+            template = body['spec']['template']
+            pod = dict(template['spec'], volumes=[*(template['spec'].get('volumes') or []), data])
+            spec = {field: value for field, value in body['spec'].items() if field != 'volumeClaimTemplates'}
+            return dict(body, spec=dict(spec, template=dict(template, spec=pod)))
+
+        claim = body['spec']['volumeClaimTemplates'][0]
+        storage = live_claim['spec']['resources']['requests']['storage']
+        spec = dict(claim['spec'], resources={'requests': {'storage': storage}})
+        spec.pop('storageClassName', None)
+        if live_claim['spec'].get('storageClassName') is not None:
+            spec['storageClassName'] = live_claim['spec']['storageClassName']
+        return dict(body, spec=dict(body['spec'], volumeClaimTemplates=[dict(claim, spec=spec)]))
+
+    # Bring an existing StatefulSet to the desired state with a server-side apply of the full object, so the fields
+    # dropped from the desired state are removed too. A Pod template change is rolled out step by step
+    async def apply(self, live, step=ROLLOUT_STEP, template_changed=True):
+        body = stage(self.__live_claims(self.manifest(), live), live, step, template_changed)
+        return await server_side_apply(
+            api_client=self.api.api_client,
+            path=stateful_set_path(name=self.name, namespace=self.namespace),
+            body=body
+        )
+
     # Inner Class to define the liveness and Readiness Probes
     class __Probes:
         def __init__(self, container_port):
@@ -0,0 +1,130 @@
+import time
+import functools
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from kubernetes.client.exceptions import ApiException
+from .profiler import profiler
+
+# Kubernetes verbs of the kubernetes.client method prefixes
+_VERBS = {'read': 'get', 'list': 'list', 'create': 'create', 'patch': 'patch', 'replace': 'update', 'delete': 'delete'}
+
+HANDLER_SECONDS = Histogram(
+    'loki_operator_handler_duration_seconds',
+    'Duration of the kopf handlers',
+    ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'loki_operator_handler_errors_total',
+    'Exceptions raised by the kopf handlers',
+    ['handler']
+)
+API_SECONDS = Histogram(
+    'loki_operator_api_call_duration_seconds',
+    'Duration of the Kubernetes API calls',
+    ['verb', 'resource'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+API_ERRORS = Counter(
+    'loki_operator_api_errors_total',
+    'Kubernetes API calls answered with an error status',
+    ['verb', 'resource', 'code']
+)
+API_RETRIES = Counter(
+    'loki_operator_api_retries_total',
+    'Kubernetes API calls sent again after a retryable error, by status code or exception',
+    ['code']
+)
+API_LIMIT = Gauge(
+    'loki_operator_api_concurrency_limit',
+    'Adaptive limit of the Kubernetes API calls in flight, shrunk by the 429 responses'
+)
+QUEUE_DEPTH = Gauge(
+    'loki_operator_reconcile_queue_depth',
+    'Lokis waiting on the reconcile queue'
+)
+RECONCILES = Counter(
+    'loki_operator_reconciles_total',
+    'Reconciliations by result: hash (spec hash hit), in_sync (structural diff hit), drift or missing',
+    ['result']
+)
+CONFIGMAP_PATCH_BYTES = Histogram(
+    'loki_operator_configmap_patch_bytes',
+    'Bytes of the patches sent to the rules ConfigMap shards',
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576)
+)
+VPA_ACTIONS = Counter(
+    'loki_operator_vpa_actions_total',
+    'Resource changes made on the Loki CRs: oom (memory bump after an OOMKilled) or recommendation',
+    ['action']
+)
+SCALE_ACTIONS = Counter(
+    'loki_operator_scale_actions_total',
+    'Replica changes made on the Loki CRs by the autoscaler, by direction: up or down',
+    ['direction']
+)
+POD_RECOVERY_SECONDS = Histogram(
+    'loki_operator_pod_recovery_seconds',
+    'Seconds from the start of a Loki container to its Pod passing the /ready probe: WAL replay and cache warm-up',
+    buckets=(15, 30, 45, 60, 90, 120, 180, 300, 600, 1200, 1800)
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _split(method) -> tuple:
+    """ Return the verb and resource of a kubernetes.client method, e.g. patch_namespaced_stateful_set """
+    prefix, _, rest = method.partition('_')
+    rest = rest.replace('namespaced_', '').replace('cluster_', '').replace('_for_all_namespaces', '')
+    return _VERBS.get(prefix, prefix), rest.replace('_', '') + 's'
+
+
+def api_call(method, fn, *args, **kwargs):
+    """ Run a blocking kubernetes.client call, recording its duration and error status
+    :param method: The kubernetes.client method name, giving the verb and resource labels
+    :param fn: The function to call
+    """
+    verb, resource = _split(method)
+    if resource == 'customobjects':
+        resource = kwargs.get('plural', resource)
+    return observe(verb, resource, fn, *args, **kwargs)
+
+
+def observe(verb, resource, fn, *args, **kwargs):
+    """ Run a blocking Kubernetes API call under the given verb and resource labels """
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    except ApiException as e:
+        API_ERRORS.labels(verb=verb, resource=resource, code=str(e.status)).inc()
+        raise
+    finally:
+        API_SECONDS.labels(verb=verb, resource=resource).observe(time.perf_counter() - start)
+
+
+def timed(handler):
+    """ Decorator recording the duration and the exceptions of an async kopf handler, and its wall and
+    CPU split while the profiler runs. The exceptions with a true expected attribute are not counted """
+    def decorator(fn):
+        seconds = HANDLER_SECONDS.labels(handler=handler)
+        errors = HANDLER_ERRORS.labels(handler=handler)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if profiler.active:
+                    return await profiler.measure(handler, fn(*args, **kwargs))
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                # An expected exception only defers the handler, e.g. a Loki not handed over to this replica yet
+                if not getattr(e, 'expected', False):
+                    errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - start)
+
+        return wrapper
+    return decorator
+
+
+def serve(port):
+    """ Serve /metrics on a background thread """
+    start_http_server(port)
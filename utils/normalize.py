@@ -0,0 +1,164 @@
+import re
+
+# Objects keeping annotations filtered by the annotation rules
+_ANNOTATED_PATHS = ('metadata', 'spec.template.metadata')
+
+_DROP = object()
+
+
+class Rules:
+    def __init__(self, drop=(), annotations=(), defaults=()):
+        """ Declarative set of fields ignored when comparing StatefulSets
+        :param drop: Dotted paths of fields always removed, * matching any list index
+        :param annotations: Regex patterns of the annotation keys removed
+        :param defaults: (path, predicate) pairs, the field is removed when predicate(value) is True
+        """
+
+        self.drop = tuple(drop)
+        self.annotations = tuple(annotations)
+        self.defaults = tuple(defaults)
+
+    def extend(self, drop=(), annotations=(), defaults=()):
+        """ Return new Rules with these ones plus the given ones """
+        return Rules(
+            drop=self.drop + tuple(drop),
+            annotations=self.annotations + tuple(annotations),
+            defaults=self.defaults + tuple(defaults)
+        )
+
+
+class _Node:
+    __slots__ = ('children', 'drop', 'defaults', 'annotations')
+
+    def __init__(self):
+        self.children = dict()
+        self.drop = set()
+        self.defaults = dict()
+        self.annotations = None
+
+
+class Normalizer:
+    def __init__(self, rules: Rules):
+        """ Rules compiled to a tree walked in one pass. The normalized view shares the unchanged
+        subtrees with the input, which is never mutated
+        """
+
+        self.root = _Node()
+
+        for path in rules.drop:
+            parent, key = self.__split(path)
+            parent.drop.add(key)
+
+        for path, predicate in rules.defaults:
+            parent, key = self.__split(path)
+            parent.defaults[key] = predicate
+
+        if rules.annotations:
+            pattern = re.compile('|'.join(f'(?:{annotation})' for annotation in rules.annotations))
+            for path in _ANNOTATED_PATHS:
+                self.__node(path.split('.')).annotations = pattern
+
+    def __node(self, segments) -> _Node:
+        node = self.root
+        for segment in segments:
+            node = node.children.setdefault(segment, _Node())
+        return node
+
+    def __split(self, path):
+        segments = path.split('.')
+        return self.__node(segments[:-1]), segments[-1]
+
+    def __call__(self, obj):
+        return self.__walk(obj, self.root)
+
+    def __walk(self, obj, node):
+        if isinstance(obj, list):
+            child = node.children.get('*')
+            if child is None:
+                return obj
+            items = [self.__walk(item, child) for item in obj]
+            return obj if all(new is old for new, old in zip(items, obj)) else items
+
+        if not isinstance(obj, dict):
+            return obj
+
+        changes = dict()
+        for key in node.drop:
+            if key in obj:
+                changes[key] = _DROP
+
+        for key, predicate in node.defaults.items():
+            if key in obj and predicate(obj[key]):
+                changes[key] = _DROP
+
+        if node.annotations is not None and isinstance(obj.get('annotations'), dict):
+            annotations = obj['annotations']
+            kept = {key: value for key, value in annotations.items() if not node.annotations.match(key)}
+            if not kept:
+                changes['annotations'] = _DROP
+            elif len(kept) != len(annotations):
+                changes['annotations'] = kept
+
+        for key, child in node.children.items():
+            if key in obj and key not in changes:
+                value = self.__walk(obj[key], child)
+                if value is not obj[key]:
+                    changes[key] = value
+
+        if not changes:
+            return obj
+
+        normalized = dict(obj)
+        for key, value in changes.items():
+            if value is _DROP:
+                normalized.pop(key)
+            else:
+                normalized[key] = value
+        return normalized
+
+
+# Fields set by the API server on every StatefulSet
+BASE_RULES = Rules(
+    drop=(
+        'apiVersion',  # List items come without the type fields
+        'kind',
+        'status',
+        'metadata.creationTimestamp',
+        'metadata.selfLink',
+        'metadata.uid',
+        'metadata.resourceVersion',
+        'metadata.generation',
+        'metadata.managedFields',
+        'spec.updateStrategy.rollingUpdate.partition',  # Moved by the rollouts, see utils/rollout.py
+        'spec.volumeClaimTemplates'  # Immutable, resized apart from the diff, see Reconciliation
+    ),
+    annotations=(
+        r'jack\.experts/spec-hash$',  # Compared apart from the structural diff
+    ),
+    defaults=(
+        ('spec.template.spec.containers.*.securityContext', lambda value: not (value or {}).get('capabilities')),
+        # Only the partition, defaulted to 0 by the API server or held by a rollout
+        ('spec.updateStrategy.rollingUpdate', lambda value: not set(value or {}) - {'partition'}),
+    )
+)
+
+FLAVORS = {
+    'vanilla': BASE_RULES,
+    'rancher': BASE_RULES.extend(annotations=(r'.*cattle',)),
+    'openshift': BASE_RULES.extend(annotations=(r'openshift\.io/', r'k8s\.v1\.cni\.cncf\.io/'))
+}
+
+_normalizers = dict()
+
+
+def register_flavor(name, rules: Rules):
+    """ Add the ignore rules of a cluster flavor """
+    FLAVORS[name] = rules
+    _normalizers.pop(name, None)
+
+
+def normalizer(flavor='vanilla') -> Normalizer:
+    """ Return the compiled Normalizer of a cluster flavor """
+    if flavor not in _normalizers:
+        _normalizers[flavor] = Normalizer(FLAVORS[flavor])
+    return _normalizers[flavor]
@@ -0,0 +1,101 @@
+import time
+import asyncio
+import logging
+from datetime import datetime
+from . import quantity
+
+
+class OomWatcher:
+    def __init__(self, resize_fn, debounce=0.5):
+        """ React to OOMKilled containers of the Loki Pods seen by the pods Informer
+        :param resize_fn: Coroutine function called as resize_fn(name, namespace, memory) once per Loki, memory being
+                          the highest memory limit the OOMKilled containers ran with, None when unknown
+        :param debounce: Seconds to gather the OOMs of all replicas into a single resize
+        """
+
+        self.resize_fn = resize_fn
+        self.debounce = debounce
+        self.started = time.time()
+
+        self.__loop = None
+        self.__seen = dict()  # OOMs already handled, per Pod
+        self.__scheduled = dict()
+        self.__memory = dict()  # Highest memory limit of the OOMKilled containers, per Loki scheduled
+
+    def attach(self, informer, loop):
+        """ Listen to the Pod events of the Informer, scheduling the resizes on the loop """
+        self.__loop = loop
+        informer.add_handler(self.on_pod)
+
+    @staticmethod
+    def __owner(pod):
+        """ Return the Loki owning the Pod: its StatefulSet has the Loki name """
+        for owner in pod['metadata'].get('ownerReferences') or []:
+            if owner['kind'] == 'StatefulSet':
+                return f"{pod['metadata']['namespace']}/{owner['name']}"
+        return None
+
+    @staticmethod
+    def __memory_limit(pod, container):
+        """ Return the memory limit the container of the Pod runs with, None when it has none """
+        for spec in (pod.get('spec') or {}).get('containers') or []:
+            if spec['name'] == container:
+                return ((spec.get('resources') or {}).get('limits') or {}).get('memory')
+        return None
+
+    @staticmethod
+    def __timestamp(value) -> float:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+    # Called by the Informer thread
+    def on_pod(self, event_type, pod):
+        pod_key = f"{pod['metadata']['namespace']}/{pod['metadata']['name']}"
+        if event_type == 'DELETED':
+            self.__seen.pop(pod_key, None)
+            return
+
+        loki = self.__owner(pod)
+        if loki is None:
+            return
+
+        seen = self.__seen.setdefault(pod_key, set())
+        for status in (pod.get('status') or {}).get('containerStatuses') or []:
+            for state in (status.get('state'), status.get('lastState')):
+                terminated = (state or {}).get('terminated')
+                if not terminated or terminated.get('reason') != 'OOMKilled':
+                    continue
+
+                mark = (status['name'], terminated.get('finishedAt'))
+                if mark in seen:
+                    continue
+                seen.add(mark)
+
+                # Ignore the OOMs from before the operator start
+                finished = terminated.get('finishedAt')
+                if finished and self.__timestamp(finished) < self.started:
+                    continue
+
+                logging.info(f"\n\n\tContainer {status['name']} of {pod_key} was OOMKilled\n\n")
+                self.__loop.call_soon_threadsafe(self.__schedule, loki, self.__memory_limit(pod, status['name']))
+
+    def __schedule(self, loki, memory):
+        known = self.__memory.get(loki)
+        if memory is not None and (known is None or quantity.compare(memory, known) > 0):
+            self.__memory[loki] = memory
+
+        # A resize is already scheduled to this Loki
+        if loki in self.__scheduled:
+            return
+        self.__scheduled[loki] = self.__loop.call_later(
+            self.debounce, lambda: asyncio.ensure_future(self.__resize(loki))
+        )
+
+    async def __resize(self, loki):
+        namespace, name = loki.split('/')
+        memory = self.__memory.pop(loki, None)
+        try:
+            await self.resize_fn(name=name, namespace=namespace, memory=memory)
+        except Exception as e:
+            logging.error(f"\n\n\tResize of {loki} failed: {e}\n\n")
+        finally:
+            self.__scheduled.pop(loki, None)
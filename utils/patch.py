@@ -0,0 +1,57 @@
+import json
+from .asyncApi import run
+from .metrics import observe
+from . import retry
+
+# Stable field manager of every write made by the operator
+FIELD_MANAGER = 'loki-operator'
+
+
+def patch_size(patch) -> int:
+    """ Bytes of the patch on the wire """
+    return len(json.dumps(patch, separators=(',', ':')))
+
+
+async def server_side_apply(api_client, path, body, force=True):
+    """ Send a server-side apply of the full desired object under the operator field manager.
+    The fields applied before and missing from body are removed, so body must never be partial
+    :param api_client: The kubernetes ApiClient
+    :param path: The object path, e.g. /apis/apps/v1/namespaces/<namespace>/statefulsets/<name>
+    :param body: The full desired object, with apiVersion and kind
+    :param force: Take the ownership of fields managed by other managers
+    """
+    query_params = [('fieldManager', FIELD_MANAGER)]
+    if force:
+        query_params.append(('force', 'true'))
+
+    response = await retry.call(lambda: run(
+        observe,
+        'apply',
+        path.split('/')[-2],
+        api_client.call_api,
+        path,
+        'PATCH',
+        query_params=query_params,
+        header_params={'Content-Type': 'application/apply-patch+yaml', 'Accept': 'application/json'},
+        body=json.dumps(body),  # JSON is valid YAML
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True,
+        _preload_content=False
+    ))
+    return json.loads(response.data)
+
+
+def stateful_set_path(name, namespace) -> str:
+    return f'/apis/apps/v1/namespaces/{namespace}/statefulsets/{name}'
+
+
+def config_map_path(name, namespace) -> str:
+    return f'/api/v1/namespaces/{namespace}/configmaps/{name}'
+
+
+def deployment_path(name, namespace) -> str:
+    return f'/apis/apps/v1/namespaces/{namespace}/deployments/{name}'
+
+
+def service_path(name, namespace) -> str:
+    return f'/api/v1/namespaces/{namespace}/services/{name}'
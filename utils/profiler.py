@@ -0,0 +1,166 @@
+import os
+import re
+import sys
+import json
+import time
+import types
+import asyncio
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+# Seconds profiled after each toggle, when not stopped before
+PROFILE_WINDOW = float(os.environ.get('LOKI_OPERATOR_PROFILE_WINDOW', '30'))
+
+# Directory of the collapsed stacks and summaries
+PROFILE_DIR = os.environ.get('LOKI_OPERATOR_PROFILE_DIR', tempfile.gettempdir())
+
+# The executor threads are named <prefix>_<index>, one stack per pool is enough
+_THREAD_INDEX = re.compile(r'_\d+$')
+
+
+@types.coroutine
+def _stepped(coro, cpu):
+    """ Drive a coroutine step by step, adding to cpu[0] the CPU time of its own steps only,
+    not the one of the other tasks run by the loop while it waits """
+    value, error = None, None
+    while True:
+        start = time.thread_time()
+        try:
+            yielded = coro.send(value) if error is None else coro.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            cpu[0] += time.thread_time() - start
+
+        try:
+            value, error = (yield yielded), None
+        except BaseException as e:
+            value, error = None, e
+
+
+class Profiler:
+    def __init__(self, interval=0.01, lag_interval=0.1, output_dir=PROFILE_DIR):
+        """ Sampling profiler toggled at runtime. Idle, it costs one attribute check per handler call
+        :param interval: Seconds between two stack samples of every thread
+        :param lag_interval: Seconds between two event loop lag probes
+        :param output_dir: Directory of the collapsed stacks (.folded) and summaries (.json)
+        """
+
+        self.interval = interval
+        self.lag_interval = lag_interval
+        self.output_dir = output_dir
+        self.active = False
+
+        self.stacks = Counter()
+        self.handlers = dict()  # Calls, wall and CPU seconds per handler
+        self.lags = list()
+
+        self.__started = 0.0
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__lag_task = None
+        self.__timer = None
+
+    def toggle(self, window=PROFILE_WINDOW):
+        """ Start a profiling window, or stop the running one. Called on the event loop, e.g. on SIGUSR2 """
+        if self.active:
+            self.stop()
+        else:
+            self.start(window)
+
+    def start(self, window=PROFILE_WINDOW):
+        """ Profile for window seconds. Must be called on the event loop """
+        if self.active:
+            return
+
+        loop = asyncio.get_event_loop()
+        self.stacks, self.handlers, self.lags = Counter(), dict(), list()
+        self.__started = time.time()
+        self.__stop.clear()
+        self.active = True
+
+        self.__thread = threading.Thread(target=self.__sample, name='profiler', daemon=True)
+        self.__thread.start()
+        self.__lag_task = loop.create_task(self.__probe_lag(loop))
+        self.__timer = loop.call_later(window, self.stop)
+        logging.info(f"\n\n\tProfiling for {window}s\n\n")
+
+    def stop(self):
+        """ Stop the window and write its results, returning the paths written """
+        if not self.active:
+            return None
+
+        self.active = False
+        self.__stop.set()
+        self.__thread.join()
+        self.__lag_task.cancel()
+        self.__timer.cancel()
+
+        name = f"loki-operator-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.__started))}"
+        folded = os.path.join(self.output_dir, f'{name}.folded')
+        summary = os.path.join(self.output_dir, f'{name}.json')
+
+        with open(folded, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+        with open(summary, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+        logging.info(f"\n\n\tProfile written to {folded} and {summary}\n\n")
+        return folded, summary
+
+    def summary(self) -> dict:
+        lags = sorted(self.lags)
+
+        def lag(q):
+            return lags[min(len(lags) - 1, int(q * len(lags)))] if lags else None
+
+        return {
+            'seconds': time.time() - self.__started,
+            'samples': sum(self.stacks.values()),
+            'loop_lag_seconds': {'p50': lag(0.5), 'p99': lag(0.99), 'max': lags[-1] if lags else None},
+            # Off CPU: awaiting the API threads, the network or the other tasks of the loop
+            'handlers': {
+                handler: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu, 'off_cpu_seconds': wall - cpu}
+                for handler, (calls, wall, cpu) in sorted(self.handlers.items(), key=lambda item: -item[1][1])
+            }
+        }
+
+    async def measure(self, handler, coro):
+        """ Await a handler coroutine, adding its wall and CPU time to the handler stats """
+        cpu = [0.0]
+        start = time.perf_counter()
+        try:
+            return await _stepped(coro, cpu)
+        finally:
+            calls, wall, cpu_total = self.handlers.get(handler, (0, 0.0, 0.0))
+            self.handlers[handler] = (calls + 1, wall + time.perf_counter() - start, cpu_total + cpu[0])
+
+    # Sampling thread: one collapsed stack per thread and interval
+    def __sample(self):
+        own = threading.get_ident()
+        while not self.__stop.wait(self.interval):
+            names = {thread.ident: _THREAD_INDEX.sub('', thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    async def __probe_lag(self, loop):
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lags.append(loop.time() - start - self.lag_interval)
+
+
+profiler = Profiler()
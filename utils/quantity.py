@@ -0,0 +1,153 @@
+import re
+import math
+from fractions import Fraction
+
+# Kubernetes resource quantities: <signedNumber><suffix>, the suffix being binary, decimal or an exponent
+_QUANTITY = re.compile(r'^([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))(?:([eE][+-]?[0-9]+)|([a-zA-Z]*))$')
+
+_BINARY = {
+    'Ki': Fraction(2 ** 10), 'Mi': Fraction(2 ** 20), 'Gi': Fraction(2 ** 30),
+    'Ti': Fraction(2 ** 40), 'Pi': Fraction(2 ** 50), 'Ei': Fraction(2 ** 60)
+}
+_DECIMAL = {
+    'n': Fraction(1, 10 ** 9), 'u': Fraction(1, 10 ** 6), 'm': Fraction(1, 10 ** 3), '': Fraction(1),
+    'k': Fraction(10 ** 3), 'M': Fraction(10 ** 6), 'G': Fraction(10 ** 9),
+    'T': Fraction(10 ** 12), 'P': Fraction(10 ** 15), 'E': Fraction(10 ** 18)
+}
+
+# Suffixes tried by the canonical serialization, from the largest, as integer multipliers.
+# The decimal ones are counted in nano units, so every multiplier is an integer
+_BINARY_ORDER = sorted(((suffix, int(value)) for suffix, value in _BINARY.items()), key=lambda item: -item[1])
+_DECIMAL_ORDER = sorted(((suffix, int(value * 10 ** 9)) for suffix, value in _DECIMAL.items()),
+                        key=lambda item: -item[1])
+
+_cache = dict()
+
+
+class QuantityError(ValueError):
+    pass
+
+
+def parse(quantity) -> Fraction:
+    """ Parse a Kubernetes quantity (e.g. 512Mi, 1.5G, 500m, 1e3, 12345n) to an exact Fraction of base units """
+    if isinstance(quantity, Fraction):
+        return quantity
+    if isinstance(quantity, int):
+        return Fraction(quantity)
+
+    text = str(quantity).strip()
+    value = _cache.get(text)
+    if value is not None:
+        return value
+
+    match = _QUANTITY.match(text)
+    if match is None:
+        raise QuantityError(f'Invalid quantity: {quantity!r}')
+
+    number, exponent, suffix = match.groups()
+    if exponent is not None:
+        multiplier = Fraction(10) ** int(exponent[1:])
+    elif suffix in _BINARY:
+        multiplier = _BINARY[suffix]
+    elif suffix in _DECIMAL:
+        multiplier = _DECIMAL[suffix]
+    else:
+        raise QuantityError(f'Invalid quantity suffix: {quantity!r}')
+
+    value = Fraction(number) * multiplier
+    if len(_cache) < 4096:
+        _cache[text] = value
+    return value
+
+
+def _format(number, suffixes) -> str:
+    for suffix, multiplier in suffixes:
+        if number % multiplier == 0:
+            return f'{number // multiplier}{suffix}'
+    return None
+
+
+def serialize(value, binary=None) -> str:
+    """ Return the canonical representation of a quantity: the largest suffix keeping an integer number
+    :param value: A Fraction of base units, or a quantity string
+    :param binary: Prefer the binary suffixes (Ki, Mi...). Default: the shortest representation
+    """
+    value = parse(value)
+    if value == 0:
+        return '0'
+
+    # Below 1n the value is rounded up to the next nano unit
+    nanos = math.ceil(value * 10 ** 9)
+    decimal_formatted = _format(nanos, _DECIMAL_ORDER)
+
+    binary_formatted = None
+    if binary is not False and value.denominator == 1:
+        binary_formatted = _format(value.numerator, _BINARY_ORDER)
+
+    if binary_formatted is not None and (binary or len(binary_formatted) <= len(decimal_formatted)):
+        return binary_formatted
+    return decimal_formatted
+
+
+def compare(a, b) -> int:
+    """ Return -1, 0 or 1 as a is smaller, equal or bigger than b """
+    a, b = parse(a), parse(b)
+    return (a > b) - (a < b)
+
+
+def equal(a, b) -> bool:
+    return parse(a) == parse(b)
+
+
+def scale(quantity, factor, round_to=None) -> str:
+    """ Multiply a quantity, keeping the binary or decimal notation of the input
+    :param quantity: The quantity to scale
+    :param factor: The multiplier, int, float or Fraction
+    :param round_to: Quantity the result is rounded up to (e.g. 1Mi)
+    """
+    # Floats go through their repr, so 1.2 is exactly 6/5
+    value = parse(quantity) * (Fraction(repr(factor)) if isinstance(factor, float) else Fraction(factor))
+    if round_to is not None:
+        step = parse(round_to)
+        value = math.ceil(value / step) * step
+
+    text = str(quantity)
+    return serialize(value, binary=text.endswith('i') or None)
+
+
+def add(a, b) -> Fraction:
+    return parse(a) + parse(b)
+
+
+# Batch API over whole resource dicts ({'limits': {'cpu': ..., 'memory': ...}, 'requests': {...}})
+
+def parse_resources(resources) -> dict:
+    """ Parse every quantity of a resources dict """
+    return {
+        section: {name: parse(value) for name, value in (values or {}).items()}
+        for section, values in (resources or {}).items()
+    }
+
+
+def serialize_resources(resources) -> dict:
+    """ Return the canonical representation of every quantity of a resources dict """
+    return {
+        section: {name: serialize(value) for name, value in (values or {}).items()}
+        for section, values in (resources or {}).items()
+    }
+
+
+def resources_equal(a, b) -> bool:
+    """ Compare two resources dicts numerically, 1Gi being equal to 1024Mi """
+    return parse_resources(a) == parse_resources(b)
+
+
+def resources_diff(current, desired) -> dict:
+    """ Return the desired quantities numerically different from the current ones, per section """
+    current = parse_resources(current)
+    diff = dict()
+    for section, values in (desired or {}).items():
+        for name, value in (values or {}).items():
+            if current.get(section, {}).get(name) != parse(value):
+                diff.setdefault(section, dict())[name] = value
+    return diff
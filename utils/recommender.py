@@ -0,0 +1,205 @@
+import time
+import asyncio
+import logging
+from array import array
+from fractions import Fraction
+from kubernetes import client
+from . import quantity
+from .asyncApi import AsyncApi
+from .informer import MANAGED_BY_SELECTOR, read
+from .metrics import VPA_ACTIONS
+
+# Recommendations are rounded up to these steps
+_ROUND_TO = {'cpu': '1m', 'memory': '1Mi'}
+
+
+class RingBuffer:
+    __slots__ = ('values', 'times', 'head', 'count')
+
+    def __init__(self, size):
+        """ Fixed-size, array-backed buffer of timestamped samples """
+        self.values = array('d', bytes(8 * size))
+        self.times = array('d', bytes(8 * size))
+        self.head = 0
+        self.count = 0
+
+    def push(self, value, timestamp):
+        self.values[self.head] = value
+        self.times[self.head] = timestamp
+        self.head = (self.head + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def last(self) -> float:
+        return self.times[(self.head - 1) % len(self.values)] if self.count else 0.0
+
+    def percentile(self, q, half_life, now) -> float:
+        """ Weighted percentile of the samples, the weight of a sample halves every half_life seconds """
+        samples = sorted(
+            (self.values[index], 0.5 ** ((now - self.times[index]) / half_life))
+            for index in range(self.count)
+        )
+        total = sum(weight for _, weight in samples)
+
+        accumulated = 0.0
+        for value, weight in samples:
+            accumulated += weight
+            if accumulated >= q * total:
+                return value
+        return samples[-1][0]
+
+
+async def metrics_api_source():
+    """ Return the PodMetrics of the Loki Pods from the metrics.k8s.io API """
+    api = AsyncApi(client.CustomObjectsApi)
+    metrics = await api.list_cluster_custom_object(
+        group='metrics.k8s.io',
+        version='v1beta1',
+        plural='pods',
+        label_selector=MANAGED_BY_SELECTOR
+    )
+    return metrics['items']
+
+
+class Recommender:
+    def __init__(self,
+                 source=metrics_api_source,
+                 window=720,
+                 min_samples=12,
+                 cpu_percentile=0.9,
+                 memory_percentile=0.95,
+                 half_life=6 * 3600.0,
+                 margin=0.15,
+                 hysteresis=0.1,
+                 owns=None):
+        """ Recommend the Loki resources from the usage history of its containers
+        :param source: Coroutine function returning a list of PodMetrics, as the metrics.k8s.io API
+        :param window: Number of samples kept per container
+        :param min_samples: Number of samples needed before the first recommendation
+        :param cpu_percentile: The cpu usage percentile used as request
+        :param memory_percentile: The memory usage percentile used as request
+        :param half_life: Seconds for the weight of a sample to halve
+        :param margin: Safety margin added over the percentiles
+        :param hysteresis: Min relative change of a value to apply a recommendation
+        :param owns: Function called as owns(name=, namespace=), only the Lokis it accepts are patched
+        """
+
+        self.source = source
+        self.window = window
+        self.min_samples = min_samples
+        self.percentiles = {'cpu': cpu_percentile, 'memory': memory_percentile}
+        self.half_life = half_life
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.owns = owns
+
+        self.api = AsyncApi(client.CustomObjectsApi)
+        self.buffers = dict()  # RingBuffer per Loki, container and resource
+
+    @staticmethod
+    def __loki(pod_name) -> str:
+        """ The StatefulSet Pods are named <loki>-<ordinal> """
+        return pod_name.rsplit('-', 1)[0]
+
+    def sample(self, pods_metrics, now=None):
+        """ Store the usage of every container of the PodMetrics list """
+        now = time.time() if now is None else now
+
+        for pod in pods_metrics:
+            loki = f"{pod['metadata']['namespace']}/{self.__loki(pod['metadata']['name'])}"
+            for container in pod['containers']:
+                for resource in ('cpu', 'memory'):
+                    key = (loki, container['name'], resource)
+                    if key not in self.buffers:
+                        self.buffers[key] = RingBuffer(self.window)
+                    self.buffers[key].push(float(quantity.parse(container['usage'][resource])), now)
+
+        # Drop the containers without samples for four half-lives, e.g. deleted Lokis
+        stale = [key for key, buffer in self.buffers.items() if buffer.last() < now - self.half_life * 4]
+        for key in stale:
+            self.buffers.pop(key)
+
+    def recommend(self, loki, container, current, now=None):
+        """ Return the recommended resources of a container, or None when it should not change
+        :param loki: The Loki key as namespace/name
+        :param container: The container name
+        :param current: The current spec.resources of the Loki
+        """
+        now = time.time() if now is None else now
+        recommended = {'requests': dict(current.get('requests') or {}), 'limits': dict(current.get('limits') or {})}
+        changed = False
+
+        for resource, q in self.percentiles.items():
+            buffer = self.buffers.get((loki, container, resource))
+            if buffer is None or buffer.count < self.min_samples:
+                continue
+
+            request = Fraction(repr(buffer.percentile(q, self.half_life, now))) * Fraction(repr(1 + self.margin))
+            current_request = quantity.parse(recommended['requests'].get(resource, 0))
+            current_limit = recommended['limits'].get(resource)
+
+            # Hysteresis: ignore the small changes in both directions
+            if current_request and abs(request - current_request) / current_request < self.hysteresis:
+                continue
+
+            # Keep the limit/request ratio of the current resources
+            ratio = quantity.parse(current_limit) / current_request if current_limit and current_request else None
+
+            recommended['requests'][resource] = quantity.scale(request, 1, round_to=_ROUND_TO[resource])
+            if ratio is not None:
+                recommended['limits'][resource] = quantity.scale(request * ratio, 1, round_to=_ROUND_TO[resource])
+            changed = True
+
+        return recommended if changed else None
+
+    async def __loki_resources(self, namespace, name):
+        async def fallback():
+            return await self.api.get_namespaced_custom_object(
+                group='jack.experts',
+                version='v1',
+                namespace=namespace,
+                plural='lokis',
+                name=name
+            )
+
+        loki = await read('lokis', namespace, name, fallback)
+        return loki['spec']['resources'] if loki is not None else None
+
+    async def run_once(self):
+        """ Sample the usage and apply the recommendations """
+        self.sample(await self.source())
+
+        for loki in sorted({key[0] for key in self.buffers}):
+            namespace, name = loki.split('/')
+            if self.owns is not None and not self.owns(name=name, namespace=namespace):
+                continue
+
+            current = await self.__loki_resources(namespace, name)
+            if current is None:
+                continue
+
+            # The Loki container is named as the Loki
+            recommended = self.recommend(loki, name, current)
+            if recommended is None:
+                continue
+
+            # The Loki spec is the desired state: resources_change applies it through utils.resources.update
+            await self.api.patch_namespaced_custom_object(
+                group='jack.experts',
+                version='v1',
+                namespace=namespace,
+                plural='lokis',
+                name=name,
+                body={'spec': {'resources': recommended}}
+            )
+            VPA_ACTIONS.labels(action='recommendation').inc()
+            logging.info(f"\n\n\tRecommended resources of {loki}: {recommended}\n\n")
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"\n\n\tRecommender failed: {e}\n\n")
+            await asyncio.sleep(interval)
@@ -1,142 +1,392 @@
 
-import re
+import json
+import asyncio
 import logging
-from kubernetes import config, client
-from .k8sControllers.lokiSf import LokiSf
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+from . import quantity
+from .asyncApi import AsyncApi
+from .informer import get_informer, read
+from .patch import FIELD_MANAGER
+from .retry import retryable
+from .metrics import RECONCILES
+from .normalize import normalizer
+from .rollout import rollout_step
+from .k8sControllers.lokiSf import LokiSf, SPEC_HASH_ANNOTATION, pod_management_policy
+from .k8sControllers.lokiConfig import config_profile, shared_state
 
 
 class Reconciliation:
-    def __init__(self, cr_group, cr_version, cr_plural):
+    def __init__(self, cr_group, cr_version, cr_plural, rules=('logs-alert',), flavor='rancher', api_client=None,
+                 checkpoint=None, ensure_rules=None):
         """ Run the reconciliation for Loki Resources
         :param cr_group: The CustomResource Group
         :param cr_version: The CustomResource Version
         :param cr_plural: The CustomResource Plural Name
+        :param rules: The names of the LogAlert rules ConfigMap shards
+        :param flavor: The cluster flavor selecting the fields ignored by the diff (vanilla, rancher, openshift)
+        :param api_client: The kubernetes ApiClient, the process-wide one by default
+        :param checkpoint: The Checkpoint keeping the verified generations across restarts
+        :param ensure_rules: Coroutine function creating the rules ConfigMap shards, awaited before a missing
+                             StatefulSet is created
         """
 
         self.sts_queue = list()
+        # Generation of each StatefulSet last found in sync, so a restart does not diff them all again
+        self.verified_generation = checkpoint.section('verified_generation') if checkpoint is not None else dict()
         self.cr_group = cr_group
         self.cr_version = cr_version
         self.cr_plural = cr_plural
+        self.rules = tuple(rules)
+        self.ensure_rules = ensure_rules
+        self.normalize = normalizer(flavor)
+        self.storage_warned = dict()  # Storage change already reported as impossible, per Loki
+        self.config_applied = dict()  # Hash of the Loki config last applied by this process, per Loki
+        self.cache_generation = dict()  # Generation of each cache Deployment last found in sync
 
-        self.custom_resources_api = client.CustomObjectsApi()
-        self.apps_api = client.AppsV1Api()
-        self.core_api = client.CoreV1Api()
-        config.load_incluster_config()
-        # config.load_kube_config('/lixo/kubernetes/jac/kubeconfig-production.yaml')
+        self.api_client = api_client
+        self.custom_resources_api = AsyncApi(client.CustomObjectsApi, api_client)
+        self.apps_api = AsyncApi(client.AppsV1Api, api_client)
+        self.core_api = AsyncApi(client.CoreV1Api, api_client)
 
-    def __get_crds(self):
+    async def __get_crds(self):
         """ Get Loki CRDs from all namespaces """
 
         crds = dict()
-        _crds = self.custom_resources_api.list_cluster_custom_object(
-            group=self.cr_group,
-            plural=self.cr_plural,
-            version=self.cr_version
-        )
+        informer = get_informer(self.cr_plural)
+        if informer is not None:
+            items = informer.list()
+        else:
+            items, _ = await self.custom_resources_api.list_all(
+                'list_cluster_custom_object',
+                group=self.cr_group,
+                plural=self.cr_plural,
+                version=self.cr_version
+            )
 
-        for item in _crds['items']:
-            crds[item['metadata']['name']+'/'+item['metadata']['namespace']] = item
+        for item in items:
+            crds[item['metadata']['namespace']+'/'+item['metadata']['name']] = item
 
         return crds
 
-    def __get_stateful_set(self, name, namespace):
+    async def __get_stateful_set(self, name, namespace):
         """ Get Loki StatefulSet representation """
-        stateful_set = self.apps_api.read_namespaced_stateful_set(
-            name=name,
-            namespace=namespace
+        async def fallback():
+            try:
+                stateful_set = await self.apps_api.read_namespaced_stateful_set(
+                    name=name,
+                    namespace=namespace
+                )
+            except ApiException as e:
+                if e.status == 404:
+                    return None
+                raise
+            return self.core_api.api_client.sanitize_for_serialization(stateful_set)
+
+        # The cached object is shared, callers must copy it before any change
+        return await read('statefulsets', namespace, name, fallback, miss=True)
+
+    @staticmethod
+    def __live_hash(statefulset):
+        """ Return the spec hash stamped by LokiSf on the live StatefulSet """
+        annotations = statefulset['metadata'].get('annotations') or {}
+        return annotations.get(SPEC_HASH_ANNOTATION)
+
+    async def __structural_diff(self, lk, live_sts) -> set:
+        """ Compare the live StatefulSet with a dry-run of the desired one
+        :param lk: The LokiSf rendered under the real Loki name: the config volume, the config hash and the owner
+                   derive from it
+        :return: The fields differing, e.g. metadata or spec.template, an empty set when in sync
+        """
+        name = lk.name
+
+        # The normalized view shares the unchanged fields with the cached object
+        old_sts = self.normalize(live_sts)
+
+        # Only the object name changes, a dry-run create of the live name would be an AlreadyExists.
+        # The rendered manifest is shared, so the body is a shallow copy
+        manifest = lk.manifest()
+        body = dict(manifest, metadata=dict(manifest['metadata'], name=f"{name}-new"))
+        response = await self.apps_api.create_namespaced_stateful_set(
+            namespace=lk.namespace,
+            body=body,
+            dry_run='All',
+            _preload_content=False
         )
 
-        json_stateful_set = self.core_api.api_client.sanitize_for_serialization(stateful_set)
+        new_sts_json = json.loads(response.data)
+        new_sts_json['metadata']['name'] = name
 
-        return json_stateful_set
+        new_sts = self.normalize(new_sts_json)
+        if new_sts == old_sts:
+            return set()
 
-    @staticmethod
-    def __clear_defaults_field_sts(statefulset):
-        """ Clear de Default Fields from Statefulset """
-        metadata_fields = ['creationTimestamp',
-                           'selfLink',
-                           'uid',
-                           'resourceVersion',
-                           'managedFields']
-
-        # Find and remove default cattle annotations
-        if 'annotations' in statefulset['spec']['template']['metadata']:
-            pattern_annotation = ".*cattle*."
-            pattern = re.compile(pattern_annotation)
-            discard_annotation = [
-                key for key, value in statefulset['spec']['template']['metadata']['annotations'].items()
-                if pattern.match(key)
-            ]
-
-            for annotation in discard_annotation:
-                statefulset['spec']['template']['metadata']['annotations'].pop(annotation)
-
-            # Verify if annotations have more inside fields
-            if not bool(statefulset['spec']['template']['metadata']['annotations']):
-                statefulset['spec']['template']['metadata'].pop('annotations')  # If not, delete the annotations field
-
-        # Remove metadata fields
-        for field in metadata_fields:
-            if field in statefulset['metadata'].keys():
-                statefulset['metadata'].pop(field)
-
-        if 'securityContext' in statefulset['spec']['template']['spec']['containers'][0]:
-            if not bool(statefulset['spec']['template']['spec']['containers'][0]['securityContext']['capabilities']):
-                statefulset['spec']['template']['spec']['containers'][0].pop('securityContext')
-
-        statefulset.pop('status')
-
-        return statefulset
-
-    def compare_resources(self):
-        """ Get Loki StatefulSet from all namespaces """
-
-        lk_crd = self.__get_crds()
-        for item, value in lk_crd.items():
-            name, namespace = item.split('/')
-
-            old_sts = self.__clear_defaults_field_sts(self.__get_stateful_set(name=name, namespace=namespace))
-
-            lk = LokiSf(
-                lk_name=f"{value['metadata']['name']}-new",
-                lk_namespace=value['metadata']['namespace'],
-                lk_image=value['spec']['image'],
-                lk_requests=value['spec']['resources']['requests'],
-                lk_limits=value['spec']['resources']['limits'],
-                lk_labels=value['metadata']['labels'],
-                lk_storage=value['spec']['storage'],
-                lk_uid=value['metadata']['uid']
-            )
+        new_spec, old_spec = new_sts.get('spec') or {}, old_sts.get('spec') or {}
+        changed = {field for field in set(new_sts) | set(old_sts) if field != 'spec' and
+                   new_sts.get(field) != old_sts.get(field)}
+        return changed | {f'spec.{field}' for field in set(new_spec) | set(old_spec) if
+                          new_spec.get(field) != old_spec.get(field)}
 
-            new_sts = lk.stateful_set()
+    async def __get_crd(self, name, namespace):
+        """ Get a Loki CRD """
+        async def fallback():
+            try:
+                return await self.custom_resources_api.get_namespaced_custom_object(
+                    group=self.cr_group,
+                    version=self.cr_version,
+                    namespace=namespace,
+                    plural=self.cr_plural,
+                    name=name
+                )
+            except ApiException as e:
+                if e.status == 404:
+                    return None
+                raise
 
-            dry_run = self.apps_api.create_namespaced_stateful_set(
-                namespace=namespace,
-                body=new_sts,
-                dry_run='All'
-            )
+        return await read(self.cr_plural, namespace, name, fallback)
+
+    async def __recreate(self, lk, timeout=30.0):
+        """ Recreate a StatefulSet to change an immutable field. Its Pods are orphaned, not deleted,
+        and adopted back by the new StatefulSet """
+        await self.apps_api.delete_namespaced_stateful_set(
+            name=lk.name,
+            namespace=lk.namespace,
+            body=client.V1DeleteOptions(propagation_policy='Orphan')
+        )
+
+        # The orphan finalizer runs before the StatefulSet is gone, an apply before would patch the old one
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            try:
+                await self.apps_api.read_namespaced_stateful_set(name=lk.name, namespace=lk.namespace)
+            except ApiException as e:
+                if e.status == 404:
+                    break
+                raise
+            await asyncio.sleep(0.5)
+
+        await lk.create()
+        logging.info(f"\n\n\tStatefulSet {lk.namespace}/{lk.name} recreated with the {lk.pod_management_policy} "
+                     f"pod management policy\n\n")
+
+    async def __resize_storage(self, item, lk, live_sts) -> bool:
+        """ Bring the data volumes to spec.storage. The claim templates are immutable, so the PVCs are expanded
+        online, without restarting the Pods, then the StatefulSet is recreated with the new template
+        :return: True when the StatefulSet was recreated
+        """
+
+        templates = live_sts['spec'].get('volumeClaimTemplates') or []
+        live_claim = next((claim for claim in templates if claim['metadata']['name'] == 'data'), None)
+        if live_claim is None:
+            # Created with the emptyDir data volume of the previous versions
+            await self.__recreate(lk)
+            return True
+
+        live_storage = live_claim['spec']['resources']['requests']['storage']
+        live_class = live_claim['spec'].get('storageClassName')
+        resize = quantity.compare(lk.storage, live_storage)
+        if resize == 0 and lk.storage_class in (None, live_class):
+            self.storage_warned.pop(item, None)
+            return False
+
+        if resize < 0 or lk.storage_class not in (None, live_class):
+            if self.storage_warned.get(item) != (lk.storage, lk.storage_class):
+                self.storage_warned[item] = (lk.storage, lk.storage_class)
+                logging.warning(f"\n\n\tThe data volumes of {item} cannot shrink nor change of StorageClass, "
+                                f"kept at {live_storage} on {live_class}\n\n")
+            return False
+
+        selector = ','.join(f'{key}={value}' for key, value in sorted(lk.labels.items()))
+        claims, _ = await self.core_api.list_all(
+            'list_namespaced_persistent_volume_claim',
+            namespace=lk.namespace,
+            label_selector=selector
+        )
+
+        prefix = f'data-{lk.name}-'
+        for claim in claims:
+            claim_name = claim['metadata']['name']
+            if not (claim_name.startswith(prefix) and claim_name[len(prefix):].isdigit()):
+                continue
+            if quantity.compare(claim['spec']['resources']['requests']['storage'], lk.storage) >= 0:
+                continue
+
+            try:
+                await self.core_api.patch_namespaced_persistent_volume_claim(
+                    name=claim_name,
+                    namespace=lk.namespace,
+                    body={'spec': {'resources': {'requests': {'storage': lk.storage}}}},
+                    field_manager=FIELD_MANAGER
+                )
+            except ApiException as e:
+                if retryable(e):
+                    raise
+                # E.g. a StorageClass without allowVolumeExpansion: keep the StatefulSet matching its volumes
+                logging.error(f"\n\n\tPVC {lk.namespace}/{claim_name} not expanded: {e.status} {e.reason}\n\n")
+                return False
+            logging.info(f"\n\n\tPVC {lk.namespace}/{claim_name} expanded to {lk.storage}\n\n")
+
+        # The new replicas get the new size
+        await self.__recreate(lk)
+        return True
+
+    async def __reconcile_cache(self, item, lk):
+        """ Bring the cache Deployment of a Loki to spec.cache with the StatefulSet drift logic: spec hash first,
+        then a minimal patch. The cache is deleted once spec.cache is removed """
+        namespace, name = item.split('/')
+        cache_name = f'{name}-cache'
+        informer = get_informer('deployments')
+
+        if lk.cache is None:
+            self.cache_generation.pop(item, None)
+            # Without the cache, looking for a leftover would cost a read per reconciliation
+            if informer is None or informer.get(namespace, cache_name) is None:
+                return
+            for delete in (self.apps_api.delete_namespaced_deployment, self.core_api.delete_namespaced_service):
+                try:
+                    await delete(name=cache_name, namespace=namespace)
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+            logging.info(f"\n\n\tCache {namespace}/{cache_name} deleted\n\n")
+            return
+
+        async def fallback():
+            try:
+                deployment = await self.apps_api.read_namespaced_deployment(name=cache_name, namespace=namespace)
+            except ApiException as e:
+                if e.status == 404:
+                    return None
+                raise
+            return self.core_api.api_client.sanitize_for_serialization(deployment)
+
+        live = await read('deployments', namespace, cache_name, fallback)
+        if live is None:
+            await lk.cache.apply()
+            logging.info(f"\n\n\tCache {namespace}/{cache_name} created\n\n")
+            return
+
+        generation = live['metadata'].get('generation')
+        if self.__live_hash(live) == lk.cache.spec_hash() and self.cache_generation.get(item) == generation:
+            return
+
+        # The full desired objects, so the fields dropped from spec.cache are removed. A no-op when in sync
+        applied = await lk.cache.apply()
+        self.cache_generation[item] = applied['metadata'].get('generation')
+        if self.cache_generation[item] != generation:
+            logging.info(f"\n\n\tCache {namespace}/{cache_name} brought to the Loki spec\n\n")
+
+    async def reconcile(self, key) -> bool:
+        """ Compare the StatefulSet of one Loki with its desired state
+        :param key: The Loki key as namespace/name
+        :return: True when the StatefulSet is in sync
+        """
+
+        namespace, name = key.split('/')
+        value = await self.__get_crd(name=name, namespace=namespace)
+        if value is None:
+            self.verified_generation.pop(key, None)
+            self.config_applied.pop(key, None)
+            self.cache_generation.pop(key, None)
+            return True
+
+        return await self.__reconcile_cr(key, value)
+
+    async def compare_resources(self) -> dict:
+        """ Compare the Loki StatefulSets from all namespaces, returning if each one is in sync """
+
+        lk_crd = await self.__get_crds()
+        return {item: await self.__reconcile_cr(item, value) for item, value in lk_crd.items()}
+
+    async def __reconcile_cr(self, item, value) -> bool:
+        namespace, name = item.split('/')
+
+        live_sts = await self.__get_stateful_set(name=name, namespace=namespace)
+        lk = LokiSf(
+            lk_name=name,
+            lk_namespace=namespace,
+            lk_image=value['spec']['image'],
+            lk_requests=value['spec']['resources']['requests'],
+            lk_limits=value['spec']['resources']['limits'],
+            lk_labels=value['metadata']['labels'],
+            lk_storage=value['spec']['storage'],
+            lk_uid=value['metadata']['uid'],
+            lk_replicas=value['spec']['replicas'],
+            lk_rules=self.rules,
+            lk_pod_management_policy=pod_management_policy(value['spec'], live_sts),
+            lk_storage_class=value['spec'].get('storageClassName'),
+            lk_config_profile=config_profile(value['spec']),
+            lk_cache=value['spec'].get('cache'),
+            lk_shared_state=shared_state(value['spec']),
+            lk_api_client=self.api_client
+        )
+
+        if live_sts is None:
+            RECONCILES.labels(result='missing').inc()
+            # Its StatefulSet is garbage collected with the Loki
+            if value['metadata'].get('deletionTimestamp'):
+                return True
+
+            # The create event was missed, e.g. while the Loki was handed over between two operator replicas
+            logging.info(f"\n\n\tStatefulSet {namespace}/{name} not found, creating it\n\n")
+            if self.ensure_rules is not None:
+                await self.ensure_rules()
+            await lk.create()
+            self.config_applied[item] = lk.config.config_hash()
+            return False
+
+        # The pod management policy and the claim templates cannot be patched. The policy only differs when
+        # spec.podManagementPolicy was set to another one
+        if live_sts['spec'].get('podManagementPolicy', 'OrderedReady') != lk.pod_management_policy:
+            await self.__recreate(lk)
+            recreated = True
+        else:
+            recreated = await self.__resize_storage(item, lk, live_sts)
+        if recreated:
+            self.verified_generation.pop(item, None)
+            self.config_applied[item] = lk.config.config_hash()
+            RECONCILES.labels(result='drift').inc()
+            return False
+
+        await self.__reconcile_cache(item, lk)
+
+        # Once per config change and per process: the apply is a no-op when the ConfigMap is up to date
+        if self.config_applied.get(item) != lk.config.config_hash():
+            await lk.config.apply()
+            self.config_applied[item] = lk.config.config_hash()
+
+        desired_hash = lk.spec_hash()
+        generation = live_sts['metadata'].get('generation')
+
+        # Same hash and no edit since the last check: nothing to compare
+        if self.__live_hash(live_sts) == desired_hash and self.verified_generation.get(item) == generation:
+            RECONCILES.labels(result='hash').inc()
+            return True
+
+        # The hash differs or the StatefulSet was edited out of band
+        changed = await self.__structural_diff(lk, live_sts)
+        in_sync = not changed
+        if in_sync:
+            RECONCILES.labels(result='in_sync').inc()
+            self.verified_generation[item] = generation
+            if self.__live_hash(live_sts) != desired_hash:
+                # Stamp the current hash, an annotation change does not bump the generation
+                await self.apps_api.patch_namespaced_stateful_set(
+                    name=name,
+                    namespace=namespace,
+                    body={'metadata': {'annotations': {SPEC_HASH_ANNOTATION: desired_hash}}},
+                    field_manager=FIELD_MANAGER
+                )
+        else:
+            self.verified_generation.pop(item, None)
+            RECONCILES.labels(result='drift').inc()
+            logging.info(f"\n\n\tStatefulSet {namespace}/{name} drifted from the Loki spec on "
+                         f"{', '.join(sorted(changed))}\n\n")
+
+            # The full desired object, so the fields dropped from the spec are removed. A template change rolls out
+            # step by step
+            await lk.apply(live_sts, rollout_step(value['spec']), template_changed='spec.template' in changed)
+            logging.info(f"\n\n\tStatefulSet {namespace}/{name} applied\n\n")
 
-            new_sts_json = self.core_api.api_client.sanitize_for_serialization(dry_run)
-
-            # Update fields
-            new_sts_json['spec']['template']['metadata']['name'] = value['metadata']['name']
-            new_sts_json['spec']['template']['spec']['containers'][0]['name'] = value['metadata']['name']
-            new_sts_json['metadata']['name'] = value['metadata']['name']
-            new_sts_json['metadata']['generation'] = old_sts['metadata']['generation']
-
-            new_sts_json = self.__clear_defaults_field_sts(new_sts_json)
-            return new_sts_json == old_sts
-            # try:
-            #     if not new_sts_json == old_sts:
-            #         # self.apps_api.patch_namespaced_stateful_set(
-            #         #     name=value['metadata']['name'],
-            #         #     namespace=value['metadata']['namespace'],
-            #         #     body=new_sts_json
-            #         # )
-            #         # logging.info("\n\n\treconciliate\n\n")
-            #         # logging.info(f"\n\n\tNEW: {new_sts_json}\n\n")
-            #         # logging.info(f"\n\n\tACTUAL{old_sts}\n\n")
-            # except Exception as e:
-            #     logging.error(e)
-            # logging.info(f"\n\n\tNEW: {new_sts_json}\n\n")
-            # logging.info(f"\n\n\tACTUAL{old_sts}\n\n")
+        return in_sync
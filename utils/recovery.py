@@ -0,0 +1,52 @@
+import time
+from datetime import datetime
+from .metrics import POD_RECOVERY_SECONDS
+
+
+def _timestamp(value) -> float:
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+class RecoveryWatcher:
+    def __init__(self):
+        """ Measure how long the Loki Pods take to become ready after each start or restart of their container,
+        from the Pod events seen by the pods Informer
+        """
+
+        self.started = time.time()
+        self.__seen = dict()  # Container start already measured, per Pod
+
+    def attach(self, informer):
+        informer.add_handler(self.on_pod)
+
+    # Called by the Informer thread
+    def on_pod(self, event_type, pod):
+        pod_key = f"{pod['metadata']['namespace']}/{pod['metadata']['name']}"
+        if event_type == 'DELETED':
+            self.__seen.pop(pod_key, None)
+            return
+
+        status = pod.get('status') or {}
+        ready = next((condition for condition in status.get('conditions') or [] if condition['type'] == 'Ready'), None)
+        if ready is None or ready.get('status') != 'True' or not ready.get('lastTransitionTime'):
+            return
+
+        running = [
+            (container.get('state') or {}).get('running') or {}
+            for container in status.get('containerStatuses') or []
+        ]
+        starts = [state['startedAt'] for state in running if state.get('startedAt')]
+        if not starts:
+            return
+
+        # The last container started is the one the Pod waited for
+        container_start = max(starts)
+        if self.__seen.get(pod_key) == container_start:
+            return
+        self.__seen[pod_key] = container_start
+
+        started, ready_at = _timestamp(container_start), _timestamp(ready['lastTransitionTime'])
+        # Ignore the starts from before the operator start, and the Ready conditions older than the start
+        if started < self.started or ready_at < started:
+            return
+        POD_RECOVERY_SECONDS.observe(ready_at - started)
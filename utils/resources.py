@@ -1,91 +1,150 @@
+import copy
 import logging
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.exceptions import ApiException
+from . import quantity
+from .asyncApi import AsyncApi
+from .informer import read
+from .metrics import VPA_ACTIONS
+from .retry import retryable
+from .patch import FIELD_MANAGER
+from .rollout import ROLLOUT_STEP
+from .k8sControllers.lokiSf import CONFIG_HASH_ANNOTATION
 
-# config.load_kube_config('/lixo/kubernetes/jac/kubeconfig-production.yaml')
-config.load_incluster_config()
-api = client.AppsV1Api()
-
-
-def update(name: str, namespace: str, new_resource: dict, ):
-    patch = {
-        "spec": {
-            "template": {
-                "spec": {
-                    "containers": [
-                        {
-                            "name": name,
-                            "resources": new_resource
-                        }
-                    ]
-                }
-            }
-        }
-    }
+# Built lazily on the process-wide ApiClient, so importing this module needs no cluster
+api = AsyncApi(client.AppsV1Api)
+
+
+def __up_to_date(live, loki) -> bool:
+    """ True when the live resources are numerically the desired ones and the config did not change """
+    template = live['spec']['template']
+    container = next((ct for ct in template['spec']['containers'] if ct['name'] == loki.name), {})
+    desired = loki.manifest()['spec']['template']
+    config_hash = (template['metadata'].get('annotations') or {}).get(CONFIG_HASH_ANNOTATION)
+    return quantity.resources_equal(container.get('resources'), desired['spec']['containers'][0]['resources']) and \
+        config_hash == desired['metadata']['annotations'][CONFIG_HASH_ANNOTATION]
+
+
+async def live_stateful_set(name, namespace):
+    """ Return the live StatefulSet of a Loki from the cache, None when it does not exist. Shared, must not be
+    mutated """
+
+    async def fallback():
+        try:
+            stateful_set = await api.read_namespaced_stateful_set(name=name, namespace=namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+        return api.api_client.sanitize_for_serialization(stateful_set)
+
+    return await read('statefulsets', namespace, name, fallback, miss=True)
+
+
+async def update(loki, step: int = ROLLOUT_STEP):
+    """ Apply the StatefulSet of a Loki whose resources changed, the Pods restarted step by step
+    :param loki: The LokiSf rendered from the new spec, with the config tuned to the new resources
+    :param step: The Pods updated on each step of the rollout
+    """
+
+    live = await live_stateful_set(loki.name, loki.namespace)
+    if live is not None and __up_to_date(live, loki):
+        logging.info(f"\n\n\tThe resources of {loki.namespace}/{loki.name} are up to date\n\n")
+        return
 
     try:
-        _patch = api.patch_namespaced_stateful_set(
+        if live is None:
+            await loki.create()
+        else:
+            await loki.apply(live, step)
+        logging.info(f"\n\n\tSuccess Update!\n\n")
+    except ApiException as e:
+        logging.error(f"{e}")
+        # Still failing after the retries: raise, so kopf retries the handler
+        if retryable(e):
+            raise
+
+
+async def scale(name: str, namespace: str, replicas: int):
+    patch = {"spec": {"replicas": replicas}}
+
+    async def fallback():
+        return None
+
+    live = await read('statefulsets', namespace, name, fallback)
+    if live is not None and live['spec'].get('replicas') == replicas:
+        logging.info(f"\n\n\t{namespace}/{name} already has {replicas} replicas\n\n")
+        return
+
+    try:
+        await api.patch_namespaced_stateful_set(
             namespace=namespace,
             name=name,
-            body=patch
+            body=patch,
+            field_manager=FIELD_MANAGER
         )
-        logging.info(f"\n\n\tSuccess Update!\n\n")
+        logging.info(f"\n\n\tScaled {namespace}/{name} to {replicas} replicas\n\n")
     except ApiException as e:
         logging.error(f"{e}")
+        # Still failing after the retries: raise, so kopf retries the handler
+        if retryable(e):
+            raise
 
 
-def __calc_resource(namespace: str, name: str):
-    up_mem = 3
+async def __calc_resource(namespace: str, name: str, memory=None):
+    """ Return the patch bumping the memory limit of a Loki, None when there is nothing to bump
+    :param memory: The memory limit the OOMKilled containers ran with, the spec one when None. The OOMs of the Pods
+                   still running the limit before a bump do not bump it again
+    """
+    up_mem = 1.25  # Memory limit multiplier after an OOMKilled
     pkg = dict()
-    api = client.CustomObjectsApi()
-    loki = api.get_namespaced_custom_object(
-        group='jack.experts',
-        version='v1',
-        namespace=namespace,
-        plural='lokis',
-        name=name
-    )
+    api = AsyncApi(client.CustomObjectsApi)
+
+    async def fallback():
+        return await api.get_namespaced_custom_object(
+            group='jack.experts',
+            version='v1',
+            namespace=namespace,
+            plural='lokis',
+            name=name
+        )
 
-    resource = loki['spec']['resources']
-
-    memory = loki['spec']['resources']['limits']['memory']
-    #
-    if 'Mi' in memory:
-        num = int(memory.split('Mi')[0]) + up_mem
-        _num = str(num) + 'Mi'
-        resource['limits']['memory'] = _num
-        pkg["spec"] = {"resources": resource}
-        return pkg
-    elif 'Gi' in memory:
-        num = int(memory.split('Gi')[0]) + up_mem
-        _num = str(num) + 'Gi'
-        resource['limits']['memory'] = _num
-        pkg["spec"] = {"resources": resource}
-        return pkg
-
-
-def vpa(name: str, namespace: str):
-    _event = client.CoreV1Api()
-    response = _event.read_namespaced_pod(namespace=namespace, name=f'{name}-0')
-    evento = _event.api_client.sanitize_for_serialization(response)
-
-    current_status = evento['status']['containerStatuses'][0]['state']
-    last_status = evento['status']['containerStatuses'][0]['lastState']
-
-    logging.info(f"\n\n\t{__calc_resource(namespace, name)}\n\n")
-
-    if 'waiting' in current_status:  # Verify current container status
-        # If the current status is waiting, verify if the Last Status is terminated
-        if 'terminated' in last_status:
-            api = client.CustomObjectsApi()
-            api.patch_namespaced_custom_object(
-                group="jack.experts",
-                version="v1",
-                namespace=namespace,
-                plural="lokis",
-                name=name,
-                body=__calc_resource(name=name, namespace=namespace)
-            )
-            logging.info("\n\nVPA WORKS\n\n")
+    loki = await read('lokis', namespace, name, fallback)
+    if loki is None:
+        return None
 
+    # The cached object is shared, so work on a copy
+    resource = copy.deepcopy(loki['spec']['resources'])
 
+    current = loki['spec']['resources']['limits']['memory']
+    bumped = quantity.scale(memory or current, up_mem, round_to='1Mi')
+    if quantity.compare(bumped, current) <= 0:
+        logging.info(f"\n\n\t{namespace}/{name} already has {current} of memory, over the {memory} OOMKilled\n\n")
+        return None
+
+    resource['limits']['memory'] = bumped
+    pkg["spec"] = {"resources": resource}
+    return pkg
+
+
+async def vpa(name: str, namespace: str, memory=None):
+    """ Bump the memory of a Loki after an OOMKilled, reported by the OomWatcher
+    :param memory: The memory limit the OOMKilled containers ran with, None to bump the spec one
+    """
+    body = await __calc_resource(namespace=namespace, name=name, memory=memory)
+    if body is None:
+        return
+
+    logging.info(f"\n\n\t{body}\n\n")
+
+    api = AsyncApi(client.CustomObjectsApi)
+    await api.patch_namespaced_custom_object(
+        group="jack.experts",
+        version="v1",
+        namespace=namespace,
+        plural="lokis",
+        name=name,
+        body=body
+    )
+    VPA_ACTIONS.labels(action='oom').inc()
+    logging.info("\n\nVPA WORKS\n\n")
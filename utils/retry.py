@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import random
+import typing
+import asyncio
+from urllib3.exceptions import HTTPError
+from kubernetes.client.exceptions import ApiException
+from .apiClient import API_CONCURRENCY
+from .metrics import API_LIMIT, API_RETRIES
+
+# Attempts of a call before its error is raised to the caller
+API_RETRIES_MAX = int(os.environ.get('LOKI_OPERATOR_API_RETRIES', '5'))
+
+# Throttled (429) and transient server errors
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def _reason(e) -> typing.Optional[str]:
+    """ Return the reason of the Status returned by the API server, e.g. Conflict or AlreadyExists """
+    try:
+        return json.loads(e.body).get('reason')
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def retryable(e) -> bool:
+    """ True when sending the same call again may succeed """
+    if isinstance(e, ApiException):
+        if e.status in _RETRYABLE_STATUS:
+            return True
+        # An optimistic lock conflict, not an AlreadyExists on create which is also a 409
+        return e.status == 409 and _reason(e) == 'Conflict'
+    return isinstance(e, (HTTPError, ConnectionError))
+
+
+def retry_after(e) -> float:
+    """ Return the seconds asked by the Retry-After header, 0 without it """
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After') or 0)
+    except ValueError:
+        return 0.0  # An HTTP date, never sent by the API server
+
+
+class AdaptiveLimit:
+    def __init__(self, maximum, minimum=1, decrease=0.5, cooldown=1.0):
+        """ Client-side limit of the calls in flight: halved on a 429 (at most once per cooldown),
+        grown by one after a limit of successful calls. The other errors leave it as is
+        :param maximum: The max limit, e.g. the size of the API executor
+        :param minimum: The min limit
+        :param decrease: Factor applied to the limit on a 429
+        :param cooldown: Seconds between two decreases, the 429 of the calls sent together count once
+        """
+
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.in_flight = 0
+
+        self.__waiters = list()
+        self.__decreased = 0.0
+        API_LIMIT.set(self.limit)
+
+    async def acquire(self):
+        while self.in_flight >= max(self.minimum, int(self.limit)):
+            waiter = asyncio.get_running_loop().create_future()
+            self.__waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def release(self, throttled=False, succeeded=False):
+        """ Release a slot
+        :param throttled: The call got a 429
+        :param succeeded: The call returned, a failed one must not grow the limit
+        """
+        self.in_flight -= 1
+
+        if throttled:
+            now = time.monotonic()
+            if now - self.__decreased >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.__decreased = now
+        elif succeeded:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        API_LIMIT.set(self.limit)
+
+        waiters, self.__waiters = self.__waiters, list()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class RetryPolicy:
+    def __init__(self, attempts=API_RETRIES_MAX, base=0.2, cap=10.0):
+        """ Jittered exponential backoff of the retryable errors
+        :param attempts: Attempts of a call before its error is raised
+        :param base: Seconds of the first backoff
+        :param cap: Max seconds of a backoff
+        """
+
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, e, attempt):
+        """ Return the seconds to wait before the next attempt, None when the error must be raised """
+        if attempt + 1 >= self.attempts or not retryable(e):
+            return None
+        # Full jitter: the calls failed together do not retry together
+        backoff = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        return max(backoff, retry_after(e))
+
+
+limiter = AdaptiveLimit(API_CONCURRENCY)
+policy = RetryPolicy()
+
+
+async def call(fn, retry_policy=None):
+    """ Await fn() under the adaptive limit, retrying its retryable errors
+    :param fn: Function returning a new awaitable on each call
+    :param retry_policy: The RetryPolicy, the default one when None
+    """
+    retry_policy = retry_policy or policy
+    attempt = 0
+
+    while True:
+        await limiter.acquire()
+        throttled = succeeded = False
+        try:
+            result = await fn()
+            succeeded = True
+            return result
+        except Exception as e:
+            throttled = getattr(e, 'status', None) == 429
+            delay = retry_policy.delay(e, attempt)
+            if delay is None:
+                raise
+            API_RETRIES.labels(code=str(getattr(e, 'status', None) or type(e).__name__)).inc()
+        finally:
+            limiter.release(throttled, succeeded)
+
+        attempt += 1
+        await asyncio.sleep(delay)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from kubernetes import client
+from .asyncApi import AsyncApi
+from .informer import get_informer, read
+from .patch import FIELD_MANAGER
+
+# Pods updated at once by default, so an upgrade never takes more than one replica out of the ingestion
+ROLLOUT_STEP = 1
+
+
+def rollout_step(spec) -> int:
+    """ Return the Pods updated on each step of a rollout, from spec.rollout.step of the Loki CR """
+    return max(1, int((spec.get('rollout') or {}).get('step', ROLLOUT_STEP)))
+
+
+def partition(stateful_set) -> int:
+    """ Return the ordinal from which the Pods get the new template, 0 when no rollout is held """
+    strategy = stateful_set['spec'].get('updateStrategy') or {}
+    return (strategy.get('rollingUpdate') or {}).get('partition') or 0
+
+
+def stage(body, live, step=ROLLOUT_STEP, template_changed=True) -> dict:
+    """ Set the partition on the full StatefulSet applied by the operator. A Pod template change is held to the
+    highest step ordinals, the RolloutController moving the partition down as the updated Pods become ready.
+    Without a template change, a rollout in progress keeps its partition
+    :param body: The full desired StatefulSet
+    :param live: The live StatefulSet, None when unknown
+    :param step: The Pods updated on each step
+    :param template_changed: True when the apply changes the Pod template
+    """
+
+    if live is None:
+        return body
+
+    held = partition(live)
+    replicas = body['spec'].get('replicas') or 1
+    if template_changed:
+        value = replicas - step if replicas > step else 0
+    else:
+        value = held
+    if not value and not held:
+        return body
+
+    update_strategy = dict(body['spec'].get('updateStrategy') or {}, rollingUpdate={'partition': value})
+    return dict(body, spec=dict(body['spec'], updateStrategy=update_strategy))
+
+
+def _ready(pod) -> bool:
+    for condition in (pod.get('status') or {}).get('conditions') or []:
+        if condition.get('type') == 'Ready':
+            return condition.get('status') == 'True'
+    return False
+
+
+def _ordinal(pod) -> int:
+    return int(pod['metadata']['name'].rsplit('-', 1)[1])
+
+
+def _owner(pod):
+    """ Return the key of the StatefulSet owning the Pod, None for the other Pods """
+    for owner in pod['metadata'].get('ownerReferences') or []:
+        if owner['kind'] == 'StatefulSet':
+            return f"{pod['metadata']['namespace']}/{owner['name']}"
+    return None
+
+
+class RolloutController:
+    def __init__(self, cr_plural='lokis', api_client=None):
+        """ Move the partition of the staged rollouts down, step by step, once the updated Pods pass
+        their /ready probe
+        :param cr_plural: The Loki CustomResource Plural Name, giving the step of each rollout
+        :param api_client: The kubernetes ApiClient, the process-wide one by default
+        """
+
+        self.cr_plural = cr_plural
+        self.api = AsyncApi(client.AppsV1Api, api_client)
+
+        self.__loop = None
+        self.__scheduled = set()
+
+    def attach(self, statefulsets, pods, loop):
+        """ Listen to the StatefulSet and Pod events of the Informers, checking the rollouts on the loop """
+        self.__loop = loop
+        statefulsets.add_handler(self.on_stateful_set)
+        pods.add_handler(self.on_pod)
+
+    # Called by the Informer threads
+    def on_stateful_set(self, event_type, stateful_set):
+        if event_type != 'DELETED' and partition(stateful_set):
+            key = f"{stateful_set['metadata']['namespace']}/{stateful_set['metadata']['name']}"
+            self.__loop.call_soon_threadsafe(self.__schedule, key)
+
+    def on_pod(self, event_type, pod):
+        key = _owner(pod)
+        if key is not None:
+            self.__loop.call_soon_threadsafe(self.__schedule, key)
+
+    def __schedule(self, key):
+        # The events of all the replicas are checked once
+        if key in self.__scheduled:
+            return
+        self.__scheduled.add(key)
+        asyncio.ensure_future(self.__advance(key))
+
+    def __updated_pods_ready(self, stateful_set, held) -> bool:
+        """ True when every Pod from the partition up runs the update revision and is ready """
+        status = stateful_set.get('status') or {}
+        # The StatefulSet controller has not acted on the last change yet
+        if status.get('observedGeneration') != stateful_set['metadata'].get('generation'):
+            return False
+
+        key = f"{stateful_set['metadata']['namespace']}/{stateful_set['metadata']['name']}"
+        updated = [pod for pod in get_informer('pods').list() if _owner(pod) == key and _ordinal(pod) >= held]
+        if len(updated) < (stateful_set['spec'].get('replicas') or 0) - held:
+            return False
+
+        revision = status.get('updateRevision')
+        return all(
+            pod['metadata'].get('labels', {}).get('controller-revision-hash') == revision and _ready(pod)
+            for pod in updated
+        )
+
+    async def __advance(self, key):
+        self.__scheduled.discard(key)
+        namespace, name = key.split('/')
+
+        informer = get_informer('statefulsets')
+        stateful_set = informer.get(namespace, name) if informer is not None else None
+        if stateful_set is None:
+            return
+
+        held = partition(stateful_set)
+        if not held or not self.__updated_pods_ready(stateful_set, held):
+            return
+
+        async def fallback():
+            return None
+
+        loki = await read(self.cr_plural, namespace, name, fallback)
+        step = rollout_step(loki['spec']) if loki is not None else ROLLOUT_STEP
+        new_partition = max(0, held - step)
+
+        try:
+            await self.api.patch_namespaced_stateful_set(
+                name=name,
+                namespace=namespace,
+                body={'spec': {'updateStrategy': {'rollingUpdate': {'partition': new_partition}}}},
+                field_manager=FIELD_MANAGER
+            )
+            logging.info(f"\n\n\tRollout of {key} moved to partition {new_partition}\n\n")
+        except Exception as e:
+            logging.error(f"\n\n\tRollout of {key} not moved: {e}\n\n")
@@ -0,0 +1,216 @@
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+from .apiClient import api_client as shared_api_client
+from .informer import MANAGED_BY_LABEL, MANAGED_BY_VALUE
+
+# Label of the Leases announcing the operator replicas
+SHARD_LABEL = 'loki-operator.jack.experts/shard'
+
+
+def _hash(value) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, members, vnodes=64):
+        """ Consistent hash of the namespace/name keys over the operator replicas
+        :param members: The identities of the live replicas
+        :param vnodes: Points of each replica on the ring, more points spread the keys more evenly
+        """
+
+        self.members = tuple(sorted(members))
+        points = sorted((_hash(f'{member}#{index}'), member) for member in self.members for index in range(vnodes))
+        self.__hashes = [point for point, _ in points]
+        self.__owners = [member for _, member in points]
+
+    def owner(self, key):
+        """ Return the replica owning the key, None on an empty ring """
+        if not self.__hashes:
+            return None
+        index = bisect.bisect(self.__hashes, _hash(key)) % len(self.__hashes)
+        return self.__owners[index]
+
+
+class Sharding:
+    def __init__(self, namespace, identity, lease_duration=15, vnodes=64, api_client=None):
+        """ Split the Loki CRs across the operator replicas, each replica announcing itself with a Lease
+        :param namespace: The namespace of the Leases
+        :param identity: The unique name of this replica, e.g. the Pod name
+        :param lease_duration: Seconds without renew after which a replica is considered gone
+        :param vnodes: Points of each replica on the hash ring
+        :param api_client: The kubernetes ApiClient, the process-wide one by default
+        """
+
+        self.namespace = namespace
+        self.identity = identity
+        self.lease_name = f'loki-operator-shard-{identity}'
+        self.lease_duration = lease_duration
+        self.renew_period = lease_duration / 3
+        # Keys moving to this replica wait for the previous owner to see the new ring and let them go
+        self.handoff = 2 * self.renew_period
+        self.vnodes = vnodes
+        self.api_client = api_client
+
+        self.ring = None  # Ring owning the keys
+        self.pending = None  # New ring, active once the handoff period is over
+        self.__pending_since = 0.0
+
+        self.listeners = list()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__api = None
+
+    @property
+    def api(self):
+        if self.__api is None:
+            self.__api = client.CoordinationV1Api(self.api_client or shared_api_client())
+        return self.__api
+
+    def add_listener(self, listener):
+        """ Register a function called as listener(phase) from the Sharding thread, phase being
+        pending when a new ring is seen and active once it owns the keys """
+        self.listeners.append(listener)
+
+    def owns(self, namespace, name) -> bool:
+        """ True when this replica handles the Loki. During a handoff, a key is only owned if both rings agree """
+        key = f'{namespace}/{name}'
+        ring, pending = self.ring, self.pending
+
+        if ring is None or ring.owner(key) != self.identity:
+            return False
+        return pending is None or pending.owner(key) == self.identity
+
+    def awaits(self, namespace, name) -> bool:
+        """ True when the Loki comes to this replica once the handoff is over, or may come to it while no ring is
+        known yet. Its events are retried until then, not dropped """
+        key = f'{namespace}/{name}'
+        ring, pending = self.ring, self.pending
+
+        if ring is None and pending is None:
+            return True
+        return pending is not None and pending.owner(key) == self.identity and not self.owns(namespace, name)
+
+    def handoff_left(self) -> float:
+        """ Seconds before the pending ring owns the keys, 0 without a handoff """
+        if self.pending is None:
+            return 0.0
+        return max(0.0, self.handoff - (time.monotonic() - self.__pending_since))
+
+    def caches(self, namespace, name) -> bool:
+        """ True when this replica keeps the Loki on its caches: owned now, or after the handoff """
+        key = f'{namespace}/{name}'
+        return any(
+            ring is not None and ring.owner(key) == self.identity
+            for ring in (self.ring, self.pending)
+        )
+
+    def start(self):
+        """ Announce this replica and read the members once, so the first ring is pending when the handlers start,
+        then keep renewing on a thread. Blocking """
+        if self.__thread is None:
+            self.__step()
+            self.__thread = threading.Thread(target=self.__run, name='sharding', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        """ Stop renewing and delete the Lease, so the other replicas take the keys without waiting its expiry """
+        self.__stop.set()
+        try:
+            self.api.delete_namespaced_lease(name=self.lease_name, namespace=self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                logging.error(f"\n\n\tLease {self.lease_name} was not released: {e}\n\n")
+
+    @staticmethod
+    def __now() -> str:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    @staticmethod
+    def __timestamp(value) -> float:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+    def __renew(self):
+        now = self.__now()
+        try:
+            self.api.patch_namespaced_lease(
+                name=self.lease_name,
+                namespace=self.namespace,
+                body={'spec': {'renewTime': now}}
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            self.api.create_namespaced_lease(namespace=self.namespace, body={
+                'apiVersion': 'coordination.k8s.io/v1',
+                'kind': 'Lease',
+                'metadata': {
+                    'name': self.lease_name,
+                    'namespace': self.namespace,
+                    'labels': {MANAGED_BY_LABEL: MANAGED_BY_VALUE, SHARD_LABEL: 'true'}
+                },
+                'spec': {
+                    'holderIdentity': self.identity,
+                    'leaseDurationSeconds': int(self.lease_duration),
+                    'acquireTime': now,
+                    'renewTime': now
+                }
+            })
+            logging.info(f"\n\n\tReplica {self.identity} joined the operator shards\n\n")
+
+    # Return the replicas with a Lease renewed in time
+    def __members(self) -> set:
+        response = self.api.list_namespaced_lease(
+            namespace=self.namespace,
+            label_selector=f'{SHARD_LABEL}=true',
+            _preload_content=False
+        )
+        now = time.time()
+        members = {self.identity}
+
+        for lease in json.loads(response.data)['items']:
+            spec = lease.get('spec') or {}
+            renew = spec.get('renewTime')
+            if not renew or not spec.get('holderIdentity'):
+                continue
+            if self.__timestamp(renew) + spec.get('leaseDurationSeconds', self.lease_duration) > now:
+                members.add(spec['holderIdentity'])
+
+        return members
+
+    def __notify(self, phase):
+        for listener in self.listeners:
+            try:
+                listener(phase)
+            except Exception as e:
+                logging.error(f"\n\n\tSharding listener failed: {e}\n\n")
+
+    def __update(self, members):
+        latest = self.pending or self.ring
+        if latest is None or set(latest.members) != members:
+            logging.info(f"\n\n\tOperator shards: {', '.join(sorted(members))}\n\n")
+            self.pending = HashRing(members, self.vnodes)
+            self.__pending_since = time.monotonic()
+            self.__notify('pending')
+
+        if self.pending is not None and time.monotonic() - self.__pending_since >= self.handoff:
+            self.ring, self.pending = self.pending, None
+            self.__notify('active')
+
+    def __step(self):
+        try:
+            self.__renew()
+            self.__update(self.__members())
+        except Exception as e:
+            logging.error(f"\n\n\tSharding failed: {e}\n\n")
+
+    def __run(self):
+        # The pending ring is activated as soon as its handoff is over
+        while not self.__stop.wait(min(self.renew_period, self.handoff_left() or self.renew_period)):
+            self.__step()
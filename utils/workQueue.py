@@ -0,0 +1,129 @@
+import time
+import asyncio
+import logging
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        """ Global rate limit shared by all the queue workers
+        :param rate: Tokens added per second
+        :param burst: Max number of tokens stored
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.__last = time.monotonic()
+        self.__lock = None
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    async def acquire(self):
+        """ Wait until a token is available and take it """
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+
+        async with self.__lock:
+            self.__refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.__refill()
+            self.tokens -= 1
+
+
+class WorkQueue:
+    def __init__(self, process_fn, workers=4, rate=20.0, burst=40, base_delay=0.5, max_delay=300.0):
+        """ Keyed work queue collapsing duplicated keys, processed by parallel workers
+        :param process_fn: Coroutine function called as process_fn(key)
+        :param workers: Number of parallel workers
+        :param rate: Max number of keys processed per second by all the workers
+        :param burst: Max number of keys processed at once after an idle period
+        :param base_delay: Backoff in seconds after the first failure of a key
+        :param max_delay: Max backoff in seconds of a key
+        """
+
+        self.process_fn = process_fn
+        self.workers = workers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+
+        self.latency = dict()  # Seconds from the add to the end of the last processing, per key
+
+        self.__queue = None
+        self.__tasks = list()
+        self.__pending = dict()  # Keys waiting on the queue and their add time
+        self.__processing = set()
+        self.__dirty = set()  # Keys added again while being processed
+        self.__failures = dict()
+
+    def depth(self) -> int:
+        """ Number of keys waiting to be processed """
+        return len(self.__pending) + len(self.__dirty)
+
+    def start(self):
+        """ Start the workers on the running event loop """
+        if self.__queue is None:
+            self.__queue = asyncio.Queue()
+            self.__tasks = [asyncio.ensure_future(self.__worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    def add(self, key):
+        """ Add a key to the queue, unless it is already waiting """
+        if key in self.__pending:
+            return
+        if key in self.__processing:
+            self.__dirty.add(key)
+            return
+
+        self.__pending[key] = time.monotonic()
+        self.__queue.put_nowait(key)
+
+    def add_after(self, key, delay):
+        asyncio.get_running_loop().call_later(delay, self.add, key)
+
+    def add_rate_limited(self, key):
+        """ Add the key again after an exponential backoff of its failures """
+        failures = self.__failures.get(key, 0) + 1
+        self.__failures[key] = failures
+        delay = min(self.base_delay * 2 ** (failures - 1), self.max_delay)
+        self.add_after(key, delay)
+
+    def forget(self, key):
+        self.__failures.pop(key, None)
+
+    def drop(self, key):
+        """ Forget everything known about a deleted key """
+        self.forget(key)
+        self.latency.pop(key, None)
+
+    async def __worker(self):
+        while True:
+            key = await self.__queue.get()
+            added = self.__pending.pop(key)
+            self.__processing.add(key)
+
+            try:
+                await self.bucket.acquire()
+                await self.process_fn(key)
+                self.forget(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"\n\n\tReconcile of {key} failed: {e}\n\n")
+                self.add_rate_limited(key)
+            finally:
+                self.latency[key] = time.monotonic() - added
+                self.__processing.discard(key)
+                self.__queue.task_done()
+
+            if key in self.__dirty:
+                self.__dirty.discard(key)
+                self.add(key)